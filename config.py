@@ -4,7 +4,7 @@ Centralized configuration for the autograder system.
 """
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 from dotenv import load_dotenv
 
@@ -19,11 +19,15 @@ class AzureConfig:
 
 @dataclass
 class RateLimits:
-    """Rate limiting configuration"""
+    """Rate limiting configuration (starting values; corrected from the service's rate-limit headers)"""
     requests_per_minute: int = 100
     tokens_per_minute: int = 100_000
     embedding_concurrent: int = 3
     question_concurrent: int = 3
+    initial_concurrency: int = 8  # chat requests in flight at first; adapts to the deployment (AIMD)
+    max_concurrency: int = 64
+    max_retries: int = 6  # retries of a request throttled with 429
+    embedding_max_retries: int = 5  # retries of an embeddings request that hit a 429, 5xx or connection error
 
 @dataclass
 class ModelConfig:
@@ -32,6 +36,7 @@ class ModelConfig:
     embedding_model: str = "text-embedding-3-large"
     encoder_model: str = "o200k_base"
     max_tokens: int = 8192
+    batch_model: Optional[str] = None  # Azure global-batch deployment for --batch_api; None = the grading model
 
 @dataclass
 class ProcessingConfig:
@@ -42,6 +47,60 @@ class ProcessingConfig:
     max_dimension: int = 15000
     dpi: int = 200
     quality: int = 90
+    render_workers: Optional[int] = None  # None = one process per core
+    render_pages_per_task: int = 8
+    render_max_tasks_per_child: int = 64
+    page_cache_size: int = 256  # rendered page images kept in memory while grading
+    page_image_cache_bytes: int = 256 * 1024 ** 2  # encoded image data URLs kept in memory while grading
+    grading_image_detail: str = "auto"  # "high", "low", or "auto" (per request, within grading_image_token_budget)
+    grading_image_token_budget: int = 1500  # vision tokens per grading request when detail is "auto"
+    grading_image_format: str = "jpeg"  # "jpeg" or "png"
+    grading_image_quality: int = 75
+    grading_image_grayscale: bool = True
+    grading_image_trim: bool = True  # crop whitespace margins
+    grading_image_tile_snap: float = 0.15  # shrink up to this fraction to save a row/column of 512px tiles
+    grading_batch_size: int = 1  # student answers per grading request; >1 grades several answers to a question at once
+    grading_batch_max_tokens: int = 24_000  # estimated input tokens per multi-answer request
+    quick_grade_samples: int = 2  # independent points-only grades per answer (grade_1..grade_k)
+    quick_grade_sampling: str = "n"  # "n" (one request for k choices) or "fanout" (k parallel requests)
+    grading_consistency_sample: int = 20  # answers re-graded one at a time to check multi-answer grading
+    batch_base_url: Optional[str] = field(default_factory=lambda: os.getenv("AUTOGRADER_BATCH_BASE_URL"))  # stand-in batch server
+    batch_completion_window: str = "24h"
+    batch_poll_seconds: float = 60.0
+    batch_max_requests: int = 50_000  # requests per batch input file
+    batch_max_file_bytes: int = 100 * 1024 ** 2  # size of a batch input file (the service accepts up to 200 MB)
+    batch_max_resubmits: int = 3  # new jobs for requests an expired job left unfinished
+    ocr_concurrency: int = 10  # Document Intelligence analyses in flight at once
+    ocr_poll_min_seconds: float = 0.5
+    ocr_poll_max_seconds: float = 5.0
+    ocr_mode: str = "auto"  # "auto" (text layer + OCR for weak pages), "azure" or "local"
+    text_layer_min_chars: int = 200  # pages with less extractable text are OCR'd
+    text_layer_max_image_coverage: float = 0.5  # pages this image-covered are OCR'd
+    ocr_page_level: bool = True  # OCR and cache PDFs page by page so resubmissions only pay for changed pages
+    ingest_workers: Optional[int] = None  # processes for truncation/text extraction; None = one per core
+    convert_workers: Optional[int] = None  # parallel LibreOffice DOCX->PDF conversions; None = one per core
+    convert_timeout_seconds: float = 300.0  # abandon a single DOCX conversion after this long
+    embedding_batch_tokens: int = 100_000  # token budget per embeddings request, summed over inputs
+    embedding_batch_size: int = 2048  # inputs per embeddings request (API maximum)
+    embedding_batch_wait_seconds: float = 0.05  # how long a partial batch waits for more texts
+    page_embedding_dtype: str = "float32"  # "float16" halves the page embedding store
+    page_embedding_dims: Optional[int] = None  # keep only the first N dimensions (text-embedding-3 supports shortening)
+    page_match_min_confidence: float = 0.8  # text-matched page assignments below this go to the LLM
+    page_match_min_words: int = 5  # shorter answers are too ambiguous to locate by text
+    page_mapping_mode: str = "submission"  # "submission" (one LLM call per submission) or "question"
+    token_count_cache_size: int = 4096  # memoized token counts of shared prompt parts per encoding (system prompts, question prefixes)
+    tokenizer_threads: Optional[int] = None  # threads for batch token counting; None = Python's default
+    embedding_provider: str = "azure"  # page-mapping embeddings: "azure" or "local" (offline hashed bag-of-words)
+    local_embedding_dims: int = 4096  # hash buckets for the local embedding provider
+
+@dataclass
+class CacheConfig:
+    """Persistent cache configuration (shared by every course run on this machine)"""
+    cache_dir: str = field(default_factory=lambda: os.getenv(
+        "AUTOGRADER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autograder")
+    ))
+    ocr_max_bytes: int = 2 * 1024 ** 3
+    embedding_max_bytes: int = 2 * 1024 ** 3
 
 class Config:
     """Main configuration class"""
@@ -51,6 +110,7 @@ class Config:
         self.rate_limits = RateLimits()
         self.models = ModelConfig()
         self.processing = ProcessingConfig()
+        self.cache = CacheConfig()
     
     def _load_azure_config(self) -> AzureConfig:
         """Load Azure configuration from environment variables"""
@@ -64,18 +124,22 @@ class Config:
             api_key_doc_intel=os.getenv("AZURE_API_KEY")
         )
     
-    def validate(self) -> bool:
-        """Validate that all required configuration is present"""
+    def validate(self, ocr_mode: Optional[str] = None) -> bool:
+        """
+        Validate that all configuration the run needs is present. Document
+        Intelligence credentials are only required when ocr_mode uses it
+        (anything but "local").
+        """
         if not self.azure.endpoint_gpt or not self.azure.api_key_gpt:
             raise ValueError("Azure GPT credentials (AZURE_ENDPOINT_GPT, AZURE_API_KEY_GPT) are required")
         
+        if (ocr_mode or self.processing.ocr_mode) == "local":
+            return True
+
         if not self.azure.endpoint_doc_intel or not self.azure.api_key_doc_intel:
             raise ValueError("Azure Document Intelligence credentials (AZURE_ENDPOINT, AZURE_API_KEY) are required")
         
         return True
 
-# Global configuration instance
+# Global configuration instance (validated by the entry point, see Config.validate)
 config = Config()
-
-# Validate configuration on import
-config.validate()
@@ -8,12 +8,15 @@ import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI
-from docx2pdf import convert
 
-import concurrent.futures
-
-from processing.grading.llm_grader import grade_questions, grade_questions_simple
-from processing.document_ingest.process_documents import process_all_documents, process_single_document
+from processing.grading.llm_grader import add_agreement_stats, grade_questions, grade_questions_multi_sample
+from processing.grading.batch_grading import grade_questions_offline
+from processing.grading.multi_answer import (
+    check_batch_consistency, grade_questions_batched, grade_questions_simple_batched,
+)
+from processing.document_ingest.process_documents import process_all_documents, process_single_document, load_submissions_markdown
+from processing.document_ingest.convert_docx import DocxConverter
+from processing.document_ingest.layout_index import load_layout_indexes
 from processing.extraction.extract_problems import process_submissions, get_questions_with_context, strip_assignment
 from processing.rubric_answer_key.generate_rubric import generate_rubrics, expand_rubric
 from processing.rubric_answer_key.create_answer_key import question_level_answer_key
@@ -21,8 +24,9 @@ from processing.rubric_answer_key.generate_answer_key import generate_key, selec
 from processing.grading.compile_feedback import generate_subquestion_feedback
 from processing.extraction.replace_pp_link import replace_pingpong_urls_in_submissions
 from processing.extraction.get_page_nums import map_questions_to_pages_llm
-from processing.document_ingest.pdf2img import create_images
+from processing.document_ingest.page_images import PageImageProvider
 from helpers.token_tracker import token_tracker
+from helpers.batch_jobs import batch_client
 from config import config
 
 #TODO: Send pages to LLM
@@ -85,7 +89,59 @@ async def main():
         help="Azure OpenAI model to use for grading (default: gpt-5-mini)"
     )
 
+    parser.add_argument(
+        "--ocr_mode",
+        type=str,
+        choices=["auto", "azure", "local"],
+        default=config.processing.ocr_mode,
+        help="How documents become markdown: 'auto' uses the PDF text layer and sends only text-poor pages to "
+             "Document Intelligence, 'azure' sends every page, 'local' never calls Document Intelligence (default: auto)"
+    )
+
+    parser.add_argument(
+        "--page_mapping_mode",
+        type=str,
+        choices=["submission", "question"],
+        default=config.processing.page_mapping_mode,
+        help="Pages that can't be located by text match are mapped by the LLM with one request per submission "
+             "(all its questions at once) or one request per question (default: submission)"
+    )
+
+    parser.add_argument(
+        "--embedding_provider",
+        type=str,
+        choices=["azure", "local"],
+        default=config.processing.embedding_provider,
+        help="Embeddings used to find candidate pages: 'azure' (text-embedding model) or 'local' "
+             "(offline hashed bag-of-words, no network calls) (default: azure)"
+    )
+
+    parser.add_argument(
+        "--grading_batch_size",
+        type=int,
+        default=config.processing.grading_batch_size,
+        help="Student answers to the same question graded per request; above 1, answers are graded "
+             "together and a sample is re-graded one at a time to check agreement (default: 1)"
+    )
+
+    parser.add_argument(
+        "--quick_grade_samples",
+        type=int,
+        default=config.processing.quick_grade_samples,
+        help="Independent points-only grades per answer (grade_1..grade_k), requested together with their "
+             "agreement statistics (default: 2)"
+    )
+
+    parser.add_argument(
+        "--batch_api",
+        action="store_true",
+        help="Grade through the Batch API instead of the chat endpoint: requests are submitted as batch jobs "
+             "that finish within 24 hours without per-minute rate limits; rerunning resumes submitted jobs"
+    )
+
     args = parser.parse_args()
+    if args.batch_api and args.grading_batch_size > 1:
+        parser.error("--batch_api grades one answer per request; it cannot be combined with --grading_batch_size > 1")
     model = args.model
 
     #TEMP FILES
@@ -105,10 +161,6 @@ async def main():
     blank_assignment_md_path = os.path.join(backup_folder,"blank_assignment.md")
     questions_with_context_path = os.path.join(backup_folder,"questions_with_context.csv")
 
-    img_dir = os.path.join(backup_folder, "img")
-    os.makedirs(img_dir, exist_ok=True)    
-    
-
     answer_key_md_path = os.path.join(backup_folder, "answer_key_backup.md")
     answer_key_csv_path = os.path.join(backup_folder, "standardized_answer_key.csv")
     answer_key_generated_answers_all_csv_path = os.path.join(backup_folder, "standardized_answer_key_all_attempts.csv")
@@ -121,8 +173,8 @@ async def main():
     #0 Initialize and LLM Client:
     load_dotenv()
     
-    # Validate configuration
-    config.validate()
+    # Validate configuration (Document Intelligence credentials only if it will be used)
+    config.validate(ocr_mode=args.ocr_mode)
     
     # Initialize Azure OpenAI client
     client = AsyncAzureOpenAI(
@@ -143,39 +195,33 @@ async def main():
             print(f"Error: Submissions folder '{args.submissions_folder}' does not exist.")
             sys.exit(1)
         
-        # Validate and convert files
-        print("Validating and converting files...")
-        try:
-            convert(args.submissions_folder)
-            print("Successfully converted DOCX files to PDF")
-        except Exception as e:
-            print(f"Error converting DOCX files: {e}")
+        # DOCX files are converted in parallel while ingestion runs; each PDF
+        # joins the ingestion queue as soon as it is written
+        converter = DocxConverter(args.submissions_folder, manifest_dir=backup_folder)
+        to_convert = converter.pending()
+        if to_convert:
+            print(f"Converting {len(to_convert)} DOCX files to PDF...")
+
+        print("Converting submissions to Markdown...")
+        #TODO: Figure out how to track costs of document intelligence
+        submissions = await process_all_documents(
+            args.submissions_folder,
+            submissions_csv_path,
+            submissions_backup_path,
+            truncate=args.truncate,
+            ocr_mode=args.ocr_mode,
+            incoming=converter.convert(to_convert),
+            deferred=converter.pending_pdf_names(to_convert),
+        )
+        if converter.failures:
             print("Please ensure all files are either PDF or DOCX format")
-            sys.exit(1)
-        
-        # Launch create_images in the background using a thread
-        loop = asyncio.get_running_loop()
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            print("Starting create_images...")
-            image_future = loop.run_in_executor(pool, create_images, args.submissions_folder, img_dir)
-
-            print("Converting submissions to Markdown...")
-            #TODO: Figure out how to track costs of document intelligence
-            submissions = await process_all_documents(
-                args.submissions_folder,
-                submissions_csv_path,
-                submissions_backup_path,
-                truncate=args.truncate,
-            )
-           
-            if submissions.empty:
-                print(f"No valid documents found in {args.submissions_folder}")
-                sys.exit(1)
 
-            await image_future  # Wait for image generation to complete
+        if submissions.empty:
+            print(f"No valid documents found in {args.submissions_folder}")
+            sys.exit(1)
     else:
         print("Using existing submissions_markdown.csv...")
-        submissions = pd.read_csv(submissions_csv_path)
+        submissions = load_submissions_markdown(submissions_csv_path, args.submissions_folder)
       
     
     #1a. Get the assignment's questions. 
@@ -190,7 +236,8 @@ async def main():
         else:
             print("Casting blank assignment to markdown")
             raw_assignment = await process_single_document(args.blank_assignment,
-                                                           blank_assignment_md_path)
+                                                           blank_assignment_md_path,
+                                                           ocr_mode=args.ocr_mode)
 
     else :
         print(f"Using existing blank assignment markdown from {blank_assignment_md_path}...")
@@ -229,7 +276,10 @@ async def main():
             output_csv=question_page_mapping_path, 
             model=model, 
             backup_dir=backup_folder,
-            token_tracker=token_tracker
+            token_tracker=token_tracker,
+            mapping_mode=args.page_mapping_mode,
+            embedding_provider=args.embedding_provider,
+            layouts=load_layout_indexes(submissions_csv_path)
         )
     else:
         print(f"Using existing question-page mapping from {question_page_mapping_path}...")
@@ -291,7 +341,7 @@ async def main():
                 print(f"Rubric file {args.rubric} cannot be found.")
                 sys.exit(1)
             else:
-                rubric_md = await process_single_document(args.rubric)
+                rubric_md = await process_single_document(args.rubric, ocr_mode=args.ocr_mode)
                 print("Expanding given rubric...")
                 rubric_df = await expand_rubric(rubric_md, 
                                                 questions, 
@@ -310,77 +360,134 @@ async def main():
         print(f"Using existing rubric CSV from {rubric_csv_path}...")
         rubric_df = pd.read_csv(rubric_csv_path)
 
-    # 5. Perform the grading
-    print("Grading assignments...")  
-    # initial, full-feedback pass (keeps the long JSON etc.)
-    results_df = await grade_questions(
-        submission_by_question,
-        questions,
-        rubric_df,
-        client,
-        model=model,
-        page_mapping=with_page_numbers,
-        img_dir=img_dir,
-        token_tracker=token_tracker
-    )
-    results_df.to_csv(args.output_csv, index=False)
-    token_tracker.print_grand_total()
-    # add four "grade-only" passes, each in its own column
-    for i in range(1, 3):
-        results_df = await grade_questions_simple(
+    # Page images are rendered lazily from the PDFs, only for pages that grading asks for
+    page_images = PageImageProvider(args.submissions_folder, truncate=args.truncate)
+    try:
+        # 5. Perform the grading
+        print("Grading assignments...")  
+        # initial, full-feedback pass (keeps the long JSON etc.)
+        batched = args.grading_batch_size > 1
+        if args.batch_api:
+            # One set of batch jobs covers the full pass and the quick grade samples
+            results_df = await grade_questions_offline(
+                submission_by_question,
+                questions,
+                rubric_df,
+                batch_client(client),
+                state_path=os.path.join(backup_folder, "grading_batches.json"),
+                model=config.models.batch_model or model,
+                page_mapping=with_page_numbers,
+                token_tracker=token_tracker,
+                page_images=page_images,
+                quick_samples=args.quick_grade_samples
+            )
+            token_tracker.print_grand_total()
+        else:
+            if batched:
+                results_df = await grade_questions_batched(
+                    submission_by_question,
+                    questions,
+                    rubric_df,
+                    client,
+                    model=model,
+                    page_mapping=with_page_numbers,
+                    token_tracker=token_tracker,
+                    page_images=page_images,
+                    batch_size=args.grading_batch_size
+                )
+            else:
+                results_df = await grade_questions(
+                    submission_by_question,
+                    questions,
+                    rubric_df,
+                    client,
+                    model=model,
+                    page_mapping=with_page_numbers,
+                    token_tracker=token_tracker,
+                    page_images=page_images
+                )
+            results_df.to_csv(args.output_csv, index=False)
+            token_tracker.print_grand_total()
+            # k independent "grade-only" samples per answer (grade_1..grade_k) plus their agreement, in one sweep
+            if batched:
+                # Multi-answer requests can't carry n choices; their passes run concurrently instead
+                await asyncio.gather(*(
+                    grade_questions_simple_batched(
+                        results_df,
+                        client,
+                        n=i,
+                        model=model,
+                        bar_desc=f"Quick grade pass {i}",
+                        token_tracker=token_tracker,
+                        batch_size=args.grading_batch_size
+                    )
+                    for i in range(1, args.quick_grade_samples + 1)
+                ))
+                add_agreement_stats(results_df, args.quick_grade_samples)
+            else:
+                results_df = await grade_questions_multi_sample(
+                    results_df,
+                    client,
+                    k=args.quick_grade_samples,
+                    model=model,
+                    token_tracker=token_tracker
+                )
+            if batched and config.processing.grading_consistency_sample > 0 and not results_df.empty:
+                await check_batch_consistency(
+                    results_df,
+                    client,
+                    model=model,
+                    batch_size=args.grading_batch_size,
+                    token_tracker=token_tracker
+                )
+
+        if results_df.empty:
+            print("No grading results were returned. Check your grader logic.")
+            sys.exit(1)
+
+        # 6. Save results to the specified CSV
+        results_df.to_csv(args.output_csv, index=False)
+        print(f"Grading complete! Results saved to {args.output_csv}")
+        #results_df = pd.read_csv("/Users/cai529/Github/autograder_dpi681/trials/assignment_2/grades.csv")
+        # 7. Generate higher level feedback
+        print("Generating 'AI TF' feedback...")
+        overall_feedback = await generate_subquestion_feedback(
             results_df,
             client,
-            n=i,
             model=model,
-            bar_desc=f"Quick grade pass {i}", 
             token_tracker=token_tracker
         )
+        # Save feedback to input_dir's parent folder
+        feedback_output_path = os.path.join(input_dir_parent, "feedback.csv")
 
-    if results_df.empty:
-        print("No grading results were returned. Check your grader logic.")
-        sys.exit(1)
-
-    # 6. Save results to the specified CSV
-    results_df.to_csv(args.output_csv, index=False)
-    print(f"Grading complete! Results saved to {args.output_csv}")
-    #results_df = pd.read_csv("/Users/cai529/Github/autograder_dpi681/trials/assignment_2/grades.csv")
-    # 7. Generate higher level feedback
-    print("Generating 'AI TF' feedback...")
-    overall_feedback = await generate_subquestion_feedback(
-        results_df,
-        client,
-        model=model,
-        token_tracker=token_tracker
-    )
-    # Save feedback to input_dir's parent folder
-    feedback_output_path = os.path.join(input_dir_parent, "feedback.csv")
-
-    # Join in ids to map back to students
-    parts = submissions['original_file_name'].str.split('_', n=4, expand=True)
-    parts.columns = ['p0','p1','p2','p3','rest']  # rest = everything after the 3rd underscore
+        # Join in ids to map back to students
+        parts = submissions['original_file_name'].str.split('_', n=4, expand=True)
+        parts.columns = ['p0','p1','p2','p3','rest']  # rest = everything after the 3rd underscore
 
-    # 2) derive fields with/without LATE
-    is_late = parts['p1'].eq('LATE')
+        # 2) derive fields with/without LATE
+        is_late = parts['p1'].eq('LATE')
 
-    submissions['username']   = parts['p0']
-    submissions['late']       = is_late
+        submissions['username']   = parts['p0']
+        submissions['late']       = is_late
 
-    # if LATE present: canvas_id=p2, student_id=p3 ; else: canvas_id=p1, student_id=p2
-    submissions['canvas_id']  = np.where(is_late, parts['p2'], parts['p1'])
-    submissions['student_id'] = np.where(is_late, parts['p3'], parts['p2'])
+        # if LATE present: canvas_id=p2, student_id=p3 ; else: canvas_id=p1, student_id=p2
+        submissions['canvas_id']  = np.where(is_late, parts['p2'], parts['p1'])
+        submissions['student_id'] = np.where(is_late, parts['p3'], parts['p2'])
 
-    # 3) coerce IDs to nullable integers (keeps NaN if something doesn't match)
-    submissions['canvas_id']  = pd.to_numeric(submissions['canvas_id'], errors='coerce').astype('Int64')
-    submissions['student_id'] = pd.to_numeric(submissions['student_id'], errors='coerce').astype('Int64')
+        # 3) coerce IDs to nullable integers (keeps NaN if something doesn't match)
+        submissions['canvas_id']  = pd.to_numeric(submissions['canvas_id'], errors='coerce').astype('Int64')
+        submissions['student_id'] = pd.to_numeric(submissions['student_id'], errors='coerce').astype('Int64')
     
-    id_map = submissions[['submission_id', 'original_file_name', 'username', 'late', 'canvas_id', 'student_id']]
+        id_map = submissions[['submission_id', 'original_file_name', 'username', 'late', 'canvas_id', 'student_id']]
 
-    final_output = pd.merge(id_map, overall_feedback, on='submission_id', how='left')
-    print(f"Feedback saved to {feedback_output_path}")
-    final_output.to_csv(feedback_output_path, index=False)
+        final_output = pd.merge(id_map, overall_feedback, on='submission_id', how='left')
+        print(f"Feedback saved to {feedback_output_path}")
+        final_output.to_csv(feedback_output_path, index=False)
 
-    # Print the grand total tokens at the end
-    token_tracker.print_grand_total()
+        # Print the grand total tokens at the end
+        token_tracker.print_grand_total()
+    finally:
+        page_images.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+"""
+Client side of the (Azure) OpenAI Batch API.
+
+Chat requests are written as JSONL, one {"custom_id", "method", "url",
+"body"} object per line, uploaded as a file and submitted as a batch job.
+The service works through the job asynchronously (within its 24 hour
+completion window), outside the per-minute limits of the chat endpoint.
+run_batch splits a large request set over several input files, polls the
+jobs, downloads their output and returns the response bodies by custom_id.
+
+Submitted jobs are recorded in a JSON state file, keyed by a hash of each
+input file. A restarted run that builds the same requests resumes polling
+the jobs it already submitted instead of submitting (and paying for) them
+again. The output of a completed job is kept next to the state file, so it
+is read from disk on the next run. A job that expires keeps what it finished
+inside the window, and the requests it left unfinished are submitted again
+as a new job.
+
+Any server that implements the files and batches endpoints can stand in for
+the service: set AUTOGRADER_BATCH_BASE_URL (and optionally
+AUTOGRADER_BATCH_API_KEY) and batch_client returns a plain OpenAI client
+pointed at it.
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+from tqdm import tqdm
+
+from config import config
+
+FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_client(default_client=None, base_url: Optional[str] = config.processing.batch_base_url):
+    """
+    Client to submit batch jobs with: one for the stand-in server at
+    `base_url` when set, otherwise `default_client` (or a new Azure client).
+    """
+    if base_url:
+        return AsyncOpenAI(base_url=base_url, api_key=os.getenv("AUTOGRADER_BATCH_API_KEY", "local"))
+    if default_client is not None:
+        return default_client
+    return AsyncAzureOpenAI(
+        azure_endpoint=config.azure.endpoint_gpt,
+        api_key=config.azure.api_key_gpt,
+        api_version=config.azure.api_version
+    )
+
+
+def chat_endpoint(client) -> str:
+    """Batch endpoint (and request url) for chat completions on `client`."""
+    # Azure omits the /v1 prefix
+    return "/chat/completions" if isinstance(client, AsyncAzureOpenAI) else "/v1/chat/completions"
+
+
+def _chunk(lines: List[str], max_requests: int, max_bytes: int) -> List[List[str]]:
+    chunks, current, size = [], [], 0
+    for line in lines:
+        line_bytes = len(line.encode("utf-8")) + 1
+        if current and (len(current) >= max_requests or size + line_bytes > max_bytes):
+            chunks.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += line_bytes
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _atomic_write(path: str, data: bytes):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class BatchState:
+    """Submitted batch jobs by input-file hash, persisted as JSON at `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f).get("jobs", {})
+
+    def output_path(self, key: str) -> str:
+        return f"{os.path.splitext(self.path)[0]}.{key}.output.jsonl"
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        _atomic_write(self.path, json.dumps({"jobs": self.jobs}, indent=2).encode("utf-8"))
+
+
+async def _download(client, batch) -> bytes:
+    """Output and error lines of a finished batch, concatenated."""
+    data = b""
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            content = (await client.files.content(file_id)).content
+            if content and not content.endswith(b"\n"):
+                content += b"\n"
+            data += content
+    return data
+
+
+async def _run_chunk(client, lines: List[str], endpoint: str, state: BatchState, description: str,
+                     poll_seconds: float, progress: tqdm,
+                     resubmits: int = config.processing.batch_max_resubmits) -> bytes:
+    """
+    Submit (or resume) the job for one input file and return its output lines.
+    Requests an expired job left unfinished are run as a new job, up to
+    `resubmits` times.
+    """
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+    key = hashlib.sha256(payload).hexdigest()[:16]
+    output_path = state.output_path(key)
+    if os.path.exists(output_path):
+        progress.update(len(lines))
+        with open(output_path, "rb") as f:
+            return f.read()
+
+    job = state.jobs.get(key)
+    if job is None or job["status"] in ("failed", "cancelled"):
+        file = await client.files.create(file=(f"{description}-{key}.jsonl", payload), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=file.id,
+            endpoint=endpoint,
+            completion_window=config.processing.batch_completion_window,
+            metadata={"description": description},
+        )
+        job = state.jobs[key] = {
+            "batch_id": batch.id,
+            "input_file_id": file.id,
+            "requests": len(lines),
+            "status": batch.status,
+        }
+        state.save()
+    else:
+        print(f"Resuming batch job {job['batch_id']} ({job['requests']} requests)")
+
+    done = 0
+    while True:
+        batch = await client.batches.retrieve(job["batch_id"])
+        if batch.status != job["status"]:
+            job["status"] = batch.status
+            state.save()
+        counts = batch.request_counts
+        finished = (counts.completed + counts.failed) if counts else 0
+        if finished > done:
+            progress.update(finished - done)
+            done = finished
+        if batch.status in FINISHED_STATES:
+            break
+        await asyncio.sleep(poll_seconds)
+
+    progress.update(len(lines) - done)
+    if batch.status in ("failed", "cancelled"):
+        errors = getattr(batch.errors, "data", None) or []
+        detail = "; ".join(str(e.message) for e in errors[:3])
+        raise RuntimeError(f"Batch job {batch.id} {batch.status}{': ' + detail if detail else ''}")
+
+    data = await _download(client, batch)
+    if batch.status == "completed":
+        _atomic_write(output_path, data)
+        return data
+
+    # Expired: keep whatever finished inside the window and run the rest again
+    answered = {json.loads(line)["custom_id"] for line in data.decode("utf-8").splitlines() if line.strip()}
+    unfinished = [line for line in lines if json.loads(line)["custom_id"] not in answered]
+    if not unfinished:
+        return data
+    if resubmits <= 0:
+        print(f"Batch job {batch.id} expired with {len(unfinished)} of {len(lines)} requests unfinished")
+        return data
+    print(f"Batch job {batch.id} expired; resubmitting {len(unfinished)} unfinished requests")
+    progress.total += len(unfinished)
+    progress.refresh()
+    return data + await _run_chunk(
+        client, unfinished, endpoint, state, description, poll_seconds, progress, resubmits - 1
+    )
+
+
+async def run_batch(
+    client,
+    requests: List[Tuple[str, dict]],
+    state_path: str,
+    description: str = "batch",
+    poll_seconds: float = config.processing.batch_poll_seconds,
+    max_requests: int = config.processing.batch_max_requests,
+    max_bytes: int = config.processing.batch_max_file_bytes
+) -> Dict[str, dict]:
+    """
+    Run chat completion requests through the Batch API.
+
+    Args:
+        client: AsyncAzureOpenAI or AsyncOpenAI client (see batch_client).
+        requests (List[Tuple[str, dict]]): (custom_id, request body) pairs; bodies are
+            chat.completions.create arguments ({"model", "messages", ...}).
+        state_path (str): JSON file recording submitted jobs, for resuming.
+        description (str): Label for the progress bar and job metadata.
+        poll_seconds (float): Delay between job status checks.
+        max_requests (int): Requests per input file.
+        max_bytes (int): Size limit of an input file.
+
+    Returns:
+        Dict[str, dict]: Response body (a chat completion) by custom_id. Requests that
+        failed, or did not finish in the completion window of any resubmitted job,
+        are missing.
+    """
+    endpoint = chat_endpoint(client)
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}, ensure_ascii=False)
+        for custom_id, body in requests
+    ]
+    state = BatchState(state_path)
+    with tqdm(total=len(lines), desc=f"{description} (batch)") as progress:
+        outputs = await asyncio.gather(*(
+            _run_chunk(client, chunk, endpoint, state, description, poll_seconds, progress)
+            for chunk in _chunk(lines, max_requests, max_bytes)
+        ))
+
+    results: Dict[str, dict] = {}
+    errors = []
+    for data in outputs:
+        for line in data.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200 and response.get("body"):
+                results[record["custom_id"]] = response["body"]
+            else:
+                errors.append((record.get("custom_id"), record.get("error") or response.get("body")))
+    missing = len(requests) - len(results)
+    if missing:
+        print(f"{description}: {missing} of {len(requests)} batch requests returned no result")
+        if errors:
+            print(f"  first error ({errors[0][0]}): {errors[0][1]}")
+    return results
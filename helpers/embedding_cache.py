@@ -0,0 +1,166 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import config
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of text embeddings, keyed by model and text hash.
+
+    Question text and context are identical for every submission, and reruns
+    on the same corpus embed exactly the same pages, so each (model, text)
+    pair only ever needs to be embedded once. Vectors are stored as float32
+    blobs in one SQLite database (WAL mode, so several processes can share
+    it). Least-recently-used rows are evicted once the vectors outgrow
+    max_bytes; the last-used time of hits is written in bulk.
+    """
+
+    QUERY_CHUNK = 500  # keys per SELECT (SQLite limits bound parameters)
+    TOUCH_BATCH = 1000  # hits buffered before their last_used is written
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.path = os.path.join(cache_dir or config.cache.cache_dir, "embeddings.sqlite3")
+        self.max_bytes = max_bytes if max_bytes is not None else config.cache.embedding_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._size = None  # bytes of stored vectors, computed lazily
+        self._touched = set()  # hits whose last_used is not written yet
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """Build the cache key for embedding `text` with `model`."""
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; a crash only loses recent rows
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """Return the cached embedding for `key`, or None on a miss."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Return the cached embeddings among `keys` (misses are left out).
+
+        Reads only; hits are marked as recently used in bulk by the next
+        put_many or flush, instead of one write per hit.
+        """
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(unique), self.QUERY_CHUNK):
+                chunk = unique[start:start + self.QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for key, vector in conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ):
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+            self._touched.update(found)
+            flush = len(self._touched) >= self.TOUCH_BATCH
+        self.hits += len(found)
+        self.misses += len(unique) - len(found)
+        if flush:
+            self.flush()
+        return found
+
+    def flush(self):
+        """Write the last_used time of every hit since the last flush, in one transaction."""
+        with self._lock:
+            if not self._touched:
+                return
+            self._touch(self._connect())
+            self._connect().commit()
+
+    def _touch(self, conn: sqlite3.Connection):
+        now = time.time()
+        conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", ((now, key) for key in self._touched))
+        self._touched.clear()
+
+    def put_many(self, items: Dict[str, List[float]]):
+        """Store several embeddings at once, evicting old rows if the cache is over budget."""
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            conn = self._connect()
+            # Rows being replaced no longer count towards the size
+            replaced = self._stored_bytes(conn, list(items)) if self._size is not None else 0
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._touch(conn)
+            conn.commit()
+            if self._size is None:
+                self._size = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+            else:
+                self._size += sum(len(vector) for _, vector, _ in rows) - replaced
+            if self._size > self.max_bytes:
+                self._evict(conn)
+
+    def _stored_bytes(self, conn: sqlite3.Connection, keys: List[str]) -> int:
+        """Total size of the vectors already stored under `keys`."""
+        total = 0
+        for start in range(0, len(keys), self.QUERY_CHUNK):
+            chunk = keys[start:start + self.QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            total += conn.execute(
+                f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE key IN ({placeholders})", chunk
+            ).fetchone()[0]
+        return total
+
+    def _evict(self, conn: sqlite3.Connection, target_fraction: float = 0.9):
+        """Delete least-recently-used rows until the vectors fit in target_fraction * max_bytes."""
+        size = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        target = self.max_bytes * target_fraction
+        stale = []
+        for key, length in conn.execute(
+            "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used"
+        ):
+            if size <= target:
+                break
+            stale.append((key,))
+            size -= length
+        conn.executemany("DELETE FROM embeddings WHERE key = ?", stale)
+        conn.commit()
+        self.evictions += len(stale)
+        self._size = size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print(f"Embedding cache: {s['hits']} hits, {s['misses']} misses "
+              f"({s['hit_rate']:.0%} hit rate), {s['evictions']} evictions [{self.path}]")
+
+# Singleton instance
+embedding_cache = EmbeddingCache()
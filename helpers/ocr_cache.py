@@ -0,0 +1,129 @@
+import os
+import json
+import uuid
+import hashlib
+from typing import Iterable, Optional
+
+from config import config
+
+
+class OCRCache:
+    """
+    Persistent, content-addressed cache for Document Intelligence output.
+
+    Entries are keyed by the SHA-256 of the file bytes plus everything that
+    changes the result (truncated pages, model id, output format), so the same
+    bytes are only ever analyzed once, whatever the file is called or which
+    course/backup folder it came from. Entries are plain files written
+    atomically, so several processes can share one cache directory.
+    Least-recently-used entries are evicted once the cache outgrows max_bytes.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = os.path.join(cache_dir or config.cache.cache_dir, "ocr")
+        self.max_bytes = max_bytes if max_bytes is not None else config.cache.ocr_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None  # bytes on disk, computed lazily
+
+    @staticmethod
+    def make_key(
+        data: bytes,
+        truncate: Optional[Iterable[int]] = None,
+        model_id: str = "prebuilt-layout",
+        output_format: str = "markdown",
+    ) -> str:
+        """Build the cache key for a document's bytes and analysis settings."""
+        descriptor = json.dumps({
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "truncate": sorted(set(truncate or [])),
+            "model_id": model_id,
+            "output_format": output_format,
+        }, sort_keys=True)
+        return hashlib.sha256(descriptor.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.cache")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached text for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        """Store `value` under `key`, evicting old entries if the cache is over budget."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        try:
+            replaced = os.path.getsize(path)  # an entry being overwritten no longer counts
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(path) - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        """Yield (mtime, size, path) for every cache entry."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".cache"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # removed by another process
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self, target_fraction: float = 0.9):
+        """Delete least-recently-used entries until the cache is under target_fraction * max_bytes."""
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_bytes * target_fraction
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print(f"OCR cache: {s['hits']} hits, {s['misses']} misses "
+              f"({s['hit_rate']:.0%} hit rate), {s['evictions']} evictions [{self.cache_dir}]")
+
+# Singleton instance
+ocr_cache = OCRCache()
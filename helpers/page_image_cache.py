@@ -0,0 +1,160 @@
+import os
+import base64
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from config import config
+
+
+@dataclass
+class EncodedImage:
+    """An image ready to attach to a chat request."""
+    url: str              # base64 data URL
+    width: int = 0        # final pixel size (0 if unknown)
+    height: int = 0
+    detail: str = "auto"  # image_url detail level the image was prepared for
+    tokens: int = 0       # estimated vision tokens (0 if unknown)
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def to_data_url(image: bytes, mime_type: str = "image/png") -> str:
+    """Base64-encode image bytes as a data URL for a chat image_url part."""
+    return f"data:{mime_type};base64,{base64.b64encode(image).decode('ascii')}"
+
+
+def encode_png(image: bytes) -> EncodedImage:
+    """Wrap PNG bytes as they are, without any preparation."""
+    return EncodedImage(url=to_data_url(image))
+
+
+class PageImageCache:
+    """
+    In-memory cache of encoded page images (data URLs) for grading requests.
+
+    A page mapped to several questions is attached to every one of their
+    requests; it is read, prepared and base64-encoded once and the result is
+    reused. Files are keyed by path and modification time, so a re-rendered
+    image is picked up, and rendered pages by PageImageProvider.cache_key;
+    `variant` distinguishes different preparations of the same image.
+    Reading and encoding run on a worker thread, and concurrent requests for
+    the same image share one load. Least-recently-used entries are dropped
+    once the data URLs outgrow max_bytes.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes if max_bytes is not None else config.processing.page_image_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, EncodedImage]" = OrderedDict()
+        self._size = 0
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    async def get(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[Optional[bytes]]],
+        encode: Callable[[bytes], EncodedImage] = encode_png,
+    ) -> Optional[EncodedImage]:
+        """
+        Return the image cached under `key`, or await `load()` for the image
+        bytes, run `encode` on them off the event loop and cache the result.
+        None if the image does not exist.
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = self._inflight[key] = asyncio.ensure_future(self._load(key, load, encode))
+        return await asyncio.shield(future)
+
+    async def _load(self, key, load, encode) -> Optional[EncodedImage]:
+        try:
+            data = await load()
+            if data is None:
+                return None
+            image = await asyncio.to_thread(encode, data)
+            self._remember(key, image)
+            return image
+        finally:
+            self._inflight.pop(key, None)
+
+    async def file_image(
+        self,
+        path: str,
+        encode: Callable[[bytes], EncodedImage] = encode_png,
+        variant: Hashable = (),
+    ) -> Optional[EncodedImage]:
+        """An image file on disk, encoded with `encode`, or None if it does not exist."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        return await self.get(("file", path, mtime, variant), lambda: asyncio.to_thread(_read_file, path), encode)
+
+    async def page_image(
+        self,
+        page_images,
+        original_file_name: str,
+        page_num: int,
+        encode: Callable[[bytes], EncodedImage] = encode_png,
+        variant: Hashable = (),
+    ) -> Optional[EncodedImage]:
+        """A page rendered by a PageImageProvider, encoded with `encode`, or None if it does not exist."""
+        key = page_images.cache_key(original_file_name, page_num)
+        if key is None:
+            return None
+        return await self.get(
+            ("page",) + key + (variant,), lambda: page_images.get_page(original_file_name, page_num), encode
+        )
+
+    def _remember(self, key: Hashable, image: EncodedImage):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = image
+            self._size += len(image.url)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._size -= len(old.url)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print(f"Page image cache: {s['hits']} hits, {s['misses']} misses "
+              f"({s['hit_rate']:.0%} hit rate), {s['evictions']} evictions, "
+              f"{s['entries']} images in {s['bytes'] / 1024 ** 2:.1f} MiB")
+
+# Singleton instance
+page_image_cache = PageImageCache()
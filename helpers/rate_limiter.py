@@ -0,0 +1,236 @@
+"""
+Adaptive rate limiting for chat completion requests.
+
+The static limits in RateLimits are only a starting point; the deployment's
+real quota is read back from every response:
+
+- Two token buckets, requests and tokens per minute, pace requests. Their
+  capacities follow the x-ratelimit-limit-* headers when the service sends
+  them, or grow to the x-ratelimit-remaining-* values when those show more
+  room than assumed. The remaining counts also pull the buckets down when the
+  service has less quota left than the local estimate (other clients share it).
+- Concurrency is controlled AIMD-style: every `concurrency` successful
+  responses in a row raise the window of requests in flight by one, and a 429
+  halves it.
+- A 429 pauses every request until its retry-after (or retry-after-ms) has
+  passed, or for an exponential backoff when the header is missing; the
+  request is then retried, up to max_retries times.
+- A request estimated at more tokens than the bucket holds is not rejected:
+  it waits for a full bucket and then overdraws it, so the following requests
+  wait until the debt is repaid.
+
+The OpenAI client's own retries are disabled for requests sent through the
+limiter, so every 429 reaches it.
+"""
+
+import re
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from openai import RateLimitError
+
+from config import config
+
+
+class _Bucket:
+    """Continuously refilled token bucket; `level` may go negative (debt)."""
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.period = period
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / self.period)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` (at most a full bucket) is available."""
+        self.refill()
+        need = min(amount, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) * self.period / self.capacity
+
+    def observe(self, limit: Optional[float], remaining: Optional[float]):
+        """Correct capacity and level from the service's limit/remaining headers."""
+        self.refill()
+        capacity = limit if limit else (remaining if remaining and remaining > self.capacity else None)
+        if capacity:
+            if capacity > self.capacity:
+                # Room that was not assumed before is available now
+                self.level += capacity - self.capacity
+            else:
+                self.level = min(self.level, capacity)
+            self.capacity = float(capacity)
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers is not None else None
+    match = re.match(r"\s*([\d.]+)", value or "")
+    return float(match.group(1)) if match else None
+
+
+def retry_after(headers) -> Optional[float]:
+    """Seconds to wait according to retry-after-ms / retry-after, if given."""
+    ms = _header_number(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000
+    return _header_number(headers, "retry-after")
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared limiter for chat completion requests (see the module docstring).
+    Use the `rate_limiter` singleton so every caller draws on one quota.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = config.rate_limits.requests_per_minute,
+        tokens_per_minute: int = config.rate_limits.tokens_per_minute,
+        initial_concurrency: int = config.rate_limits.initial_concurrency,
+        max_concurrency: int = config.rate_limits.max_concurrency,
+        max_retries: int = config.rate_limits.max_retries
+    ):
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self.concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.remaining_requests: Optional[float] = None
+        self.remaining_tokens: Optional[float] = None
+        self.sent = 0
+        self.throttled = 0
+        self._successes = 0
+        self._slots: Optional[asyncio.Condition] = None
+        self._pacing: Optional[asyncio.Lock] = None
+
+    def _primitives(self):
+        # Created lazily so the limiter binds to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Condition()
+            self._pacing = asyncio.Lock()
+        return self._slots, self._pacing
+
+    async def _acquire(self, tokens: int):
+        slots, pacing = self._primitives()
+        async with slots:
+            await slots.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+        try:
+            # One waiter at a time, so requests go out in arrival order
+            async with pacing:
+                while True:
+                    delay = max(
+                        self.cooldown_until - time.monotonic(),
+                        self.requests.wait_time(1),
+                        self.tokens.wait_time(tokens),
+                    )
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+        except BaseException:
+            await self._release()
+            raise
+
+    async def _release(self):
+        slots, _ = self._primitives()
+        async with slots:
+            self.in_flight -= 1
+            slots.notify_all()
+
+    def _observe(self, headers):
+        if headers is None:
+            return
+        self.remaining_requests = _header_number(headers, "x-ratelimit-remaining-requests")
+        self.remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+        self.requests.observe(_header_number(headers, "x-ratelimit-limit-requests"), self.remaining_requests)
+        self.tokens.observe(_header_number(headers, "x-ratelimit-limit-tokens"), self.remaining_tokens)
+
+    def _on_success(self):
+        self._successes += 1
+        if self._successes >= self.concurrency:
+            self._successes = 0
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def _on_throttled(self, headers, attempt: int):
+        self.throttled += 1
+        self._successes = 0
+        self.concurrency = max(1, self.concurrency // 2)
+        wait = retry_after(headers)
+        if wait is None:
+            wait = min(60.0, 2.0 ** attempt)
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + wait)
+        # Start again from empty buckets rather than a burst
+        self.requests.level = min(self.requests.level, 0.0)
+        self.tokens.level = min(self.tokens.level, 0.0)
+
+    async def run(self, request: Callable[[], Awaitable], tokens: int):
+        """
+        Await `request()` under the limits, retrying on 429. If it returns a
+        raw response (``with_raw_response``), its rate-limit headers are
+        read and the parsed response is returned.
+
+        Args:
+            request: Zero-argument coroutine function sending one request.
+            tokens (int): Estimated input tokens of the request.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(tokens)
+            try:
+                self.sent += 1
+                response = await request()
+            except RateLimitError as e:
+                self._on_throttled(getattr(e.response, "headers", None), attempt)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            finally:
+                await self._release()
+            headers = getattr(response, "headers", None)
+            self._observe(headers)
+            self._on_success()
+            return response.parse() if headers is not None and hasattr(response, "parse") else response
+
+    async def chat(self, openai_client, tokens: int, **kwargs):
+        """openai_client.chat.completions.create(**kwargs) under the limits."""
+        client = openai_client.with_options(max_retries=0)
+        return await self.run(lambda: client.chat.completions.with_raw_response.create(**kwargs), tokens)
+
+    async def parse(self, openai_client, tokens: int, **kwargs):
+        """openai_client.beta.chat.completions.parse(**kwargs) under the limits."""
+        client = openai_client.with_options(max_retries=0)
+        return await self.run(lambda: client.beta.chat.completions.with_raw_response.parse(**kwargs), tokens)
+
+    def metrics(self) -> dict:
+        """Current limits, usage and throttling counts."""
+        self.requests.refill()
+        self.tokens.refill()
+        return {
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "requests_available": self.requests.level,
+            "tokens_available": self.tokens.level,
+            "server_remaining_requests": self.remaining_requests,
+            "server_remaining_tokens": self.remaining_tokens,
+            "requests_sent": self.sent,
+            "throttled": self.throttled,
+        }
+
+    def print_metrics(self):
+        m = self.metrics()
+        print(f"Rate limits: {m['requests_per_minute']:.0f} requests/min, {m['tokens_per_minute']:.0f} tokens/min, "
+              f"concurrency {m['concurrency']}; {m['requests_sent']} requests sent, {m['throttled']} throttled (429)")
+
+# Singleton instance
+rate_limiter = AdaptiveRateLimiter()
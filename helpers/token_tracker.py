@@ -1,37 +1,70 @@
 from collections import defaultdict
-import tiktoken 
+
+from helpers.tokenizer import get_tokenizer
 
 class TokenTracker:
     def __init__(self, encoding="o200k_base"):
-        self.tokenizer = tiktoken.get_encoding(encoding)
+        self.encoding = encoding
         self.process_totals = defaultdict(int)
         self.grand_total = 0
+        # Token counts reported by the API (prompt, cached prompt, completion) per process
+        self.usage_totals = defaultdict(lambda: defaultdict(int))
+
+    @property
+    def tokenizer(self):
+        # Resolved on first use so importing the tracker doesn't load an encoding
+        return get_tokenizer(self.encoding)
 
     def encode(self, text):
         """Encode text into tokens using the specified encoding."""
         return self.tokenizer.encode(text)
     
-    def count_tokens(self, text):
-        """Count the number of tokens in the given text."""
-        return len(self.encode(text))
+    def count_tokens(self, text, shared=False):
+        """Count the number of tokens in the given text (memoized if `shared`, i.e. repeated across calls)."""
+        return self.tokenizer.count(text, shared=shared)
 
     def add(self, process_name, value):
         """
         Add tokens to the tracker.
         If value is an int, treat as token count.
         If value is a str, count tokens in the string.
+        If value is a list/tuple of str (e.g. (system_prompt, user_prompt)), count
+        each part; every part but the last is taken to repeat across calls (like
+        the system prompt) and is only tokenized once.
         """
         if isinstance(value, int):
             tokens = value
         elif isinstance(value, str):
             tokens = self.count_tokens(value)
+        elif isinstance(value, (list, tuple)) and all(isinstance(part, str) for part in value):
+            tokens = sum(self.count_tokens(part, shared=i < len(value) - 1) for i, part in enumerate(value))
         else:
-            raise ValueError("add() expects an int (token count) or str (text to count tokens)")
+            raise ValueError("add() expects an int (token count), str or list of str (text to count tokens)")
         self.process_totals[process_name] += tokens
         self.grand_total += tokens
 
+    def add_usage(self, process_name, usage):
+        """
+        Record the `usage` of a chat completion response: prompt tokens, the
+        part of them served from the provider's prompt cache, and completion
+        tokens. Missing fields count as zero.
+        """
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        totals = self.usage_totals[process_name]
+        totals["requests"] += 1
+        totals["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+        totals["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+        totals["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
     def print_process(self, process_name):
         print(f"Total tokens for {process_name}: {self.process_totals[process_name]}")
+        usage = self.usage_totals.get(process_name)
+        if usage and usage["prompt_tokens"]:
+            print(f"  API usage for {process_name}: {usage['prompt_tokens']} prompt tokens "
+                  f"({usage['cached_tokens']} cached, {usage['cached_tokens'] / usage['prompt_tokens']:.0%}), "
+                  f"{usage['completion_tokens']} completion tokens over {usage['requests']} requests")
 
     def print_grand_total(self):
         print(f"GRAND TOTAL tokens for autograder run: {self.grand_total}")
@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+import tiktoken
+
+from config import config
+
+
+@lru_cache(maxsize=None)
+def _encoding(name: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(name)
+
+
+@lru_cache(maxsize=None)
+def _encoding_name_for_model(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return config.models.encoder_model
+
+
+class Tokenizer:
+    """
+    Shared token counting for one tiktoken encoding.
+
+    Encoders are built once per process. Counts of strings that recur on every
+    request (system prompts, question prefixes with their rubric and context)
+    are memoized in a bounded LRU keyed by the text when the caller marks them
+    as shared, so they are only encoded once; one-off text such as a student's
+    answer is never memoized and cannot crowd them out. Special-token
+    text is counted as ordinary text instead of raising. count_many spreads
+    large batches over a thread pool; tiktoken releases the GIL while encoding.
+
+    Use get_tokenizer() rather than constructing this directly.
+    """
+
+    def __init__(self, encoding_name: str, max_cached: int = config.processing.token_count_cache_size):
+        self.encoding = _encoding(encoding_name)
+        self.max_cached = max_cached
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode_ordinary(text)
+
+    def count(self, text: str, shared: bool = False) -> int:
+        """
+        Number of tokens in `text`.
+
+        Args:
+            text (str): Text to count.
+            shared (bool): `text` recurs across requests; memoize its count.
+        """
+        if not shared:
+            return len(self.encoding.encode_ordinary(text))
+        with self._lock:
+            n = self._counts.get(text)
+            if n is not None:
+                self._counts.move_to_end(text)
+                self.hits += 1
+                return n
+        n = len(self.encoding.encode_ordinary(text))
+        self._remember(text, n)
+        return n
+
+    def _remember(self, text: str, n: int):
+        with self._lock:
+            self.misses += 1
+            self._counts[text] = n
+            self._counts.move_to_end(text)
+            while len(self._counts) > self.max_cached:
+                self._counts.popitem(last=False)
+
+    def count_many(self, texts: Iterable[str]) -> List[int]:
+        """Token counts for one-off `texts` (not memoized), encoded on the thread pool."""
+        return [len(tokens) for tokens in _pool().map(self.encoding.encode_ordinary, list(texts))]
+
+    def truncate(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        """Return (`text` cut to at most `max_tokens` tokens, its token count)."""
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) > max_tokens:
+            return self.encoding.decode(tokens[:max_tokens]), max_tokens
+        return text, len(tokens)
+
+
+@lru_cache(maxsize=1)
+def _pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=config.processing.tokenizer_threads,
+        thread_name_prefix="tokenizer",
+    )
+
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(encoding_name: Optional[str] = None, model: Optional[str] = None) -> Tokenizer:
+    """
+    Return the shared Tokenizer for an encoding (default: config.models.encoder_model),
+    or for the encoding a model uses.
+    """
+    name = encoding_name or (_encoding_name_for_model(model) if model else config.models.encoder_model)
+    with _tokenizers_lock:
+        if name not in _tokenizers:
+            _tokenizers[name] = Tokenizer(name)
+        return _tokenizers[name]
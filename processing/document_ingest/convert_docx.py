@@ -0,0 +1,209 @@
+"""
+Parallel, cached DOCX to PDF conversion.
+
+Conversions run as headless LibreOffice processes, several at a time, each
+with its own user profile so the instances don't lock each other out. A
+manifest records the SHA-256 of every converted DOCX, so files whose PDF is
+already up to date are skipped on later runs. It is kept outside the
+submissions folder (in the run's backup folder, or the cache directory), so
+the students' files are the only thing in there besides the PDFs.
+
+Converted PDFs are yielded as soon as each one is ready, which lets
+ingestion start analyzing them while the rest are still converting. When
+LibreOffice isn't installed, docx2pdf (Word automation) is used one file at
+a time instead; it cannot read legacy .doc files, so those are reported as
+unconvertible up front.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import config
+
+DOCX_EXTENSIONS = {".docx", ".doc"}
+SOFFICE_ONLY_EXTENSIONS = {".doc"}  # docx2pdf only handles .docx
+MANIFEST_NAME = "docx2pdf_manifest.json"
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DocxConverter:
+    """
+    Convert the DOCX files in `folder` to PDFs next to them.
+
+    Args:
+        folder (str): Submissions folder.
+        manifest_dir (str, optional): Where the conversion manifest is kept
+            (default: the cache directory, one manifest per submissions folder).
+        max_workers (int, optional): LibreOffice processes run at once (default: one per core).
+        timeout (float): Seconds before a single conversion is abandoned.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        manifest_dir: Optional[str] = None,
+        max_workers: Optional[int] = config.processing.convert_workers,
+        timeout: float = config.processing.convert_timeout_seconds,
+    ):
+        self.folder = folder
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.soffice = shutil.which("soffice") or shutil.which("libreoffice")
+        if manifest_dir is None:
+            folder_id = hashlib.sha256(os.path.abspath(folder).encode("utf-8")).hexdigest()[:16]
+            manifest_dir = os.path.join(config.cache.cache_dir, "docx", folder_id)
+        self.manifest_path = os.path.join(manifest_dir, MANIFEST_NAME)
+        self.manifest: Dict[str, str] = self._load_manifest()
+        self.timings: Dict[str, float] = {}
+        self.failures: Dict[str, str] = {}
+
+    @staticmethod
+    def pdf_name(docx_name: str) -> str:
+        return Path(docx_name).stem + ".pdf"
+
+    def _load_manifest(self) -> Dict[str, str]:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def pending(self) -> List[str]:
+        """
+        DOCX files whose PDF is missing or was made from different bytes. Without
+        LibreOffice, .doc files are recorded in `failures` instead.
+        """
+        stale = []
+        unconvertible = []
+        for name in sorted(os.listdir(self.folder)):
+            suffix = Path(name).suffix.lower()
+            if suffix not in DOCX_EXTENSIONS or name.startswith("~$"):
+                continue
+            pdf_path = os.path.join(self.folder, self.pdf_name(name))
+            if os.path.isfile(pdf_path) and self.manifest.get(name) == _sha256(os.path.join(self.folder, name)):
+                continue
+            if not self.soffice and suffix in SOFFICE_ONLY_EXTENSIONS:
+                unconvertible.append(name)
+                continue
+            stale.append(name)
+        if unconvertible:
+            for name in unconvertible:
+                self.failures[name] = "converting .doc files requires LibreOffice"
+            print(f"LibreOffice not found; cannot convert {len(unconvertible)} .doc files: {', '.join(unconvertible)}")
+        return stale
+
+    def pending_pdf_names(self, docx_names: List[str]) -> set:
+        return {self.pdf_name(name) for name in docx_names}
+
+    async def _convert_soffice(self, docx_path: str, profile_dir: str):
+        process = await asyncio.create_subprocess_exec(
+            self.soffice,
+            f"-env:UserInstallation={Path(profile_dir).as_uri()}",
+            "--headless",
+            "--norestore",
+            "--convert-to", "pdf",
+            "--outdir", self.folder,
+            docx_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError(f"timed out after {self.timeout:.0f}s")
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode("utf-8", errors="replace").strip() or f"exit code {process.returncode}")
+
+    async def _convert_docx2pdf(self, docx_path: str):
+        from docx2pdf import convert
+        pdf_path = os.path.join(self.folder, self.pdf_name(os.path.basename(docx_path)))
+        await asyncio.to_thread(convert, docx_path, pdf_path)
+
+    async def convert(self, docx_names: Optional[List[str]] = None) -> AsyncIterator[str]:
+        """
+        Convert `docx_names` (default: everything pending) and yield each PDF's
+        file name as soon as it is written.
+        """
+        docx_names = self.pending() if docx_names is None else docx_names
+        if not docx_names:
+            return
+
+        workers = self.max_workers if self.soffice else 1
+        if not self.soffice:
+            print("LibreOffice not found; falling back to docx2pdf (one file at a time)")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for name in docx_names:
+            queue.put_nowait(name)
+        done: asyncio.Queue = asyncio.Queue()
+
+        async def worker():
+            # Each worker owns a LibreOffice profile so instances can run side by side
+            with tempfile.TemporaryDirectory(prefix="autograder_lo_") as profile_dir:
+                while True:
+                    try:
+                        name = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    docx_path = os.path.join(self.folder, name)
+                    started = time.monotonic()
+                    try:
+                        digest = await asyncio.to_thread(_sha256, docx_path)
+                        if self.soffice:
+                            await self._convert_soffice(docx_path, profile_dir)
+                        else:
+                            await self._convert_docx2pdf(docx_path)
+                        self.timings[name] = time.monotonic() - started
+                        self.manifest[name] = digest
+                        self._save_manifest()
+                        print(f"Converted {name} in {self.timings[name]:.1f}s")
+                        await done.put(self.pdf_name(name))
+                    except Exception as e:
+                        self.failures[name] = str(e)
+                        print(f"Error converting {name}: {e}")
+
+        async def run_workers():
+            try:
+                await asyncio.gather(*(worker() for _ in range(min(workers, len(docx_names)))))
+            finally:
+                await done.put(None)  # no more PDFs
+
+        runner = asyncio.create_task(run_workers())
+        try:
+            while (pdf_name := await done.get()) is not None:
+                yield pdf_name
+        finally:
+            runner.cancel()
+
+        self.print_summary()
+
+    def print_summary(self):
+        if not self.timings and not self.failures:
+            return
+        total = sum(self.timings.values())
+        print(f"Converted {len(self.timings)} DOCX files to PDF "
+              f"({total:.1f}s of conversion time, {len(self.failures)} failed)")
@@ -0,0 +1,215 @@
+"""
+Compact per-document layout index.
+
+Document Intelligence returns more than markdown: every page comes with its
+size and its text lines, each with a span into the content and a bounding
+polygon. The text layer of born-digital PDFs carries the same information.
+This module keeps that structure next to the markdown store, so pages are
+found by character offset instead of by re-splitting the text on
+``PageBreak``, and later stages can point at the exact region of a page.
+
+For each document the index records, relative to the stored markdown:
+
+- pages: the character offset and length of every page
+- lines: each line's offset and length, plus its polygon in page units
+  (inches for PDFs, pixels for images, points for text-layer pages)
+
+Line spans are re-anchored to the stored markdown rather than copied from the
+service response, because page-level OCR and text-layer pages are stitched
+into one document after analysis. Lines that do not appear verbatim in the
+markdown (e.g. re-flowed table cells) keep their polygon with offset -1.
+
+Page lookup for an answer is then an offset search: the answer's words are
+found in the document's word stream and the matched character span is mapped
+to pages by bisection.
+"""
+
+import os
+import re
+import json
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from config import config
+from processing.document_ingest.markdown_store import MarkdownStore, store_path_for
+from processing.document_ingest.text_layer import PAGE_BREAK_MARKER
+
+LAYOUT_VERSION = 1
+LAYOUT_COLUMNS = ["submission_id", "original_file_name", "layout"]
+
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def layout_store_path_for(markdown_dataframe: str) -> str:
+    """Path of the layout store that sits next to a submissions_markdown CSV."""
+    return os.path.splitext(store_path_for(markdown_dataframe))[0] + ".layout.jsonl"
+
+
+def _polygon(points) -> List[float]:
+    return [round(float(v), 3) for v in points or []]
+
+
+def di_page_layouts(result) -> List[Dict]:
+    """Per-page size and lines of a Document Intelligence AnalyzeResult, in page order."""
+    layouts = []
+    for page in result.pages or []:
+        layouts.append({
+            "width": page.width,
+            "height": page.height,
+            "unit": str(page.unit or ""),
+            "lines": [(line.content, _polygon(line.polygon)) for line in page.lines or []],
+        })
+    return layouts
+
+
+def page_offsets(markdown: str) -> List[List[int]]:
+    """[offset, length] of every page of `markdown`, with surrounding whitespace excluded."""
+    pages = []
+    start = 0
+    while True:
+        end = markdown.find(PAGE_BREAK_MARKER, start)
+        stop = len(markdown) if end == -1 else end
+        text = markdown[start:stop]
+        lead = len(text) - len(text.lstrip())
+        pages.append([start + lead, len(text.strip())])
+        if end == -1:
+            return pages
+        start = end + len(PAGE_BREAK_MARKER)
+
+
+def build_layout_index(markdown: str, page_layouts: Optional[List[Optional[Dict]]] = None) -> Dict:
+    """
+    Build the layout index of one document.
+
+    Args:
+        markdown (str): The document's final markdown (pages joined by PAGE_BREAK_MARKER).
+        page_layouts (List[Dict], optional): Per-page dicts from di_page_layouts or
+            text_layer.page_layout, in page order; None entries (or a short list)
+            leave those pages with offsets only.
+
+    Returns:
+        Dict: {"version", "pages": [{"offset", "length", "width", "height", "unit",
+        "lines": [[offset, length, polygon], ...]}]}.
+    """
+    page_layouts = page_layouts or []
+    pages = []
+    for number, (offset, length) in enumerate(page_offsets(markdown)):
+        page = {"offset": offset, "length": length}
+        layout = page_layouts[number] if number < len(page_layouts) else None
+        if layout:
+            page.update(width=layout["width"], height=layout["height"], unit=layout["unit"])
+            # Lines appear in reading order, so each one is searched for after the previous match
+            cursor, end = offset, offset + length
+            lines = []
+            for content, polygon in layout["lines"]:
+                found = markdown.find(content, cursor, end) if content else -1
+                if found == -1:
+                    lines.append([-1, 0, polygon])
+                else:
+                    lines.append([found, len(content), polygon])
+                    cursor = found + len(content)
+            page["lines"] = lines
+        pages.append(page)
+    return {"version": LAYOUT_VERSION, "pages": pages}
+
+
+@dataclass
+class LayoutMatch:
+    """Where a text was found in a document."""
+    pages: List[int]                     # 1-based page numbers covered by the span
+    start: int                           # character span in the markdown
+    end: int
+    regions: List[Dict] = field(default_factory=list)  # {"page", "polygon", "unit"} of overlapping lines
+
+
+class LayoutIndex:
+    """
+    Offset-based page lookup over one document.
+
+    Args:
+        markdown (str): The document's markdown, as stored.
+        layout (Dict, optional): Its layout index (see build_layout_index);
+            page offsets are recomputed from the markdown when omitted.
+    """
+
+    def __init__(self, markdown: str, layout: Optional[Dict] = None):
+        self.markdown = markdown
+        self.layout = layout or build_layout_index(markdown)
+        self.page_starts = [page["offset"] for page in self.layout["pages"]]
+
+        # Lowercase word stream, so the search ignores markdown, punctuation and whitespace
+        words = [(m.start(), m.end(), m.group().lower()) for m in _WORD_RE.finditer(markdown)]
+        self.word_spans = [(start, end) for start, end, _ in words]
+        self.word_starts = []
+        position = 1
+        for _, _, word in words:
+            self.word_starts.append(position)
+            position += len(word) + 1
+        self.stream = " " + " ".join(word for _, _, word in words) + " "
+
+    def page_at(self, offset: int) -> int:
+        """1-based page number holding character `offset`."""
+        return max(1, bisect_right(self.page_starts, offset))
+
+    def pages_for_span(self, start: int, end: int) -> List[int]:
+        """1-based page numbers overlapped by the character span [start, end)."""
+        return list(range(self.page_at(start), self.page_at(max(start, end - 1)) + 1))
+
+    def regions(self, start: int, end: int) -> List[Dict]:
+        """Polygons of the lines overlapping [start, end), with their page and unit."""
+        found = []
+        for number in self.pages_for_span(start, end):
+            page = self.layout["pages"][number - 1]
+            for offset, length, polygon in page.get("lines", []):
+                if offset != -1 and offset < end and offset + length > start:
+                    found.append({"page": number, "polygon": polygon, "unit": page.get("unit", "")})
+        return found
+
+    def find(self, text: str, min_words: int = config.processing.page_match_min_words) -> Optional[LayoutMatch]:
+        """
+        Find `text` by its word sequence. Returns None when it is shorter than
+        `min_words`, absent, or occurs on different pages (ambiguous).
+        """
+        words = [w.lower() for w in _WORD_RE.findall(str(text))]
+        if len(words) < min_words:
+            return None
+        needle = " " + " ".join(words) + " "
+        hit = self.stream.find(needle)
+        if hit == -1:
+            return None
+        match = self._match(hit, len(words))
+        again = self.stream.find(needle, hit + 1)
+        if again != -1 and self._match(again, len(words)).pages != match.pages:
+            return None
+        return match
+
+    def _match(self, hit: int, n_words: int) -> LayoutMatch:
+        first = bisect_right(self.word_starts, hit + 1) - 1
+        start, end = self.word_spans[first][0], self.word_spans[first + n_words - 1][1]
+        return LayoutMatch(pages=self.pages_for_span(start, end), start=start, end=end,
+                           regions=self.regions(start, end))
+
+
+def load_layout_indexes(markdown_dataframe: str) -> Dict[str, LayoutIndex]:
+    """
+    LayoutIndex per submission_id for a submissions_markdown CSV, built from its
+    markdown and layout stores. Documents without a stored layout get page
+    offsets only; an empty dict is returned if there is no markdown store.
+    """
+    markdown_path = store_path_for(markdown_dataframe)
+    if not os.path.exists(markdown_path):
+        return {}
+    layouts = {
+        record["original_file_name"]: record["layout"]
+        for record in MarkdownStore(layout_store_path_for(markdown_dataframe), LAYOUT_COLUMNS).load()
+    }
+    return {
+        record["submission_id"]: LayoutIndex(record["markdown"], layouts.get(record["original_file_name"]))
+        for record in MarkdownStore(markdown_path).load()
+    }
+
+
+def dumps_layout(layout: Dict) -> str:
+    """Serialize a layout index compactly (for the OCR cache)."""
+    return json.dumps(layout, separators=(",", ":"))
@@ -0,0 +1,86 @@
+"""
+Append-only, per-document store for extracted markdown.
+
+Every document is appended as one JSON line as soon as its markdown is ready
+and flushed to disk, so a crash or Ctrl-C only loses the documents still in
+flight. Each record also keeps the document's content key (its OCR cache
+key: file hash, truncation and OCR mode), and resuming skips a document only
+when the stored key matches its current one, so a file resubmitted under the
+same name is processed again. Loading
+is one json.loads per line, which is much cheaper than parsing a single CSV
+of quoted markdown blobs. The same format backs the per-document layout
+store (see layout_index), with different columns.
+"""
+
+import os
+import json
+import threading
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+COLUMNS = ["submission_id", "original_file_name", "markdown"]
+KEY_COLUMN = "content_key"  # stored alongside the columns when a record has it
+
+
+def store_path_for(markdown_dataframe: str) -> str:
+    """Path of the store that backs a submissions_markdown CSV."""
+    return os.path.splitext(markdown_dataframe)[0] + ".jsonl"
+
+
+class MarkdownStore:
+    def __init__(self, path: str, columns: List[str] = COLUMNS):
+        self.path = path
+        self.columns = columns
+        self._lock = threading.Lock()
+        self._repaired = False
+
+    def _repair(self):
+        """Drop a partially written last line left behind by a crash."""
+        if self._repaired:
+            return
+        self._repaired = True
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def append(self, record: Dict):
+        """Durably append one document's record."""
+        data = {col: record[col] for col in self.columns}
+        if record.get(KEY_COLUMN):
+            data[KEY_COLUMN] = record[KEY_COLUMN]
+        line = json.dumps(data, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._repair()
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self) -> List[Dict]:
+        """Return stored records in completion order; later records for the same file win."""
+        if not os.path.exists(self.path):
+            return []
+        records: Dict[str, Dict] = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partial line from an interrupted write
+                records.pop(record["original_file_name"], None)
+                records[record["original_file_name"]] = record
+        return list(records.values())
+
+    def completed(self) -> Dict[str, Optional[str]]:
+        """Content key of every document already stored, by original_file_name (None if not recorded)."""
+        return {record["original_file_name"]: record.get(KEY_COLUMN) for record in self.load()}
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.load(), columns=self.columns)
@@ -0,0 +1,36 @@
+"""
+Per-page content fingerprints for page-level OCR caching.
+
+A page's fingerprint covers everything that determines what OCR sees on it:
+its geometry, its content stream, the images and form XObjects it draws and
+the fonts it uses. Resubmitting a file with one or two edited pages therefore
+changes only those pages' fingerprints, and only they need to be OCR'd again.
+"""
+
+import hashlib
+from typing import List
+
+import fitz  # PyMuPDF
+
+
+def _page_fingerprint(doc, page) -> str:
+    h = hashlib.sha256()
+    h.update(repr((tuple(page.rect), page.rotation)).encode("utf-8"))
+    h.update(page.read_contents())
+
+    for xref, *_ in page.get_images(full=True):
+        h.update(b"img")
+        h.update(doc.xref_stream(xref) or b"")
+    for xref, *_ in page.get_xobjects():
+        h.update(b"xobj")
+        h.update(doc.xref_stream(xref) or b"")
+    for font in page.get_fonts(full=True):
+        h.update(repr(font[1:5]).encode("utf-8"))  # ext, type, basefont, name
+
+    return h.hexdigest()
+
+
+def page_fingerprints(data: bytes) -> List[str]:
+    """Return one fingerprint per page of the PDF in `data`, in page order."""
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return [_page_fingerprint(doc, page) for page in doc]
@@ -0,0 +1,148 @@
+"""
+Lazy, in-memory page images for grading.
+
+Instead of rasterizing every page of every submission up front, pages are
+rendered straight from the source PDF the first time a grading request asks
+for them and kept in a bounded LRU cache. Page numbers are the 1-based page
+numbers of the (possibly truncated) markdown, so they line up with the
+``PageBreak`` splits used for page mapping.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from dataclasses import astuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+from config import config
+from processing.document_ingest.pdf2img import RenderOptions, _page_matrix
+from processing.document_ingest.truncation import kept_page_indices
+
+
+class PageImageProvider:
+    """
+    Render submission pages to PNG bytes on demand.
+
+    Args:
+        pdf_folder (str): Folder holding the submission files.
+        truncate (list[int], optional): 1-based page numbers removed before OCR.
+            These pages are never rendered and are skipped when numbering pages.
+        max_cached_pages (int): Number of rendered pages kept in memory.
+        options (RenderOptions, optional): Rendering settings (default 544x704 PNG).
+    """
+
+    def __init__(
+        self,
+        pdf_folder: str,
+        truncate: Optional[Iterable[int]] = None,
+        max_cached_pages: int = config.processing.page_cache_size,
+        options: Optional[RenderOptions] = None,
+    ):
+        self.pdf_folder = pdf_folder
+        self.truncate = set(truncate or [])
+        self.max_cached_pages = max_cached_pages
+        self.options = options or RenderOptions(width=544, height=704, preserve_aspect_ratio=True)
+        self._cache: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        self._page_maps: Dict[str, List[int]] = {}
+        self._inflight: Dict[Tuple[str, int], asyncio.Future] = {}
+        # PyMuPDF is not thread-safe, so all rendering goes through one worker thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-render")
+        self.rendered = 0
+
+    @staticmethod
+    def image_name(original_file_name: str, page_num: int) -> str:
+        """Name a page image the same way create_images does."""
+        return f"{Path(original_file_name).stem}_page_{int(page_num)}.png"
+
+    def _source_path(self, original_file_name: str) -> Optional[str]:
+        """Locate the file to render from, preferring the converted PDF."""
+        pdf_path = os.path.join(self.pdf_folder, Path(original_file_name).stem + ".pdf")
+        if os.path.isfile(pdf_path):
+            return pdf_path
+        path = os.path.join(self.pdf_folder, original_file_name)
+        return path if os.path.isfile(path) else None
+
+    def _kept_pages(self, source_path: str, doc) -> List[int]:
+        """0-based indices of the pages that survived truncation, in order."""
+        if source_path not in self._page_maps:
+            # Only PDFs are truncated during ingestion
+            truncate = self.truncate if doc.is_pdf else None
+            self._page_maps[source_path] = kept_page_indices(doc.page_count, truncate)
+        return self._page_maps[source_path]
+
+    def cache_key(self, original_file_name: str, page_num: int) -> Optional[Tuple]:
+        """
+        Identify a rendered page by its source file, modification time and page
+        number (None if the source is missing), so caches of the rendered
+        image notice when the PDF is replaced.
+        """
+        source_path = self._source_path(original_file_name)
+        if source_path is None:
+            return None
+        try:
+            mtime = os.stat(source_path).st_mtime_ns
+        except OSError:
+            return None
+        return (source_path, mtime, int(page_num), tuple(sorted(self.truncate)), astuple(self.options))
+
+    def render_page(self, original_file_name: str, page_num: int) -> Optional[bytes]:
+        """Render one page (1-based, after truncation) to PNG bytes, or None if it does not exist."""
+        source_path = self._source_path(original_file_name)
+        if source_path is None:
+            return None
+
+        with fitz.open(source_path) as doc:
+            kept = self._kept_pages(source_path, doc)
+            if not 1 <= page_num <= len(kept):
+                return None
+            page_idx = kept[page_num - 1]
+            page = doc.load_page(page_idx)
+            pix = page.get_pixmap(matrix=_page_matrix(page, self.options, page_idx))
+            png = pix.tobytes("png")
+            del pix
+
+        self.rendered += 1
+        return png
+
+    def _remember(self, key: Tuple[str, int], png: bytes):
+        self._cache[key] = png
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached_pages:
+            self._cache.popitem(last=False)
+
+    async def get_page(self, original_file_name: str, page_num: int) -> Optional[bytes]:
+        """
+        Return PNG bytes for a page, rendering it off the event loop on first use.
+        Concurrent requests for the same page share a single render.
+        """
+        key = (original_file_name, int(page_num))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        if key not in self._inflight:
+            self._inflight[key] = asyncio.ensure_future(self._render(key))
+        return await self._inflight[key]
+
+    async def _render(self, key: Tuple[str, int]) -> Optional[bytes]:
+        original_file_name, page_num = key
+        loop = asyncio.get_running_loop()
+        try:
+            png = await loop.run_in_executor(self._executor, self.render_page, original_file_name, page_num)
+        except Exception as e:
+            print(f"Error rendering page {page_num} of {original_file_name}: {e}")
+            png = None
+        finally:
+            self._inflight.pop(key, None)
+
+        if png is not None:
+            self._remember(key, png)
+        return png
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._cache.clear()
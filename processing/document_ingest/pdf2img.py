@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 """
-Multithreaded PDF to Image Converter Using PyMuPDF (No Poppler Required)
+Process-parallel PDF to Image Converter Using PyMuPDF (No Poppler Required)
 
 Convert PDF files to PNG or JPEG images with specified dimensions.
 This script uses PyMuPDF (fitz) which doesn't require external tools like Poppler.
 
+Rasterization is CPU bound, so pages are rendered in a process pool rather than
+threads. Each document is split into page ranges; a worker opens the document
+once per range and renders every page in it, and workers are recycled after a
+fixed number of ranges to keep their memory bounded.
+
 Usage:
     pdf2img.py [-h] [--format {png,jpg,jpeg,tiff}] [--dpi DPI]
                [--width WIDTH] [--height HEIGHT] [--max-width MAX_WIDTH] [--max-height MAX_HEIGHT]
@@ -21,175 +26,204 @@ import os
 import resource
 import sys
 import time
+from dataclasses import dataclass
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
 import fitz  # PyMuPDF
 
+from config import config
+
+# Limit to this many pixels in any dimension
+MAX_DIMENSION = config.processing.max_dimension
+
+
+@dataclass
+class RenderOptions:
+    """Rendering settings shared by every page of a conversion run."""
+    format: str = "png"
+    dpi: int = config.processing.dpi
+    width: Optional[int] = None
+    height: Optional[int] = None
+    max_width: Optional[int] = None
+    max_height: Optional[int] = None
+    quality: int = config.processing.quality
+    preserve_aspect_ratio: bool = True
+
 
 def get_memory_usage():
     """Return current memory usage in MB"""
     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
-def process_pdf(args):
-    """Process a single PDF file"""
-    # Check if the PDF file exists
-    pdf_file = args.pdf_file
-    if not os.path.isfile(pdf_file):
-        print(f"Error: PDF file '{pdf_file}' not found.", file=sys.stderr)
-        return False
+def _page_matrix(page, options: RenderOptions, page_idx: int):
+    """Return the fitz.Matrix that renders `page` according to `options`."""
+    if options.max_width or options.max_height:
+        # Use max dimensions (preserves aspect ratio)
+        max_w = min(options.max_width if options.max_width else float("inf"), MAX_DIMENSION)
+        max_h = min(options.max_height if options.max_height else float("inf"), MAX_DIMENSION)
+
+        # Calculate zoom factors
+        zoom_x = max_w / page.rect.width if max_w < float("inf") else float("inf")
+        zoom_y = max_h / page.rect.height if max_h < float("inf") else float("inf")
+
+        # Use the smaller zoom to ensure the image fits within max dimensions
+        zoom = min(zoom_x, zoom_y)
+        if zoom == float("inf"):  # If neither max_width nor max_height was set
+            zoom = 1.0
+
+        # Check estimated dimensions before creating pixmap
+        if page.rect.width * zoom > MAX_DIMENSION or page.rect.height * zoom > MAX_DIMENSION:
+            zoom = min(MAX_DIMENSION / page.rect.width, MAX_DIMENSION / page.rect.height)
+        return fitz.Matrix(zoom, zoom)
+
+    if options.width and options.height:
+        # Use exact width and height
+        width = min(options.width, MAX_DIMENSION)
+        height = min(options.height, MAX_DIMENSION)
+        zoom_x = width / page.rect.width
+        zoom_y = height / page.rect.height
+
+        if options.preserve_aspect_ratio:
+            # Use the smaller zoom to preserve aspect ratio
+            zoom = min(zoom_x, zoom_y)
+            return fitz.Matrix(zoom, zoom)
+        # Use exact dimensions (may distort image)
+        return fitz.Matrix(zoom_x, zoom_y)
+
+    # Use DPI (but limit the resulting dimensions)
+    dpi = min(options.dpi, 600)  # Cap DPI at 600 to prevent memory issues
+    zoom = dpi / 72  # 72 DPI is the base for PDF
+    est_width = page.rect.width * zoom
+    est_height = page.rect.height * zoom
+
+    if est_width > MAX_DIMENSION or est_height > MAX_DIMENSION:
+        # Calculate safe DPI
+        zoom = min(MAX_DIMENSION / page.rect.width, MAX_DIMENSION / page.rect.height)
+        safe_dpi = zoom * 72
+        print(f"Warning: Page {page_idx+1} at {dpi} DPI would result in dimensions "
+              f"{est_width:.0f}x{est_height:.0f}, which exceeds the safety limit. "
+              f"Reducing to {safe_dpi:.0f} DPI.", file=sys.stderr)
+    return fitz.Matrix(zoom, zoom)
+
+
+def _save_pixmap(pix, output_file: Path, options: RenderOptions):
+    """Write a pixmap to disk in the requested format."""
+    fmt = options.format.lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
 
-    # Create output directory if it doesn't exist
-    output_dir = Path(args.output)
-    output_dir.mkdir(parents=True, exist_ok=True)
+    if fmt == "jpeg":
+        pix.save(str(output_file), output=fmt, jpg_quality=options.quality)
+    else:  # png / tiff
+        pix.save(str(output_file), output=fmt)
+
+
+def render_page_range(
+    pdf_file: str,
+    output_dir: str,
+    page_indices: List[int],
+    options: RenderOptions,
+) -> Tuple[int, List[str]]:
+    """
+    Render the given 0-based pages of one PDF, opening the document only once.
 
-    # Get base name for output files
+    Runs inside a worker process. Each page's pixmap is freed before the next one
+    is rendered, so memory per worker is bounded by a single page.
+
+    Returns:
+        (pages_rendered, error_messages)
+    """
+    output_path = Path(output_dir)
     base_name = Path(pdf_file).stem
+    rendered = 0
+    errors: List[str] = []
 
-    # Determine which pages to convert and handle file existence check
     try:
-        pages_to_convert = []
-        # Use a context manager for the PDF document to ensure it gets closed
         with fitz.open(pdf_file) as doc:
+            for page_idx in page_indices:
+                try:
+                    page = doc.load_page(page_idx)
+                    pix = page.get_pixmap(matrix=_page_matrix(page, options, page_idx))
+                    output_file = output_path / f"{base_name}_page_{page_idx + 1}.{options.format}"
+                    _save_pixmap(pix, output_file, options)
+                    # Explicitly delete the pixmap to free memory
+                    del pix
+                    rendered += 1
+                except Exception as e:
+                    errors.append(f"Error processing page {page_idx+1} of '{pdf_file}': {str(e)}")
+    except Exception as e:
+        errors.append(f"Error processing '{pdf_file}': {str(e)}")
 
-            pages_to_convert = list(range(doc.page_count))
+    return rendered, errors
 
-            if len(pages_to_convert) < doc.page_count:
-                print(f"Converting {len(pages_to_convert)} of {doc.page_count} pages")
 
-    except Exception as e:
-        print(f"Error examining PDF '{pdf_file}': {str(e)}", file=sys.stderr)
+def _page_count(pdf_file: str) -> int:
+    """Return the number of pages in a PDF (only the xref is parsed)."""
+    with fitz.open(pdf_file) as doc:
+        return doc.page_count
+
+
+def _options_from_args(args) -> RenderOptions:
+    return RenderOptions(
+        format=args.format,
+        dpi=args.dpi,
+        width=args.width,
+        height=args.height,
+        max_width=args.max_width,
+        max_height=args.max_height,
+        quality=args.quality,
+        preserve_aspect_ratio=args.preserve_aspect_ratio,
+    )
+
+
+def process_pdf(args):
+    """Process a single PDF file in the current process."""
+    # Check if the PDF file exists
+    pdf_file = args.pdf_file
+    if not os.path.isfile(pdf_file):
+        print(f"Error: PDF file '{pdf_file}' not found.", file=sys.stderr)
         return False
 
-    # Now process the PDF pages one by one
-    # We'll open the PDF again to ensure we're not keeping the whole document in memory
-    success = True
-    fmt = args.format.lower()
-    if fmt == "jpg":
-        fmt = "jpeg"
+    # Create output directory if it doesn't exist
+    Path(args.output).mkdir(parents=True, exist_ok=True)
 
-    # Add safety limits for very large documents
-    # Define maximum allowed dimensions
-    MAX_DIMENSION = 15000  # Limit to 15,000 pixels in any dimension
-    
     try:
-        # Process each page individually to minimize memory usage
-        for page_idx in pages_to_convert:
-            # Only open the document for one page at a time
-            with fitz.open(pdf_file) as doc:
-               
-                # Load the specific page
-                page = doc.load_page(page_idx)
-                
-                # Determine sizing approach
-                if args.max_width or args.max_height:
-                    # Use max dimensions (preserves aspect ratio)
-                    max_w = min(args.max_width if args.max_width else float("inf"), MAX_DIMENSION)
-                    max_h = min(args.max_height if args.max_height else float("inf"), MAX_DIMENSION)
-
-                    # Calculate zoom factors
-                    zoom_x = (
-                        max_w / page.rect.width if max_w < float("inf") else float("inf")
-                    )
-                    zoom_y = (
-                        max_h / page.rect.height if max_h < float("inf") else float("inf")
-                    )
-
-                    # Use the smaller zoom to ensure the image fits within max dimensions
-                    zoom = min(zoom_x, zoom_y)
-                    if zoom == float("inf"):  # If neither max_width nor max_height was set
-                        zoom = 1.0
-
-                    matrix = fitz.Matrix(zoom, zoom)
-                    
-                    # Check estimated dimensions before creating pixmap
-                    est_width = page.rect.width * zoom
-                    est_height = page.rect.height * zoom
-                    
-                    if est_width > MAX_DIMENSION or est_height > MAX_DIMENSION:
-                        # Recalculate zoom to fit within MAX_DIMENSION
-                        zoom_x = MAX_DIMENSION / page.rect.width
-                        zoom_y = MAX_DIMENSION / page.rect.height
-                        zoom = min(zoom_x, zoom_y)
-                        matrix = fitz.Matrix(zoom, zoom)
-                    
-
-                elif args.width and args.height:
-                    # Use exact width and height
-                    width = min(args.width, MAX_DIMENSION)
-                    height = min(args.height, MAX_DIMENSION)
-                    
-                    if args.preserve_aspect_ratio:
-                        # Calculate zoom factors
-                        zoom_x = width / page.rect.width
-                        zoom_y = height / page.rect.height
-
-                        # Use the smaller zoom to preserve aspect ratio
-                        zoom = min(zoom_x, zoom_y)
-                        matrix = fitz.Matrix(zoom, zoom)
-
-                    else:
-                        # Use exact dimensions (may distort image)
-                        # Calculate matrix for exact sizing
-                        scale_x = width / page.rect.width
-                        scale_y = height / page.rect.height
-                        matrix = fitz.Matrix(scale_x, scale_y)
-
-                    # Use DPI (but limit the resulting dimensions)
-                    # First, check what dimensions would result at the requested DPI
-                    dpi = min(args.dpi, 600)  # Cap DPI at 600 to prevent memory issues
-                    zoom = dpi / 72  # 72 DPI is the base for PDF
-                    est_width = page.rect.width * zoom
-                    est_height = page.rect.height * zoom
-                    
-                    if est_width > MAX_DIMENSION or est_height > MAX_DIMENSION:
-                        # Calculate safe DPI
-                        zoom_x = MAX_DIMENSION / page.rect.width
-                        zoom_y = MAX_DIMENSION / page.rect.height
-                        zoom = min(zoom_x, zoom_y)
-                        safe_dpi = zoom * 72
-                        print(f"Warning: Page {page_idx+1} at {dpi} DPI would result in dimensions "
-                              f"{est_width:.0f}x{est_height:.0f}, which exceeds the safety limit. "
-                              f"Reducing to {safe_dpi:.0f} DPI.", file=sys.stderr)
-                        dpi = safe_dpi
-                    
-                    matrix = fitz.Matrix(dpi/72, dpi/72)
-
-                
-                try:
-                    # Get the pixel map
-                    pix = page.get_pixmap(matrix=matrix)
-                    
-                    # Save the image
-                    output_file = output_dir / f"{base_name}_page_{page_idx + 1}.{args.format}"
-
-                    if fmt == "png":
-                        pix.save(str(output_file), output=fmt)
-                    elif fmt == "jpeg":
-                        pix.save(str(output_file), output=fmt, quality=args.quality)
-                    else:  # tiff
-                        pix.save(str(output_file), output=fmt)
-                    
-                    # Explicitly delete the pixmap to free memory
-                    del pix
-                except Exception as e:
-                    print(f"Error processing page {page_idx+1} of '{pdf_file}': {str(e)}", file=sys.stderr)
-                    success = False
-                    continue
-            
-        return success
-
+        pages_to_convert = list(range(_page_count(pdf_file)))
     except Exception as e:
-        print(f"Error processing '{pdf_file}': {str(e)}", file=sys.stderr)
+        print(f"Error examining PDF '{pdf_file}': {str(e)}", file=sys.stderr)
         return False
 
+    _, errors = render_page_range(pdf_file, args.output, pages_to_convert, _options_from_args(args))
+    for message in errors:
+        print(message, file=sys.stderr)
+    return not errors
+
 
-def create_images(pdf_folder, output_dir):
+def create_images(
+    pdf_folder,
+    output_dir,
+    max_workers: Optional[int] = None,
+    pages_per_task: int = config.processing.render_pages_per_task,
+):
     """
-    Convert all PDFs in pdf_folder to images in output_dir using parallel threads.
-    Images will be PNG, 544x704.
+    Convert all PDFs in pdf_folder to images in output_dir using a process pool.
+    Images will be PNG, fitted to 544x704 and named <stem>_page_<n>.png.
+
+    grade.py does not call this: grading renders pages on demand (see
+    page_images.PageImageProvider). It is kept for dumping a folder's page
+    images to disk, e.g. for grade_questions(img_dir=...) or manual review.
+
+    Args:
+        pdf_folder (str): Directory containing the PDFs.
+        output_dir (str): Directory to write the page images to.
+        max_workers (int, optional): Number of worker processes (default: all cores).
+        pages_per_task (int): Pages rendered per task; one document open per task.
+
+    Returns:
+        dict: Counts of documents/pages rendered, failures and pages per second.
     """
     # Find all PDF files in the folder
     pdf_files = [
@@ -199,35 +233,61 @@ def create_images(pdf_folder, output_dir):
     ]
     if not pdf_files:
         print(f"No PDF files found in {pdf_folder}")
-        return
-
-    # Prepare arguments for each PDF
-    class Args:
-        def __init__(self, pdf_file, output):
-            self.pdf_file = pdf_file
-            self.format = "png"
-            self.dpi = 200
-            self.width = 544
-            self.height = 704
-            self.max_width = None
-            self.max_height = None
-            self.quality = 90
-            self.output = output
-            self.pages = None
-            self.preserve_aspect_ratio = True
-
-    # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for pdf_file in pdf_files:
-            args = Args(pdf_file, output_dir)
-            futures.append(executor.submit(process_pdf, args))
-
-        # Use tqdm to track progress
-        for _ in tqdm(as_completed(futures), total=len(futures), desc="Converting PDFs to images"):
-            pass
-
-    print(f"Finished converting {len(pdf_files)} PDFs to images in {output_dir}")
+        return {"documents": 0, "pages": 0, "failed_pages": 0, "seconds": 0.0, "pages_per_second": 0.0}
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    options = RenderOptions(width=544, height=704, preserve_aspect_ratio=True)
+    max_workers = max_workers or config.processing.render_workers or os.cpu_count() or 1
+
+    # Split every document into page ranges so large PDFs spread across workers
+    tasks = []
+    for pdf_file in pdf_files:
+        try:
+            page_count = _page_count(pdf_file)
+        except Exception as e:
+            print(f"Error examining PDF '{pdf_file}': {str(e)}", file=sys.stderr)
+            continue
+        for start in range(0, page_count, pages_per_task):
+            tasks.append((pdf_file, list(range(start, min(start + pages_per_task, page_count)))))
+
+    total_pages = sum(len(pages) for _, pages in tasks)
+    rendered = 0
+    failed = 0
+    start_time = time.time()
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        max_tasks_per_child=config.processing.render_max_tasks_per_child,
+    ) as executor:
+        futures = {
+            executor.submit(render_page_range, pdf_file, output_dir, pages, options): len(pages)
+            for pdf_file, pages in tasks
+        }
+
+        # Use tqdm to track progress page by page
+        with tqdm(total=total_pages, desc="Converting PDFs to images", unit="page") as bar:
+            for future in as_completed(futures):
+                count, errors = future.result()
+                for message in errors:
+                    print(message, file=sys.stderr)
+                # A document that fails to open reports one error for all of its pages
+                attempted = futures[future]
+                rendered += count
+                failed += attempted - count
+                bar.update(attempted)
+
+    elapsed = time.time() - start_time
+    pages_per_second = rendered / elapsed if elapsed > 0 else 0.0
+    print(f"Finished converting {len(pdf_files)} PDFs ({rendered} pages) to images in {output_dir} "
+          f"in {elapsed:.2f}s ({pages_per_second:.1f} pages/s, {max_workers} workers)")
+
+    return {
+        "documents": len(pdf_files),
+        "pages": rendered,
+        "failed_pages": failed,
+        "seconds": elapsed,
+        "pages_per_second": pages_per_second,
+    }
 
 
 def pdf2img(pdf_file:str,
@@ -237,24 +297,29 @@ def pdf2img(pdf_file:str,
             max_height:int,
             pages:str,
             preserve_aspect_ratio:bool=True,
-            format:str= "png", 
+            format:str= "png",
             dpi:int=200,
             quality:int=90,
             output:str="."):
     # Start time
     start_time = time.time()
 
-    # Create output directory if it doesn't exist
-    output_dir = Path(output)
-    output_dir.mkdir(parents=True, exist_ok=True)
+    args = argparse.Namespace(
+        pdf_file=pdf_file,
+        width=width,
+        height=height,
+        max_width=max_width,
+        max_height=max_height,
+        pages=pages,
+        preserve_aspect_ratio=preserve_aspect_ratio,
+        format=format,
+        dpi=dpi,
+        quality=quality,
+        output=output,
+    )
 
-    # Process PDFs in parallel using ThreadPoolExecutor
-    success_count = 0
-    failure_count = 0
-    
     try:
-        process_pdf(args)
-        return 0
+        return 0 if process_pdf(args) else 1
     except Exception as exc:
         print(
             f"Generated an exception: {exc}", file=sys.stderr
@@ -262,4 +327,4 @@ def pdf2img(pdf_file:str,
         return 1
     finally:
         elapsed_time = time.time() - start_time
-        print(f"Processing completed in {elapsed_time:.2f} seconds:")
\ No newline at end of file
+        print(f"Processing completed in {elapsed_time:.2f} seconds:")
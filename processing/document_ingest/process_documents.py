@@ -1,5 +1,8 @@
 import os
+import time
 import asyncio
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import aiofiles  # Async file handling
 from tqdm import tqdm
@@ -8,6 +11,17 @@ from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.documentintelligence.models import DocumentContentFormat
 import hashlib
+import json
+
+from config import config
+from helpers.ocr_cache import OCRCache, ocr_cache
+from processing.document_ingest.text_layer import extract_text_layer, join_pages, split_pages
+from processing.document_ingest.truncation import truncate_pdf_bytes
+from processing.document_ingest.page_fingerprint import page_fingerprints
+from processing.document_ingest.markdown_store import MarkdownStore, store_path_for
+from processing.document_ingest.layout_index import (
+    LAYOUT_COLUMNS, build_layout_index, di_page_layouts, dumps_layout, layout_store_path_for,
+)
 
 
 def hash_filename(filename: str) -> str:
@@ -17,102 +31,412 @@ def hash_filename(filename: str) -> str:
 # Supported document formats
 SUPPORTED_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg"}
 
-async def analyze_document(file_path, document_client):
-    """Asynchronously calls Azure Document Intelligence to analyze a document."""
+# Document Intelligence settings; both are part of the OCR cache key
+LAYOUT_MODEL_ID = "prebuilt-layout"
+OUTPUT_FORMAT = DocumentContentFormat.MARKDOWN
+
+# How markdown is produced:
+#   "azure": every page goes through Document Intelligence
+#   "auto":  PDFs use their text layer; only text-poor / image-heavy pages go to Document Intelligence
+#   "local": text layer only, no network calls (pages without a text layer come back empty)
+OCR_MODES = ("auto", "azure", "local")
+
+class AdaptivePollingInterval:
+    """
+    Chooses how often to poll a Document Intelligence operation.
+
+    Keeps a running estimate of analysis seconds per MB from completed jobs and
+    polls each new job a few times over its expected duration, so small files
+    are picked up quickly and long scans don't hammer the service.
+    """
+
+    def __init__(
+        self,
+        minimum: float = config.processing.ocr_poll_min_seconds,
+        maximum: float = config.processing.ocr_poll_max_seconds,
+        polls_per_job: int = 4,
+        initial_seconds_per_mb: float = 5.0,
+        smoothing: float = 0.3,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.polls_per_job = polls_per_job
+        self.seconds_per_mb = initial_seconds_per_mb
+        self.smoothing = smoothing
+
+    def interval(self, size_bytes: int) -> float:
+        expected = max(size_bytes / 1_000_000, 0.05) * self.seconds_per_mb
+        return min(self.maximum, max(self.minimum, expected / self.polls_per_job))
+
+    def observe(self, size_bytes: int, seconds: float):
+        rate = seconds / max(size_bytes / 1_000_000, 0.05)
+        self.seconds_per_mb += self.smoothing * (rate - self.seconds_per_mb)
+
+async def analyze_document(file_path, document_client, polling_interval=None, pages=None, layout=None):
+    """
+    Asynchronously calls Azure Document Intelligence to analyze a document.
+
+    file_path may also be the document's raw bytes. polling_interval
+    (AdaptivePollingInterval, optional) picks the poll interval from the file
+    size and learns from how long the analysis took. pages (str, optional)
+    restricts the analysis to 1-based pages, e.g. "2,5". layout (list,
+    optional) is extended with the size and lines of every analyzed page
+    (see layout_index.di_page_layouts).
+    """
     try:
-        # Open file asynchronously using aiofiles
-        async with aiofiles.open(file_path, "rb") as f:
-            file_data = await f.read()  # Read file contents asynchronously
+        if isinstance(file_path, bytes):
+            file_data = file_path
+        else:
+            # Open file asynchronously using aiofiles
+            async with aiofiles.open(file_path, "rb") as f:
+                file_data = await f.read()  # Read file contents asynchronously
+
+        extra_kwargs = {}
+        if polling_interval is not None:
+            extra_kwargs["polling_interval"] = polling_interval.interval(len(file_data))
+        if pages:
+            extra_kwargs["pages"] = pages
 
         # Start analysis
+        started = time.monotonic()
         poller = await document_client.begin_analyze_document(
-            model_id="prebuilt-layout",
+            model_id=LAYOUT_MODEL_ID,
             body=file_data,
-            output_content_format=DocumentContentFormat.MARKDOWN,
+            output_content_format=OUTPUT_FORMAT,
             polling=True,  # Ensure polling behavior is set
+            **extra_kwargs,
         )
         result = await poller.result()
+        if polling_interval is not None:
+            polling_interval.observe(len(file_data), time.monotonic() - started)
+        if layout is not None:
+            layout.extend(di_page_layouts(result))
         return result.content  # Extracted markdown text
 
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
+        label = "in-memory document" if isinstance(file_path, bytes) else file_path
+        print(f"Error processing {label}: {e}")
         return None
 
-async def process_all_documents(input_dir, markdown_dataframe=None, backup_dir=None, truncate=None):
+async def analyze_pages(file_data, page_indices, page_count, document_client, polling_interval=None, layouts=None):
+    """
+    OCR only the given 0-based pages of a PDF.
+
+    Returns {page_index: markdown}, or None if the analysis failed or its
+    PageBreak boundaries don't line up with the requested pages. layouts
+    (dict, optional) receives {page_index: page layout}.
+    """
+    selection = None
+    if len(page_indices) != page_count:
+        selection = ",".join(str(i + 1) for i in page_indices)
+    page_layouts = []
+    markdown = await analyze_document(file_data, document_client, polling_interval, pages=selection, layout=page_layouts)
+    if markdown is None:
+        return None
+    parts = split_pages(markdown)
+    if len(parts) != len(page_indices):
+        return None
+    if layouts is not None and len(page_layouts) == len(page_indices):
+        layouts.update(zip(page_indices, page_layouts))
+    return dict(zip(page_indices, parts))
+
+def page_ocr_key(fingerprint):
+    """Page-level OCR cache key for a page fingerprint."""
+    return OCRCache.make_key(fingerprint.encode("utf-8"), model_id=LAYOUT_MODEL_ID, output_format=f"{OUTPUT_FORMAT.value}-page")
+
+def layout_cache_key(cache_key):
+    """OCR cache key of the layout stored alongside the markdown cached under `cache_key`."""
+    return f"{cache_key}-layout"
+
+async def get_cached_layout(cache, cache_key):
+    """The layout cached next to `cache_key`, or None (e.g. entries cached before layouts were kept)."""
+    value = await asyncio.to_thread(cache.get, layout_cache_key(cache_key))
+    return json.loads(value) if value is not None else None
+
+async def analyze_pages_cached(file_data, page_indices, fingerprints, document_client, polling_interval, page_cache, layouts=None):
+    """
+    Like analyze_pages, but pages whose fingerprint is already in `page_cache`
+    are reused and only new or changed pages are sent to Document Intelligence.
+    Page layouts are cached next to the page markdown.
+    """
+    keys = {idx: page_ocr_key(fingerprints[idx]) for idx in page_indices}
+    page_markdowns = {}
+    for idx in page_indices:
+        cached = await asyncio.to_thread(page_cache.get, keys[idx])
+        if cached is not None:
+            page_markdowns[idx] = cached
+            if layouts is not None:
+                layouts[idx] = await get_cached_layout(page_cache, keys[idx])
+
+    missing = [idx for idx in page_indices if idx not in page_markdowns]
+    if missing:
+        fresh_layouts = {}
+        fresh = await analyze_pages(file_data, missing, len(fingerprints), document_client, polling_interval, fresh_layouts)
+        if fresh is None:
+            return None
+        for idx, markdown in fresh.items():
+            await asyncio.to_thread(page_cache.put, keys[idx], markdown)
+            if idx in fresh_layouts:
+                await asyncio.to_thread(page_cache.put, layout_cache_key(keys[idx]), dumps_layout(fresh_layouts[idx]))
+        page_markdowns.update(fresh)
+        if layouts is not None:
+            layouts.update(fresh_layouts)
+    return page_markdowns
+
+async def extract_markdown(
+    file_data,
+    file_name,
+    document_client,
+    polling_interval=None,
+    ocr_mode="auto",
+    executor=None,
+    page_cache=None,
+    layout=None,
+):
+    """
+    Produce markdown for one document's bytes according to `ocr_mode` (see OCR_MODES).
+
+    In "auto" mode PDF pages are taken from the text layer, and only the pages
+    flagged as needing OCR are sent to Document Intelligence and stitched back
+    in order. Non-PDF files always go to Document Intelligence unless running
+    "local", in which case they yield None. CPU-bound page work runs on
+    `executor` (default: the loop's thread pool).
+
+    With a `page_cache`, PDF pages are fingerprinted and OCR'd page by page, so
+    a resubmission only pays for the pages that changed.
+
+    `layout` (list, optional) is filled with one entry per page: its size and
+    lines from Document Intelligence or the text layer (None where unknown),
+    ready for layout_index.build_layout_index.
+    """
+    if layout is None:
+        layout = []
+
+    async def analyze_whole():
+        del layout[:]
+        return await analyze_document(file_data, document_client, polling_interval, layout=layout)
+
+    is_pdf = file_name.lower().endswith(".pdf")
+    if not is_pdf:
+        if ocr_mode == "local":
+            return None
+        return await analyze_whole()
+    if ocr_mode == "azure" and page_cache is None:
+        return await analyze_whole()
+
+    loop = asyncio.get_running_loop()
+    try:
+        fingerprints = None
+        if page_cache is not None and ocr_mode != "local":
+            fingerprints = await loop.run_in_executor(executor, page_fingerprints, file_data)
+
+        if ocr_mode == "azure":
+            page_markdowns = [""] * len(fingerprints)
+            page_layouts = [None] * len(fingerprints)
+            ocr_indices = list(range(len(fingerprints)))
+        else:
+            pages = await loop.run_in_executor(executor, extract_text_layer, file_data)
+            page_markdowns = [page.markdown for page in pages]
+            page_layouts = [page.layout for page in pages]
+            ocr_indices = [page.index for page in pages if page.needs_ocr]
+    except Exception as e:
+        print(f"Error reading pages of {file_name}: {e}")
+        if ocr_mode == "local":
+            return None
+        return await analyze_whole()
+
+    if ocr_indices and ocr_mode != "local":
+        ocr_layouts = {}
+        if fingerprints is not None:
+            ocr_markdowns = await analyze_pages_cached(
+                file_data, ocr_indices, fingerprints, document_client, polling_interval, page_cache, ocr_layouts
+            )
+        else:
+            ocr_markdowns = await analyze_pages(
+                file_data, ocr_indices, len(page_markdowns), document_client, polling_interval, ocr_layouts
+            )
+        if ocr_markdowns is None:
+            # Page boundaries didn't line up; fall back to analyzing the whole document
+            return await analyze_whole()
+        for idx, page_md in ocr_markdowns.items():
+            page_markdowns[idx] = page_md
+            page_layouts[idx] = ocr_layouts.get(idx)
+
+    layout[:] = page_layouts
+    return join_pages(page_markdowns)
+
+def ocr_model_id(ocr_mode="azure", page_level=False):
+    """Identify the extraction pipeline for `ocr_mode` (part of the OCR cache key)."""
+    if ocr_mode == "azure":
+        return f"{LAYOUT_MODEL_ID}+pages" if page_level else LAYOUT_MODEL_ID
+    text_layer = (
+        f"pymupdf-text-layer(min_chars={config.processing.text_layer_min_chars},"
+        f"max_image_coverage={config.processing.text_layer_max_image_coverage})"
+    )
+    return f"{text_layer}+{LAYOUT_MODEL_ID}" if ocr_mode == "auto" else text_layer
+
+def ocr_cache_key(file_data, truncate=None, ocr_mode="azure", page_level=False):
+    """Cache key for analyzing `file_data` with the current model/format and truncate set."""
+    return OCRCache.make_key(
+        file_data,
+        truncate,
+        model_id=ocr_model_id(ocr_mode, page_level),
+        output_format=OUTPUT_FORMAT.value,
+    )
+
+def document_client_context(ocr_mode="auto"):
+    """
+    Async context manager yielding a DocumentIntelligenceClient, or None in
+    "local" mode (which needs no Azure credentials).
+    """
+    if ocr_mode not in OCR_MODES:
+        raise ValueError(f"Unknown ocr_mode '{ocr_mode}'; expected one of {OCR_MODES}.")
+    if ocr_mode == "local":
+        return contextlib.nullcontext(None)
+
+    load_dotenv()
+    # Retrieve Azure credentials from environment variables
+    AZURE_ENDPOINT = os.environ.get("AZURE_ENDPOINT")
+    AZURE_API_KEY = os.environ.get("AZURE_API_KEY")
+
+    if not AZURE_ENDPOINT or not AZURE_API_KEY:
+        raise ValueError("Azure credentials (AZURE_ENDPOINT, AZURE_API_KEY) are missing from environment variables.")
+
+    return DocumentIntelligenceClient(
+        endpoint=AZURE_ENDPOINT,
+        credential=AzureKeyCredential(AZURE_API_KEY)
+    )
+
+async def process_all_documents(
+    input_dir,
+    markdown_dataframe=None,
+    backup_dir=None,
+    truncate=None,
+    cache=ocr_cache,
+    max_concurrency=config.processing.ocr_concurrency,
+    ocr_mode=config.processing.ocr_mode,
+    store_path=None,
+    page_level=config.processing.ocr_page_level,
+    incoming=None,
+    deferred=None,
+):
     """
     Process all supported document types asynchronously and save extracted markdown text.
 
+    Files are fed through a sliding window of `max_concurrency` in-flight
+    analyses: the next file starts as soon as any slot frees up. Each finished
+    document is appended to a MarkdownStore right away with its content key,
+    and documents stored with the same key are skipped, so an interrupted run
+    resumes where it stopped while a file resubmitted under the same name is
+    processed again.
+
     Args:
         input_dir (str): Directory containing the documents.
         markdown_dataframe (str): CSV file path to save results.
         backup_dir (str, optional): Directory to save markdown backups.
         truncate (list[int], optional): List of page numbers to exclude from PDFs.
+        cache (OCRCache, optional): Content-addressed OCR cache; None disables it.
+        max_concurrency (int): Number of documents analyzed at once.
+        ocr_mode (str): "auto", "azure" or "local" (see OCR_MODES).
+        store_path (str, optional): Append-only JSONL store; defaults to
+            markdown_dataframe with a .jsonl extension. Each document's layout
+            index (page offsets, line spans and polygons) goes to a sibling
+            ".layout.jsonl" store.
+        page_level (bool): OCR PDFs page by page, reusing cached pages whose
+            fingerprint is unchanged (requires `cache`).
+        incoming (async iterator of str, optional): File names that appear in
+            input_dir while ingestion runs (e.g. PDFs from DocxConverter.convert);
+            each is queued as soon as it is yielded.
+        deferred (set[str], optional): File names to ignore in the initial
+            directory listing because they will arrive through `incoming`.
 
     Returns:
         pd.DataFrame: A DataFrame containing filenames and extracted markdown text.
     """
-    load_dotenv()
-    # Retrieve Azure credentials from environment variables
-    AZURE_ENDPOINT = os.environ.get("AZURE_ENDPOINT")
-    AZURE_API_KEY = os.environ.get("AZURE_API_KEY")
+    store_path = store_path or (store_path_for(markdown_dataframe) if markdown_dataframe else None)
+    store = MarkdownStore(store_path) if store_path else None
+    layout_store = MarkdownStore(layout_store_path_for(store_path), LAYOUT_COLUMNS) if store_path else None
 
-    if not AZURE_ENDPOINT or not AZURE_API_KEY:
-        raise ValueError("Azure credentials (AZURE_ENDPOINT, AZURE_API_KEY) are missing from environment variables.")
+    async with contextlib.AsyncExitStack() as stack:
+        # Use async with to ensure proper cleanup of the Azure client
+        document_client = await stack.enter_async_context(document_client_context(ocr_mode))
+        # CPU-bound work (truncation, text-layer extraction) runs in a process pool
+        cpu_pool = stack.enter_context(ProcessPoolExecutor(max_workers=config.processing.ingest_workers))
 
-    # Use async with to ensure proper cleanup of the Azure client
-    async with DocumentIntelligenceClient(
-        endpoint=AZURE_ENDPOINT, 
-        credential=AzureKeyCredential(AZURE_API_KEY)
-    ) as document_client:
-        
         # Gather all supported document files
+        deferred = set(deferred or [])
         files = [
             f for f in os.listdir(input_dir)
             if os.path.splitext(f)[1].lower() in SUPPORTED_EXTENSIONS
             and os.path.isfile(os.path.join(input_dir, f))
+            and f not in deferred
         ]
 
         # Ensure backup directory exists if provided
         if backup_dir and not os.path.exists(backup_dir):
             os.makedirs(backup_dir, exist_ok=True)
 
+        # Resume: documents stored with their current content key are not processed again
+        stored = store.completed() if store else {}
+        pending = list(files)
+        current_keys = {}  # content key of every file read in this run
+        reused = []
+
         results = []
-        batch_size = 10
+        polling_interval = AdaptivePollingInterval()
 
         async def handle_file(file_name):
             """Processes a single file asynchronously."""
             file_path = os.path.join(input_dir, file_name)
             file_id = hash_filename(file_name)
 
-            # If file is PDF and truncate is specified, handle page removal
-            if file_name.lower().endswith('.pdf') and truncate:
-                import PyPDF2
-                
-                # Read PDF and get number of pages
-                with open(file_path, 'rb') as pdf_file:
-                    pdf_reader = PyPDF2.PdfReader(pdf_file)
-                    total_pages = len(pdf_reader.pages)
-                    
-                    # Create new PDF writer
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    # Add all pages except those in truncate list
-                    for page_num in range(total_pages):
-                        if page_num + 1 not in truncate:  # page_num is 0-based, truncate list is 1-based
-                            pdf_writer.add_page(pdf_reader.pages[page_num])
-                    
-                    # Save modified PDF to temporary file
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                        pdf_writer.write(temp_file)
-                        temp_path = temp_file.name
-                
-                # Use temporary file for analysis
-                markdown_content = await analyze_document(temp_path, document_client)
-                # Clean up temporary file
-                os.unlink(temp_path)
-            else:
-                markdown_content = await analyze_document(file_path, document_client)
+            is_truncated = file_name.lower().endswith('.pdf') and bool(truncate)
+
+            async with aiofiles.open(file_path, "rb") as f:
+                file_data = await f.read()
+
+            content_key = ocr_cache_key(file_data, truncate if is_truncated else None, ocr_mode, page_level)
+            current_keys[file_name] = content_key
+            if stored.get(file_name) == content_key:
+                reused.append(file_name)
+                return
+
+            # Identical bytes with identical settings are never analyzed twice
+            cache_key = None
+            markdown_content = None
+            layout = None
+            if cache is not None:
+                cache_key = content_key
+                markdown_content = await asyncio.to_thread(cache.get, cache_key)
+                if markdown_content is not None:
+                    layout = await get_cached_layout(cache, cache_key)
+
+            cached = markdown_content is not None
+
+            loop = asyncio.get_running_loop()
+
+            # Truncated pages are removed in memory, off the event loop
+            if not cached and is_truncated:
+                file_data = await loop.run_in_executor(cpu_pool, truncate_pdf_bytes, file_data, truncate)
+
+            if not cached:
+                page_layouts = []
+                markdown_content = await extract_markdown(
+                    file_data,
+                    file_name,
+                    document_client,
+                    polling_interval,
+                    ocr_mode,
+                    executor=cpu_pool,
+                    page_cache=cache if page_level else None,
+                    layout=page_layouts,
+                )
+                if markdown_content:
+                    layout = await loop.run_in_executor(cpu_pool, build_layout_index, markdown_content, page_layouts)
+
+            if markdown_content and not cached and cache_key:
+                await asyncio.to_thread(cache.put, cache_key, markdown_content)
+                await asyncio.to_thread(cache.put, layout_cache_key(cache_key), dumps_layout(layout))
             
             if markdown_content:
                 # Save backup as markdown file if required
@@ -124,29 +448,94 @@ async def process_all_documents(input_dir, markdown_dataframe=None, backup_dir=N
                 
                 # Strip extension to create submission_id
                 #submission_id = os.path.splitext(file_name)[0]
-                results.append({
+                record = {
                     "submission_id": file_id,
                     "original_file_name": file_name,
-                    "markdown": markdown_content
-                })
+                    "markdown": markdown_content,
+                    "content_key": content_key
+                }
+                if store:
+                    if layout is None:
+                        # Cached before layouts were kept: page offsets only
+                        layout = build_layout_index(markdown_content)
+                    # The layout goes first so every stored document has one
+                    await asyncio.to_thread(layout_store.append, {**record, "layout": layout})
+                    await asyncio.to_thread(store.append, record)
+                results.append(record)
 
-        # Process files in batches of 10
-        for i in range(0, len(files), batch_size):
-            batch = files[i:i + batch_size]
-            batch_tasks = [handle_file(f) for f in batch]
-            
-            # Run batch tasks with progress bar
-            for coro in tqdm(asyncio.as_completed(batch_tasks), 
-                           total=len(batch_tasks), 
-                           desc=f"Processing batch {i//batch_size + 1}/{(len(files)-1)//batch_size + 1}"):
-                await coro
+        # Sliding window: each worker pulls the next file as soon as it is free
+        queue = asyncio.Queue()
+        for file_name in pending:
+            queue.put_nowait(file_name)
+        n_workers = max(1, max_concurrency if incoming is not None else min(max_concurrency, len(pending)))
+
+        with tqdm(total=len(files), desc="Analyzing documents", unit="doc") as progress:
+            async def feed():
+                # Files arriving while ingestion runs join the same window
+                try:
+                    if incoming is not None:
+                        async for file_name in incoming:
+                            files.append(file_name)
+                            progress.total += 1
+                            progress.refresh()
+                            await queue.put(file_name)
+                finally:
+                    for _ in range(n_workers):
+                        await queue.put(None)  # no more files
 
-        # Convert results to DataFrame and save
+            async def worker():
+                while (file_name := await queue.get()) is not None:
+                    try:
+                        await handle_file(file_name)
+                    except Exception as e:
+                        print(f"Error processing {file_name}: {e}")
+                    finally:
+                        progress.update(1)
+
+            await asyncio.gather(feed(), *(worker() for _ in range(n_workers)))
+        if reused:
+            print(f"Resumed: {len(reused)} of {len(files)} documents unchanged since they were processed")
+
+        # Convert results to DataFrame and save; a stored record of a file that
+        # has changed since (and failed this time) is not used
+        if store:
+            results = [
+                r for r in store.load()
+                if r.get("content_key") and current_keys.get(r["original_file_name"]) == r["content_key"]
+            ]
         df = pd.DataFrame(results, columns=["submission_id","original_file_name", "markdown"])
         df.to_csv(markdown_dataframe, index=False)
+
+        if cache is not None:
+            cache.print_stats()
         
         return df
 
+def load_submissions_markdown(markdown_dataframe, input_dir=None):
+    """
+    Load processed submissions, preferring the JSONL store over the CSV export.
+
+    The store keeps every document any earlier run processed, including files
+    since removed from the submissions folder, so when `input_dir` is given
+    only the documents currently in it are returned (like the CSV that
+    process_all_documents writes).
+
+    Args:
+        markdown_dataframe (str): Path of the submissions_markdown CSV.
+        input_dir (str, optional): Directory of the documents being graded.
+
+    Returns:
+        pd.DataFrame: submission_id, original_file_name and markdown per document.
+    """
+    store_path = store_path_for(markdown_dataframe)
+    if not os.path.exists(store_path):
+        return pd.read_csv(markdown_dataframe)
+    df = MarkdownStore(store_path).to_dataframe()
+    if input_dir is not None:
+        wanted = {f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))}
+        df = df[df["original_file_name"].isin(wanted)].reset_index(drop=True)
+    return df
+
 # Function to run the async processing from a synchronous script
 def run_document_processing(input_dir, markdown_dataframe, backup_dir=None, truncate=None):
     """
@@ -162,7 +551,7 @@ def run_document_processing(input_dir, markdown_dataframe, backup_dir=None, trun
     """
     return asyncio.run(process_all_documents(input_dir, markdown_dataframe, backup_dir, truncate))
 
-async def process_single_document(file_path, output_md_path=None):
+async def process_single_document(file_path, output_md_path=None, cache=ocr_cache, ocr_mode=config.processing.ocr_mode):
     """
     Asynchronously processes a single document and returns the markdown content.
     Optionally saves the markdown content to a file.
@@ -170,24 +559,29 @@ async def process_single_document(file_path, output_md_path=None):
     Args:
         file_path (str): Path to the document file.
         output_md_path (str, optional): Path to save the generated markdown file.
+        cache (OCRCache, optional): Content-addressed OCR cache; None disables it.
+        ocr_mode (str): "auto", "azure" or "local" (see OCR_MODES).
 
     Returns:
         str: Extracted markdown content.
     """
-    load_dotenv()
-    # Retrieve Azure credentials from environment variables
-    AZURE_ENDPOINT = os.environ.get("AZURE_ENDPOINT")
-    AZURE_API_KEY = os.environ.get("AZURE_API_KEY")
+    # Use async with to ensure proper cleanup of the Azure client
+    async with document_client_context(ocr_mode) as client:
+        async with aiofiles.open(file_path, "rb") as f:
+            file_data = await f.read()
 
-    if not AZURE_ENDPOINT or not AZURE_API_KEY:
-        raise ValueError("Azure credentials (AZURE_ENDPOINT, AZURE_API_KEY) are missing from environment variables.")
+        cache_key = None
+        markdown_content = None
+        if cache is not None:
+            cache_key = ocr_cache_key(file_data, ocr_mode=ocr_mode)
+            markdown_content = await asyncio.to_thread(cache.get, cache_key)
 
-    # Use async with to ensure proper cleanup of the Azure client
-    async with DocumentIntelligenceClient(
-        endpoint=AZURE_ENDPOINT, 
-        credential=AzureKeyCredential(AZURE_API_KEY)
-    ) as client:
-        markdown_content = await analyze_document(file_path, client)
+        if markdown_content is None:
+            markdown_content = await extract_markdown(
+                file_data, os.path.basename(file_path), client, ocr_mode=ocr_mode
+            )
+            if markdown_content and cache_key:
+                await asyncio.to_thread(cache.put, cache_key, markdown_content)
         
         # Save markdown content to file if output path is provided
         if markdown_content and output_md_path:
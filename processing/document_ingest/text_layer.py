@@ -0,0 +1,174 @@
+"""
+Local markdown extraction from a PDF's text layer.
+
+Born-digital submissions (e.g. DOCX exported to PDF) already carry a perfect
+text layer, so there is no need to send them through Document Intelligence.
+This module turns each page's text into simple markdown (headings, list items,
+paragraphs and tables) with PyMuPDF and flags the pages that still need OCR:
+pages with too little text, or whose content is mostly images (scans,
+screenshots, handwriting).
+
+Pages are joined with the same ``<!-- PageBreak -->`` marker Document
+Intelligence emits, so downstream page splitting works unchanged.
+"""
+
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import fitz  # PyMuPDF
+
+from config import config
+
+PAGE_BREAK_MARKER = "<!-- PageBreak -->"
+PAGE_BREAK = f"\n\n{PAGE_BREAK_MARKER}\n\n"
+
+BULLETS = ("•", "◦", "▪", "‣", "●", "○", "■", "-", "–", "*")
+
+
+@dataclass
+class PageText:
+    """Text-layer extraction result for one page."""
+    index: int              # 0-based page index within the document
+    markdown: str
+    char_count: int         # non-whitespace characters in the text layer
+    image_coverage: float   # fraction of the page area covered by images
+    needs_ocr: bool
+    layout: Optional[Dict] = None  # page size and lines (see layout_index)
+
+
+def _body_font_size(blocks) -> float:
+    """Most common font size on the page, weighted by character count."""
+    sizes = Counter()
+    for block in blocks:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                if span["text"].strip():
+                    sizes[round(span["size"], 1)] += len(span["text"])
+    return sizes.most_common(1)[0][0] if sizes else 0.0
+
+
+def _block_markdown(block, body_size: float) -> str:
+    lines = []
+    block_size = 0.0
+    for line in block["lines"]:
+        text = "".join(span["text"] for span in line["spans"]).strip()
+        if not text:
+            continue
+        lines.append(text)
+        block_size = max([block_size] + [s["size"] for s in line["spans"] if s["text"].strip()])
+    if not lines:
+        return ""
+
+    if all(line.startswith(BULLETS) for line in lines):
+        return "\n".join(f"- {line.lstrip(''.join(BULLETS)).strip()}" for line in lines)
+
+    # Re-flow wrapped lines into one paragraph, joining hyphenated breaks
+    text = lines[0]
+    for line in lines[1:]:
+        text = text[:-1] + line if text.endswith("-") else f"{text} {line}"
+
+    if body_size and len(text) < 120:
+        if block_size >= body_size * 1.5:
+            return f"# {text}"
+        if block_size >= body_size * 1.2:
+            return f"## {text}"
+    return text
+
+
+def _image_coverage(page) -> float:
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        covered += abs(fitz.Rect(info["bbox"]) & page.rect)
+    return min(1.0, covered / page_area)
+
+
+def text_blocks(page) -> List[Dict]:
+    """The page's text blocks from get_text("dict"), in reading order."""
+    return [
+        b for b in page.get_text("dict", sort=True)["blocks"]
+        if b.get("type") == 0
+    ]
+
+
+def page_layout(page, blocks=None) -> Dict:
+    """Page size (in points) and text lines with their bounding polygons."""
+    lines = []
+    for block in blocks if blocks is not None else text_blocks(page):
+        for line in block["lines"]:
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            if text:
+                x0, y0, x1, y1 = (round(v, 3) for v in line["bbox"])
+                lines.append((text, [x0, y0, x1, y0, x1, y1, x0, y1]))
+    return {"width": page.rect.width, "height": page.rect.height, "unit": "point", "lines": lines}
+
+
+def page_markdown(page, blocks=None) -> str:
+    """Convert one page's text layer to markdown."""
+    if blocks is None:
+        blocks = text_blocks(page)
+    body_size = _body_font_size(blocks)
+
+    # Tables are rendered as markdown tables and their text skipped elsewhere
+    items = []
+    table_rects = []
+    try:
+        for table in page.find_tables().tables:
+            table_rects.append(fitz.Rect(table.bbox))
+            items.append((table.bbox[1], table.to_markdown().strip()))
+    except Exception:
+        pass
+
+    for block in blocks:
+        rect = fitz.Rect(block["bbox"])
+        if any(rect.intersects(t) for t in table_rects):
+            continue
+        md = _block_markdown(block, body_size)
+        if md:
+            items.append((block["bbox"][1], md))
+
+    items.sort(key=lambda item: item[0])
+    return "\n\n".join(md for _, md in items)
+
+
+def extract_text_layer(
+    data: bytes,
+    min_chars: int = config.processing.text_layer_min_chars,
+    max_image_coverage: float = config.processing.text_layer_max_image_coverage,
+) -> List[PageText]:
+    """
+    Extract per-page markdown from a PDF's text layer.
+
+    A page is flagged `needs_ocr` when it has fewer than `min_chars`
+    non-whitespace characters or images cover at least `max_image_coverage`
+    of its area.
+    """
+    pages: List[PageText] = []
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        for page in doc:
+            blocks = text_blocks(page)
+            markdown = page_markdown(page, blocks)
+            char_count = sum(1 for ch in page.get_text() if not ch.isspace())
+            coverage = _image_coverage(page)
+            pages.append(PageText(
+                index=page.number,
+                markdown=markdown,
+                char_count=char_count,
+                image_coverage=coverage,
+                needs_ocr=char_count < min_chars or coverage >= max_image_coverage,
+                layout=page_layout(page, blocks),
+            ))
+    return pages
+
+
+def join_pages(page_markdowns: List[str]) -> str:
+    """Join per-page markdown using Document Intelligence's page-break marker."""
+    return PAGE_BREAK.join(md.strip() for md in page_markdowns)
+
+
+def split_pages(markdown: str) -> List[str]:
+    """Split Document Intelligence markdown back into per-page markdown."""
+    return [page.strip() for page in markdown.split(PAGE_BREAK_MARKER)]
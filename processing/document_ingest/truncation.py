@@ -0,0 +1,33 @@
+"""
+Page removal for --truncate, shared by ingestion and page rendering.
+
+Both the OCR input and the lazily rendered grading images are derived from
+kept_page_indices, so they always see the same page set and page numbers
+after truncation line up with the markdown's PageBreak splits.
+"""
+
+from typing import Iterable, List, Optional
+
+import fitz  # PyMuPDF
+
+
+def kept_page_indices(page_count: int, truncate: Optional[Iterable[int]] = None) -> List[int]:
+    """0-based indices of the pages that survive truncation (truncate is 1-based), in order."""
+    removed = set(truncate or [])
+    return [i for i in range(page_count) if i + 1 not in removed]
+
+
+def truncate_pdf_bytes(data: bytes, truncate: Optional[Iterable[int]] = None) -> bytes:
+    """
+    Return a copy of the PDF in `data` without the truncated pages.
+
+    Works entirely in memory and is CPU bound, so callers on the event loop
+    should run it in a worker pool.
+    """
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        kept = kept_page_indices(doc.page_count, truncate)
+        if len(kept) == doc.page_count:
+            return data
+        doc.select(kept)
+        # garbage collection drops objects only referenced by removed pages
+        return doc.tobytes(garbage=3, deflate=True)
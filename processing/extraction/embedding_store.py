@@ -0,0 +1,159 @@
+"""
+Binary, memory-mapped store for page embeddings.
+
+Embeddings are kept as one contiguous matrix in a .npy file (float32, or
+float16 to halve the size) that is memory-mapped on load, so opening the
+store costs milliseconds no matter how many pages it holds and pages are only
+read from disk when they are used. A small JSON index next to it maps each
+(submission_id, page_idx) to its row, keeps the page text and records which
+embedding model produced the vectors.
+
+Rows of one submission are contiguous, so a submission's page matrix is a
+zero-copy slice of the memory map.
+"""
+
+import os
+import json
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import config
+
+INDEX_COLUMNS = ["submission_id", "original_file_name", "page_idx", "page_text"]
+
+
+def reduce_embeddings(
+    matrix: np.ndarray,
+    dims: Optional[int] = None,
+    dtype: str = "float32",
+) -> np.ndarray:
+    """
+    Optionally shorten embeddings to their first `dims` components and cast to `dtype`.
+
+    text-embedding-3 models are trained so that a prefix of the vector is
+    itself a usable embedding; shortened vectors are re-normalized to unit
+    length.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dims and dims < matrix.shape[1]:
+        matrix = matrix[:, :dims]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+    return matrix.astype(dtype, copy=False)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _atomic_write(path: str, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class EmbeddingStore:
+    """
+    Page embeddings of every submission, stored under `directory` as
+    `<name>.npy` (the matrix) and `<name>.json` (the row index).
+    """
+
+    def __init__(self, directory: str, name: str = "page_embeddings"):
+        self.matrix_path = os.path.join(directory, f"{name}.npy")
+        self.index_path = os.path.join(directory, f"{name}.json")
+        self.matrix: Optional[np.ndarray] = None
+        self.model: Optional[str] = None
+        self.records: List[Dict] = []
+        self.rows: Dict[Tuple[str, int], int] = {}
+
+    def exists(self) -> bool:
+        # The index is written last, so its presence means the store is complete
+        return os.path.isfile(self.index_path) and os.path.isfile(self.matrix_path)
+
+    def write(
+        self,
+        records: List[Dict],
+        matrix: np.ndarray,
+        dims: Optional[int] = config.processing.page_embedding_dims,
+        dtype: str = config.processing.page_embedding_dtype,
+        model: str = config.models.embedding_model,
+    ):
+        """
+        Write the store.
+
+        Args:
+            records (List[Dict]): One dict per page with INDEX_COLUMNS, in row order.
+                Pages of a submission must be consecutive.
+            matrix (np.ndarray): Embeddings, shape (len(records), dim).
+            dims (int, optional): Keep only the first `dims` components.
+            dtype (str): "float32" or "float16".
+            model (str): Embedding model id (EmbeddingProvider.model_id) of the vectors.
+        """
+        matrix = reduce_embeddings(matrix, dims, dtype)
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        _atomic_write(self.matrix_path, lambda f: np.save(f, matrix))
+        index = {
+            "model": model,
+            "dtype": str(matrix.dtype),
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "pages": [{col: rec[col] for col in INDEX_COLUMNS} for rec in records],
+        }
+        payload = json.dumps(index, ensure_ascii=False, default=_json_default).encode("utf-8")
+        _atomic_write(self.index_path, lambda f: f.write(payload))
+        self._set(index["pages"], np.load(self.matrix_path, mmap_mode="r"))
+        self.model = model
+
+    def load(self) -> "EmbeddingStore":
+        """Memory-map the matrix and read the index."""
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self._set(index["pages"], np.load(self.matrix_path, mmap_mode="r"))
+        # Stores written before the model was recorded hold Azure embeddings
+        self.model = index.get("model", config.models.embedding_model)
+        return self
+
+    def _set(self, records: List[Dict], matrix: np.ndarray):
+        self.records = records
+        self.matrix = matrix
+        self.rows = {(rec["submission_id"], rec["page_idx"]): row for row, rec in enumerate(records)}
+
+    def row(self, submission_id: str, page_idx: int) -> int:
+        """Row offset of a page (page_idx is 1-based)."""
+        return self.rows[(submission_id, page_idx)]
+
+    def submissions(self) -> List[Dict]:
+        """Per-submission pages and memory-mapped embedding slices; see group_submissions."""
+        return group_submissions(self.records, self.matrix)
+
+
+def group_submissions(records: List[Dict], matrix: np.ndarray) -> List[Dict]:
+    """
+    Group consecutive page rows by submission, in row order. Each dict has
+    submission_id, original_file_name, pages (texts) and page_embeddings (a
+    slice of `matrix`, so no copy is made).
+    """
+    results: List[Dict] = []
+    start = 0
+    for row in range(1, len(records) + 1):
+        first = records[start]
+        if row < len(records):
+            rec = records[row]
+            if (rec["submission_id"], rec["original_file_name"]) == (first["submission_id"], first["original_file_name"]):
+                continue
+        results.append({
+            "submission_id": first["submission_id"],
+            "original_file_name": first["original_file_name"],
+            "pages": [rec["page_text"] for rec in records[start:row]],
+            "page_embeddings": matrix[start:row],
+        })
+        start = row
+    return results
@@ -0,0 +1,387 @@
+"""
+Embedding providers for page mapping.
+
+Page mapping only needs vectors that rank a submission's pages against its
+questions, so the backend is pluggable (see get_embedding_provider):
+
+- "azure" (EmbeddingBatcher): Azure OpenAI embeddings, batched and cached.
+- "local" (LocalEmbeddingProvider): hashed bag-of-words vectors computed with
+  scikit-learn on the CPU, IDF-weighted per submission when pages are scored
+  (see EmbeddingProvider.reweight); no network calls at all.
+
+The embeddings API accepts a list of inputs per call, so instead of one
+round-trip per text, EmbeddingBatcher collects the texts callers ask for and
+packs them into as few requests as possible, up to a token budget and an
+input count per request. Each caller still awaits its own embedding; results
+are fanned back out by position once the batch returns. A batch hit by a
+transient error (429, 5xx, connection) is retried with backoff, and one
+rejected as a bad request is split in half until the offending input is
+isolated, so a single bad text only fails its own caller.
+
+Embeddings are also looked up in the persistent embedding cache first, and
+concurrent requests for the same text share one pending embedding, so
+identical texts (e.g. the same question for every submission) are only sent
+once.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from openai import APIConnectionError, AsyncAzureOpenAI, BadRequestError, InternalServerError, RateLimitError
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+from config import config
+from helpers.embedding_cache import EmbeddingCache, embedding_cache
+from helpers.rate_limiter import retry_after
+from helpers.tokenizer import get_tokenizer
+
+TOKEN_LIMIT = config.models.max_tokens  # max tokens per text
+EMBEDDING_PROVIDERS = ("azure", "local")
+
+
+def truncate_text(
+    text: str,
+    max_tokens: int = TOKEN_LIMIT,
+    model: str = config.models.embedding_model
+) -> str:
+    """
+    Truncate `text` to at most TOKEN_LIMIT tokens using the model's tokenizer.
+    """
+    return get_tokenizer(model=model).truncate(text, max_tokens)[0]
+
+
+class EmbeddingProvider(ABC):
+    """
+    Interface shared by the embedding backends.
+
+    `model_id` identifies the vector space; embeddings from different model_ids
+    must never be compared (the page embedding store records it).
+    """
+    model_id: str
+
+    @abstractmethod
+    async def embed(self, text: str) -> List[float]:
+        """Embed one text."""
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """Embed `texts`, returning embeddings in the same order."""
+        return list(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+    async def flush(self):
+        """Finish any deferred work (e.g. cache bookkeeping)."""
+
+    def reweight(self, pages: np.ndarray, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Adapt one submission's page and query embeddings before they are scored
+        against each other. Dense model embeddings are used as they are.
+
+        Args:
+            pages (np.ndarray): The submission's page embeddings, one per row.
+            queries (np.ndarray): Query embeddings, with the embedding on the last axis.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: `pages` and `queries`, reweighted.
+        """
+        return pages, queries
+
+    def print_stats(self):
+        pass
+
+
+class EmbeddingBatcher(EmbeddingProvider):
+    """
+    Azure OpenAI provider. Pack concurrent embedding requests into batched `embeddings.create` calls.
+
+    A batch is sent as soon as it reaches `max_batch_tokens` or
+    `max_batch_size` inputs, or `max_wait` seconds after its first text
+    arrived, whichever comes first. At most `max_concurrent` batches are in
+    flight at once.
+
+    Args:
+        client (AsyncAzureOpenAI): Client used for the embedding calls.
+        model (str): Embedding model deployment.
+        max_batch_tokens (int): Token budget per request, summed over its inputs.
+        max_batch_size (int): Maximum number of inputs per request.
+        max_concurrent (int): Requests in flight at once.
+        max_wait (float): Seconds a partial batch waits for more texts.
+        max_retries (int): Retries of a request after a transient error.
+        cache (EmbeddingCache, optional): Persistent cache consulted before
+            sending a text and filled with every new embedding; None disables it.
+    """
+
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        model: str = config.models.embedding_model,
+        max_batch_tokens: int = config.processing.embedding_batch_tokens,
+        max_batch_size: int = config.processing.embedding_batch_size,
+        max_concurrent: int = config.rate_limits.embedding_concurrent,
+        max_wait: float = config.processing.embedding_batch_wait_seconds,
+        max_retries: int = config.rate_limits.embedding_max_retries,
+        cache: Optional[EmbeddingCache] = embedding_cache,
+    ):
+        self.client = client
+        self.model = model
+        self.model_id = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.cache = cache
+        self.tokenizer = get_tokenizer(model=model)
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._in_flight = set()
+        self._futures: Dict[str, asyncio.Future] = {}  # key -> pending embedding
+        self._lookups: Optional[Dict[str, asyncio.Future]] = None  # cache reads of this tick
+        self.requests = 0
+        self.texts = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.splits = 0
+
+    async def embed(self, text: str) -> List[float]:
+        """Embed one text, sharing a request with whatever else is pending."""
+        text = text or " "  # the API rejects empty inputs, which would fail the whole batch
+        key = EmbeddingCache.make_key(self.model, text)
+
+        # Identical text already on its way: wait for the same result
+        if key in self._futures:
+            self.coalesced += 1
+            return await asyncio.shield(self._futures[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[key] = future
+        future.add_done_callback(lambda _: self._futures.pop(key, None))
+
+        if self.cache is not None:
+            cached = await self._cached(key)
+            if cached is not None:
+                future.set_result(cached)
+                return cached
+
+        truncated, n_tokens = self.tokenizer.truncate(text, TOKEN_LIMIT)
+        if self._pending and (
+            self._pending_tokens + n_tokens > self.max_batch_tokens
+            or len(self._pending) >= self.max_batch_size
+        ):
+            self._flush()
+        self._pending.append((key, truncated, future))
+        self._pending_tokens += n_tokens
+
+        if self._pending_tokens >= self.max_batch_tokens or len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+
+        return await asyncio.shield(future)
+
+    async def _cached(self, key: str) -> Optional[List[float]]:
+        """
+        Look `key` up in the persistent cache. Keys requested in the same
+        event-loop tick are read together, in one query on a worker thread.
+        """
+        if self._lookups is None:
+            self._lookups = {}
+            asyncio.get_running_loop().call_soon(self._start_lookup)
+        if key not in self._lookups:
+            self._lookups[key] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(self._lookups[key])
+
+    def _start_lookup(self):
+        lookups, self._lookups = self._lookups, None
+        task = asyncio.create_task(self._lookup(lookups))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _lookup(self, lookups: Dict[str, asyncio.Future]):
+        try:
+            found = await asyncio.to_thread(self.cache.get_many, list(lookups))
+        except Exception as e:
+            print(f"Warning: could not read the embedding cache: {e}")
+            found = {}
+        for key, future in lookups.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+    async def flush(self):
+        """Write pending cache bookkeeping (last-used times of cache hits)."""
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        task = asyncio.create_task(self._send(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _create(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        """embeddings.create for `batch`, retried with backoff on transient errors."""
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                try:
+                    return await self.client.embeddings.create(
+                        model = self.model,
+                        input = [text for _, text, _ in batch]
+                    )
+                except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    wait = retry_after(getattr(getattr(e, "response", None), "headers", None))
+            self.retries += 1
+            await asyncio.sleep(wait if wait is not None else min(60.0, 2.0 ** attempt))
+
+    async def _send(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        try:
+            resp = await self._create(batch)
+        except BadRequestError as e:
+            if len(batch) > 1:
+                # Isolate the input the service rejected; the rest still get embedded
+                self.splits += 1
+                middle = len(batch) // 2
+                await asyncio.gather(self._send(batch[:middle]), self._send(batch[middle:]))
+                return
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.requests += 1
+        self.texts += len(batch)
+        new_embeddings = {}
+        for item in resp.data:
+            key, _, future = batch[item.index]
+            new_embeddings[key] = item.embedding
+            if not future.done():
+                future.set_result(item.embedding)
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Embedding missing from batch response"))
+
+        if self.cache is not None:
+            try:
+                await asyncio.to_thread(self.cache.put_many, new_embeddings)
+            except Exception as e:
+                print(f"Warning: could not cache embeddings: {e}")
+
+    def print_stats(self):
+        if self.requests:
+            print(f"Embedded {self.texts} texts in {self.requests} requests "
+                  f"({self.texts / self.requests:.1f} texts/request)")
+        if self.coalesced:
+            print(f"Reused {self.coalesced} in-flight embeddings for duplicate texts")
+        if self.retries or self.splits:
+            print(f"Retried {self.retries} embedding requests; split {self.splits} rejected batches")
+        if self.cache is not None:
+            self.cache.print_stats()
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Offline provider: bag-of-words vectors from scikit-learn's HashingVectorizer.
+
+    Unigrams and bigrams (English stop words removed) are hashed into `dims`
+    buckets with sublinear term frequencies and L2-normalized. Hashing needs no
+    fitted vocabulary, so pages and questions embedded at different times share
+    one vector space (and stored page vectors stay valid). IDF weights are
+    fitted at scoring time instead, over each submission's own pages, and
+    applied to its pages and queries alike (see reweight), so terms on every
+    page of a submission, like its header, carry little weight. Texts requested
+    in the same event-loop tick are vectorized together in one call on a worker
+    thread.
+
+    Args:
+        dims (int): Hash buckets, i.e. the embedding dimension.
+    """
+
+    def __init__(self, dims: int = config.processing.local_embedding_dims):
+        self.vectorizer = HashingVectorizer(
+            n_features=dims,
+            ngram_range=(1, 2),
+            stop_words="english",
+            alternate_sign=False,
+            norm=None,
+        )
+        self.model_id = f"local-hashing-{dims}"
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._in_flight = set()
+        self.batches = 0
+        self.texts = 0
+
+    def _vectorize(self, texts: List[str]) -> np.ndarray:
+        counts = self.vectorizer.transform(texts)
+        counts.data = 1.0 + np.log(counts.data)  # sublinear tf
+        matrix = counts.astype(np.float32).toarray()
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    async def embed(self, text: str) -> List[float]:
+        """Embed one text, vectorized together with the rest of this tick's texts."""
+        future = asyncio.get_running_loop().create_future()
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._pending.append((text or "", future))
+        return await future
+
+    def _flush(self):
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._run(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            matrix = await asyncio.to_thread(self._vectorize, [text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.texts += len(batch)
+        for (_, future), vector in zip(batch, matrix):
+            if not future.done():
+                future.set_result(vector.tolist())
+
+    def reweight(self, pages: np.ndarray, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Weight pages and queries by the IDF of the submission's pages, then L2-normalize."""
+        if not len(pages):
+            return pages, queries
+        tfidf = TfidfTransformer(smooth_idf=True).fit(pages)
+        weighted = tfidf.transform(queries.reshape(-1, queries.shape[-1])).toarray()
+        return (
+            tfidf.transform(pages).toarray().astype(np.float32),
+            weighted.astype(np.float32).reshape(queries.shape),
+        )
+
+    def print_stats(self):
+        if self.batches:
+            print(f"Embedded {self.texts} texts locally in {self.batches} batches")
+
+
+def get_embedding_provider(
+    name: str = config.processing.embedding_provider,
+    client: Optional[AsyncAzureOpenAI] = None,
+    model: str = config.models.embedding_model,
+) -> EmbeddingProvider:
+    """Build the embedding provider called `name` ("azure" or "local")."""
+    if name == "azure":
+        return EmbeddingBatcher(client, model=model)
+    if name == "local":
+        return LocalEmbeddingProvider()
+    raise ValueError(f"embedding provider must be one of {EMBEDDING_PROVIDERS}, got {name!r}")
@@ -4,7 +4,6 @@ import aiofiles
 from tqdm.asyncio import tqdm_asyncio
 from openai import AsyncAzureOpenAI
 import re
-import tiktoken
 from typing import Any
 
 # async def structure_submissions(markdown_text: str, stripped_assignment:str, openai_client: AsyncAzureOpenAI, model="gpt-4o") -> list:
@@ -139,7 +138,7 @@ Return your answer as valid JSON only, in the following format:
 IMPORTANT: Do not include any additional commentary. Your response MUST be in valid JSON. Provide the answer to each question in the submission, do not cut off your response early.
 """
         if token_tracker:
-            token_tracker.add("process_submissions", system_prompt+user_prompt)
+            token_tracker.add("process_submissions", (system_prompt, user_prompt))
 
         try:
             response = await client.chat.completions.create(
@@ -248,7 +247,7 @@ async def get_questions_with_context(raw_assignment, client, model, output_csv,
     """
 
     if token_tracker:
-        token_tracker.add("get_questions_with_context", system_prompt+user_prompt)
+        token_tracker.add("get_questions_with_context", (system_prompt, user_prompt))
 
     try:
         response = await client.chat.completions.create(
@@ -340,7 +339,7 @@ async def strip_assignment(
     """
    
     if token_tracker:
-        token_tracker.add("strip_assignment", system_prompt+user_prompt)
+        token_tracker.add("strip_assignment", (system_prompt, user_prompt))
 
     try:
         response = await client.chat.completions.create(
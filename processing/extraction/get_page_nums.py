@@ -5,54 +5,23 @@ import pandas as pd
 from typing import List, Dict, Tuple, Optional
 from openai import AsyncAzureOpenAI
 from tqdm.asyncio import tqdm_asyncio
-import tiktoken
-from sklearn.metrics.pairwise import cosine_similarity
 from pydantic import BaseModel, Field
 import json
+from collections import defaultdict
 from config import config
+from processing.extraction.embeddings import EmbeddingProvider, get_embedding_provider
+from processing.extraction.embedding_store import EmbeddingStore, INDEX_COLUMNS, group_submissions, reduce_embeddings
+from processing.extraction.similarity import candidate_pages, normalize_rows
+from processing.extraction.page_locator import PageLocator, PageLocation
+from processing.document_ingest.layout_index import LayoutIndex
 
 # --------------------------------------------------------------
 # 1. Constants and semaphores for Azure S0
 # --------------------------------------------------------------
-TOKEN_LIMIT         = config.models.max_tokens       # max tokens per text
-EMBED_CONCURRENT    = config.rate_limits.embedding_concurrent          # only 5 embedding calls in flight at once
 QUESTION_CONCURRENT = config.rate_limits.question_concurrent          # only 3 question‐blocks in flight at once
-_embed_semaphore    = asyncio.Semaphore(EMBED_CONCURRENT)
 _question_semaphore = asyncio.Semaphore(QUESTION_CONCURRENT)
 
 
-def truncate_text(
-    text: str,
-    max_tokens: int = TOKEN_LIMIT,
-    model: str = config.models.embedding_model
-) -> str:
-    """
-    Truncate `text` to at most TOKEN_LIMIT tokens using tiktoken.
-    """
-    encoding = tiktoken.encoding_for_model(model)
-    tokens   = encoding.encode(text)
-    if len(tokens) > max_tokens:
-        return encoding.decode(tokens[:max_tokens])
-    return text
-
-
-async def get_embedding(
-    client: AsyncAzureOpenAI,
-    text: str,
-    model: str = config.models.embedding_model
-) -> List[float]:
-    """
-    Acquire embedding‐semaphore, then fetch one embedding for `text` from Azure.
-    """
-    truncated = truncate_text(text, max_tokens=TOKEN_LIMIT, model=model)
-    async with _embed_semaphore:
-        resp = await client.embeddings.create(
-            model = model,
-            input = truncated
-        )
-        return resp.data[0].embedding
-
-
 # --------------------------------------------------------------
 # 2. Pydantic model for combined pages response
 # --------------------------------------------------------------
@@ -61,6 +30,18 @@ class CombinedPagesEntry(BaseModel):
     pages: List[int] = Field(default_factory=list)
 
 
+class SubmissionPagesEntry(BaseModel):
+    item: int  # the question's position in the prompt (1-based)
+    pages: List[int] = Field(default_factory=list)
+
+
+class SubmissionPagesResponse(BaseModel):
+    questions: List[SubmissionPagesEntry] = Field(default_factory=list)
+
+
+PAGE_MAPPING_MODES = ("question", "submission")
+
+
 # --------------------------------------------------------------
 # 3. Precompute page splits & embeddings per submission
 # --------------------------------------------------------------
@@ -68,13 +49,15 @@ async def preprocess_submissions(
     submissions_df: pd.DataFrame,
     client: AsyncAzureOpenAI,
     embedding_model: str = config.models.embedding_model,
-    backup_dir: Optional[str] = None
+    backup_dir: Optional[str] = None,
+    embedder: Optional[EmbeddingProvider] = None
 ) -> List[Dict]:
     """
-    1) If a backup CSV exists in backup_dir ("page_embeddings.csv"), load it and reconstruct results.
+    1) If an embedding store exists in backup_dir ("page_embeddings.npy/.json"), memory-map it
+       and reconstruct results. A legacy "page_embeddings.csv" backup is converted to a store once.
     2) Otherwise, flatten each submission's Markdown into pages (one row per page),
-       run get_embedding(...) for each page (limited by semaphore), track per‐page progress,
-       then assemble results and write a backup CSV in backup_dir.
+       embed all pages through `embedder` (packed into batched requests), track per‐page progress,
+       then assemble results and write the embedding store in backup_dir.
     3) Return a list of dicts (one per submission):
          {
            "submission_id": ...,
@@ -83,32 +66,22 @@ async def preprocess_submissions(
            "page_embeddings": np.ndarray # shape (num_pages, dim)
          }
     """
-    backup_path = None
+    embedder = embedder or get_embedding_provider(client=client, model=embedding_model)
+    store = None
     if backup_dir:
         os.makedirs(backup_dir, exist_ok=True)
-        backup_path = os.path.join(backup_dir, "page_embeddings.csv")
-
-    # If backup exists, load and reconstruct
-    if backup_path and os.path.isfile(backup_path):
-        df_backup = pd.read_csv(backup_path)
-        # Sort and group by submission
-        df_backup.sort_values(
-            ["submission_id", "original_file_name", "page_idx"],
-            inplace=True
-        )
-        results: List[Dict] = []
-        grouped = df_backup.groupby(["submission_id", "original_file_name"], sort=False)
-        for (sid, fname), group in grouped:
-            page_texts = group["page_text"].tolist()
-            embed_cols = [c for c in group.columns if c.startswith("d_")]
-            page_embs = group[embed_cols].to_numpy()
-            results.append({
-                "submission_id": sid,
-                "original_file_name": fname,
-                "pages": page_texts,
-                "page_embeddings": page_embs
-            })
-        return results
+        store = EmbeddingStore(backup_dir)
+        legacy_csv_path = os.path.join(backup_dir, "page_embeddings.csv")
+
+        # If backup exists (from the same embedding model), load and reconstruct
+        if store.exists():
+            if store.load().model == embedder.model_id:
+                return store.submissions()
+            print(f"Page embeddings in {backup_dir} were made with {store.model}; "
+                  f"re-embedding with {embedder.model_id}")
+        elif os.path.isfile(legacy_csv_path) and embedder.model_id == config.models.embedding_model:
+            store.write(*_load_legacy_csv(legacy_csv_path))
+            return store.submissions()
 
     # Otherwise, compute from scratch
     # Step A: Flatten submissions into individual pages
@@ -124,66 +97,198 @@ async def preprocess_submissions(
                 "page_text": pg
             })
 
-    pages_df = pd.DataFrame(pages_records)
-    all_texts = pages_df["page_text"].tolist()
+    all_texts = [rec["page_text"] for rec in pages_records]
 
-    # Step B: Create one semaphore‐limited embedding task per page
-    embed_tasks = [
-        get_embedding(client, text, model=embedding_model)
-        for text in all_texts
-    ]
+    # Step B: Create one embedding task per page; the provider batches them
+    embed_tasks = [embedder.embed(text) for text in all_texts]
 
     # Step C: Gather embeddings with per-page tqdm progress
     embeddings_list: List[List[float]] = await tqdm_asyncio.gather(
         *embed_tasks,
-        desc  = "Embedding pages (semaphore=5)",
+        desc  = "Embedding pages",
         total = len(embed_tasks),
         unit  = "page"
     )
+    embed_matrix = np.array(embeddings_list, dtype=np.float32).reshape(len(pages_records), -1)
 
-    pages_df["embedding"] = embeddings_list  # list of lists
+    # Step D: If backup_dir provided, write the embedding store and serve results from it
+    if store:
+        store.write(pages_records, embed_matrix, model=embedder.model_id)
+        return store.submissions()
 
-    # Step D: If backup_dir provided, write a CSV
-    if backup_path:
-        dim = len(embeddings_list[0]) if embeddings_list else 0
-        col_names = [f"d_{i}" for i in range(dim)]
-        embed_matrix = np.array(embeddings_list)  # shape: (total_pages, dim)
+    # Step E: Reassemble per-submission page_embeddings arrays (pages are contiguous per submission)
+    embed_matrix = reduce_embeddings(
+        embed_matrix, config.processing.page_embedding_dims, config.processing.page_embedding_dtype
+    )
+    return group_submissions(pages_records, embed_matrix)
 
-        df_export = pd.DataFrame({
-            "submission_id": pages_df["submission_id"],
-            "original_file_name": pages_df["original_file_name"],
-            "page_idx": pages_df["page_idx"],
-            "page_text": pages_df["page_text"]
-        })
-        # Create embeddings DataFrame in one go
-        embedding_df = pd.DataFrame(embed_matrix, columns=col_names)
 
-        # Concatenate horizontally
-        df_export = pd.concat([df_export, embedding_df], axis=1)
+def _load_legacy_csv(csv_path: str):
+    """Read a page_embeddings.csv backup (one d_i column per dimension) into (records, matrix)."""
+    df_backup = pd.read_csv(csv_path)
+    df_backup.sort_values(
+        ["submission_id", "original_file_name", "page_idx"],
+        inplace=True
+    )
+    embed_cols = [c for c in df_backup.columns if c.startswith("d_")]
+    df_backup["page_text"] = df_backup["page_text"].fillna("")
+    records = df_backup[INDEX_COLUMNS].to_dict("records")
+    return records, df_backup[embed_cols].to_numpy(dtype=np.float32)
 
-        df_export.to_csv(backup_path, index=False)
 
-    # Step E: Reassemble per-submission page_embeddings arrays
-    results: List[Dict] = []
-    for row in submissions_df.itertuples(index=False):
-        sid, fname, full_md = row.submission_id, row.original_file_name, row.markdown
-        page_texts = [p.strip() for p in full_md.split("PageBreak")]
+# --------------------------------------------------------------
+# 3b. One row per student answer, matched locally by text where possible
+# --------------------------------------------------------------
+def build_question_rows(
+    submission_data: List[Dict],
+    student_answers_df: pd.DataFrame
+) -> List[Dict]:
+    """
+    Join student answers to their submission's pages. Returns one dict per answer
+    row with submission_id, original_file_name, question_number, question_text,
+    answer_text, question_context, pages and submission_index (position in
+    submission_data).
+    """
+    rows: List[Dict] = []
+    for submission_index, sub_info in enumerate(submission_data):
+        sid   = sub_info["submission_id"]
+        fname = sub_info["original_file_name"]
+
+        sa_subset = student_answers_df[
+            (student_answers_df["submission_id"] == sid) &
+            (student_answers_df["original_file_name"] == fname)
+        ]
+        for sa_row in sa_subset.itertuples(index=False):
+            rows.append({
+                "submission_id": sid,
+                "original_file_name": fname,
+                "question_number": sa_row.question_number,
+                "question_text": str(sa_row.question_text).strip(),
+                "answer_text": str(sa_row.answer_text).strip(),
+                "question_context": str(sa_row.question_context).strip(),
+                "pages": sub_info["pages"],
+                "submission_index": submission_index,
+            })
+    return rows
+
+
+def layout_location(layout: LayoutIndex, row: Dict) -> Optional[PageLocation]:
+    """
+    Exact offset search in a document's layout index: the pages of the answer,
+    plus those of the question text and context when they are reproduced.
+    None if the answer does not occur verbatim (ignoring formatting).
+    """
+    answer = layout.find(row["answer_text"])
+    if answer is None:
+        return None
+    pages = set(answer.pages)
+    for key in ("question_text", "question_context"):
+        found = layout.find(row[key])
+        if found is not None:
+            pages.update(found.pages)
+    return PageLocation(pages=sorted(pages), confidence=1.0)
+
+
+def locate_question_pages(
+    rows: List[Dict],
+    min_confidence: float = config.processing.page_match_min_confidence,
+    layouts: Optional[Dict[str, LayoutIndex]] = None
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Assign pages without the LLM: first by exact offset search in the
+    submission's layout index (page_source "layout"), then by fuzzy text
+    matching (see page_locator.PageLocator).
+
+    Every row gets a "page_confidence". Rows whose answer is found exactly, or
+    fuzzily with at least `min_confidence`, become output records (page_source
+    "layout" or "text_match"); the rest are returned for the embedding + LLM path.
+
+    Returns:
+        Tuple[List[Dict], List[Dict]]: (matched records, unresolved rows)
+    """
+    matched: List[Dict] = []
+    unresolved: List[Dict] = []
+    locators: Dict[int, PageLocator] = {}
+    layouts = layouts or {}
+    for row in rows:
+        source = "layout"
+        layout = layouts.get(row["submission_id"])
+        location = layout_location(layout, row) if layout is not None else None
+        if location is None:
+            source = "text_match"
+            locator = locators.get(row["submission_index"])
+            if locator is None:
+                locator = locators[row["submission_index"]] = PageLocator(row["pages"])
+            location = locator.locate(
+                row["answer_text"], row["question_text"], row["question_context"], min_confidence
+            )
+        row["page_confidence"] = round(location.confidence, 3)
+        if location.pages and location.confidence >= min_confidence:
+            matched.append({
+                "submission_id": row["submission_id"],
+                "original_file_name": row["original_file_name"],
+                "question_number": row["question_number"],
+                "pages": json.dumps(location.pages),
+                "page_source": source,
+                "page_confidence": row["page_confidence"],
+            })
+        else:
+            unresolved.append(row)
+    return matched, unresolved
+
 
-        sub_df = pages_df[pages_df["submission_id"] == sid].sort_values("page_idx")
-        page_embs_np = np.vstack(sub_df["embedding"].tolist())
+# --------------------------------------------------------------
+# 3c. Candidate pages for every question (vectorized similarity)
+# --------------------------------------------------------------
+async def select_candidate_pages(
+    rows: List[Dict],
+    submission_data: List[Dict],
+    embedder: EmbeddingProvider,
+    top_k: int = config.processing.top_k_pages
+) -> List[Dict]:
+    """
+    For every row (see build_question_rows), set "candidate_pages": the union of
+    the top_k pages by similarity to its question text, answer and context.
+
+    All (question, answer, context) texts are embedded in one pass through the
+    shared batcher (duplicates such as question text are sent once). Embeddings
+    are normalized once, reweighted per submission by the provider (IDF for the
+    local provider), and each submission's rows are scored against its pages
+    with one matrix product.
+
+    Returns:
+        List[Dict]: `rows`, with candidate_pages (sorted 1-based page numbers) set.
+    """
+    if not rows:
+        return rows
+
+    texts = [row[key] for row in rows for key in ("question_text", "answer_text", "question_context")]
+    embeddings = await tqdm_asyncio.gather(
+        *(embedder.embed(text) for text in texts),
+        desc  = "Embedding questions",
+        total = len(texts),
+        unit  = "text"
+    )
+    queries = np.asarray(embeddings, dtype=np.float32).reshape(len(rows), 3, -1)
+
+    # Page embeddings may be stored shortened; compare on the same leading dimensions
+    dim = next((s["page_embeddings"].shape[1] for s in submission_data if len(s["page_embeddings"])), queries.shape[2])
+    queries = normalize_rows(queries[:, :, :dim])
 
-        results.append({
-            "submission_id": sid,
-            "original_file_name": fname,
-            "pages": page_texts,
-            "page_embeddings": page_embs_np
-        })
+    row_groups: Dict[int, List[int]] = defaultdict(list)
+    for row_id, row in enumerate(rows):
+        row_groups[row["submission_index"]].append(row_id)
 
-    return results
+    for submission_index, row_ids in row_groups.items():
+        pages_np, row_queries = embedder.reweight(submission_data[submission_index]["page_embeddings"], queries[row_ids])
+        pages_np = normalize_rows(pages_np)
+        for row_id, pages in zip(row_ids, candidate_pages(normalize_rows(row_queries), pages_np, top_k)):
+            rows[row_id]["candidate_pages"] = pages
+    return rows
 
 
 # --------------------------------------------------------------
-# 4. Single-question processing (LLM + embed Q/A/C)
+# 4. Single-question processing (LLM page selection)
 # --------------------------------------------------------------
 async def process_question_task(
     submission_id: str,
@@ -193,50 +298,28 @@ async def process_question_task(
     answer_text: str,
     question_context: str,
     pages: List[str],
-    page_embeddings_np: np.ndarray,
+    all_candidate_pages: List[int],
     client: AsyncAzureOpenAI,
-    embedding_model: str,
     model: str,
-    top_k: int,
     system_prompt: str,
     token_tracker=None
 ) -> Dict:
     """
-    1) Acquire embed‐semaphore‐limited embeddings of (question, answer, context) concurrently.
-    2) Compute cosine similarities, pick top_k pages, union them.
-    3) Call LLM once to format JSON response.
+    Call the LLM once, limited by question‐semaphore, to pick the pages needed for
+    one question from `all_candidate_pages` (the union of the top_k pages by
+    question, answer and context similarity, chosen in select_candidate_pages).
     """
     async with _question_semaphore:
-        qac_embeddings = await asyncio.gather(
-            get_embedding(client, question_text,    model=embedding_model),
-            get_embedding(client, answer_text,      model=embedding_model),
-            get_embedding(client, question_context, model=embedding_model)
-        )
-        emb_qtext   = np.array(qac_embeddings[0]).reshape(1, -1)
-        emb_answer  = np.array(qac_embeddings[1]).reshape(1, -1)
-        emb_context = np.array(qac_embeddings[2]).reshape(1, -1)
-
-        sims_qtext       = cosine_similarity(emb_qtext, page_embeddings_np)[0]
-        topk_qtext_idxs  = sims_qtext.argsort()[-top_k:][::-1]
-        candidate_qtext_pages = [i + 1 for i in topk_qtext_idxs]
-
-        sims_answer      = cosine_similarity(emb_answer, page_embeddings_np)[0]
-        topk_ans_idxs    = sims_answer.argsort()[-top_k:][::-1]
-        candidate_ans_pages = [i + 1 for i in topk_ans_idxs]
-
-        sims_context     = cosine_similarity(emb_context, page_embeddings_np)[0]
-        topk_ctx_idxs    = sims_context.argsort()[-top_k:][::-1]
-        candidate_ctx_pages = [i + 1 for i in topk_ctx_idxs]
-
-        all_candidate_pages = sorted(
-            set(candidate_qtext_pages + candidate_ans_pages + candidate_ctx_pages)
-        )
-
         combined_candidates_text = ""
         for page_num in all_candidate_pages:
             pg_text = pages[page_num - 1].replace('"', '\\"')
             combined_candidates_text += f'Page {page_num}:\n"{pg_text}"\n\n'
 
+        # Escaped outside the f-string (a backslash in an f-string expression needs Python 3.12)
+        question_text_escaped = question_text.replace('"', '\\"')
+        question_context_escaped = question_context.replace('"', '\\"')
+        answer_text_escaped = answer_text.replace('"', '\\"')
+
         user_prompt = f"""
 Below are the top {len(all_candidate_pages)} candidate pages (by embedding similarity)
 for Question {qn}. Each page is labeled with its page number and its entire text content.
@@ -246,13 +329,13 @@ for Question {qn}. Each page is labeled with its page number and its entire text
 Question Number: {qn}
 
 1) Question Text:
-"{question_text.replace('"', '\\"')}"
+"{question_text_escaped}"
 
 2) Question Context (exact text needed to solve the problem):
-"{question_context.replace('"', '\\"')}"
+"{question_context_escaped}"
 
 3) Student Answer (exact text):
-"{answer_text.replace('"', '\\"')}"
+"{answer_text_escaped}"
 
 From among these pages, identify which page numbers are required to fully capture:
   - the entire question text,
@@ -268,7 +351,7 @@ Return JSON with:
 
         # --- Token tracking ---
         if token_tracker:
-            token_tracker.add("map_questions_to_pages_llm", system_prompt+user_prompt)
+            token_tracker.add("map_questions_to_pages_llm", (system_prompt, user_prompt))
         # ----------------------
 
         try:
@@ -294,6 +377,124 @@ Return JSON with:
         }
 
 
+# --------------------------------------------------------------
+# 4b. Per-submission processing (one LLM call for all of a submission's questions)
+# --------------------------------------------------------------
+async def process_submission_task(
+    submission_id: str,
+    file_name: str,
+    rows: List[Dict],
+    pages: List[str],
+    client: AsyncAzureOpenAI,
+    model: str,
+    system_prompt: str,
+    token_tracker=None
+) -> List[Dict]:
+    """
+    Call the LLM once, limited by question‐semaphore, to pick the pages for every
+    row in `rows` (one submission's questions). Each page in the union of the rows'
+    candidate_pages is sent once; each question lists its own candidates, and
+    returned pages outside a question's candidates are dropped.
+
+    Questions are numbered 1..len(rows) in the prompt and answered by that item
+    number, so free-text question numbers ("1", "1.0", "Q1") never have to
+    match. A question the call does not answer (a failed call, a missing
+    entry or no valid page) falls back to all of its candidate pages.
+    """
+    async with _question_semaphore:
+        all_candidate_pages = sorted({p for row in rows for p in row["candidate_pages"]})
+
+        combined_candidates_text = ""
+        for page_num in all_candidate_pages:
+            pg_text = pages[page_num - 1].replace('"', '\\"')
+            combined_candidates_text += f'Page {page_num}:\n"{pg_text}"\n\n'
+
+        questions_text = ""
+        for item, row in enumerate(rows, start=1):
+            question_text_escaped = row["question_text"].replace('"', '\\"')
+            question_context_escaped = row["question_context"].replace('"', '\\"')
+            answer_text_escaped = row["answer_text"].replace('"', '\\"')
+            questions_text += f"""
+Item {item}
+Question Number: {row["question_number"]}
+Candidate Pages: {row["candidate_pages"]}
+
+1) Question Text:
+"{question_text_escaped}"
+
+2) Question Context (exact text needed to solve the problem):
+"{question_context_escaped}"
+
+3) Student Answer (exact text):
+"{answer_text_escaped}"
+"""
+
+        user_prompt = f"""
+Below are {len(all_candidate_pages)} candidate pages (by embedding similarity) from one
+student submission. Each page is labeled with its page number and its entire text content.
+
+{combined_candidates_text}
+
+The submission answers the following {len(rows)} questions, numbered as items 1 to {len(rows)}.
+Each question lists its own candidate pages.
+{questions_text}
+
+For every question, identify which of its candidate page numbers are required to fully capture:
+  - the entire question text,
+  - the entire question context,
+  - and the entire student answer.
+
+Return JSON with:
+{{
+  "questions": [
+    {{"item": <item number>, "pages": [<list of page ints>]}}
+  ]
+}}
+with exactly one entry per item listed above.
+"""
+
+        # --- Token tracking ---
+        if token_tracker:
+            token_tracker.add("map_questions_to_pages_llm", (system_prompt, user_prompt))
+        # ----------------------
+
+        try:
+            resp = await client.beta.chat.completions.parse(
+                model = model,
+                messages = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user",   "content": user_prompt}
+                ],
+                response_format = SubmissionPagesResponse
+            )
+            parsed = SubmissionPagesResponse.model_validate_json(resp.choices[0].message.content)
+            chosen = {entry.item: entry.pages for entry in parsed.questions}
+            failed = False
+        except Exception as e:
+            print(f"Page mapping failed for submission {submission_id}: {e}; using candidate pages")
+            chosen = {}
+            failed = True
+
+        records = []
+        fallbacks = []
+        for item, row in enumerate(rows, start=1):
+            allowed = set(row["candidate_pages"])
+            chosen_pages = [p for p in chosen.get(item, []) if p in allowed]
+            if not chosen_pages:
+                chosen_pages = sorted(allowed)
+                fallbacks.append(str(row["question_number"]))
+            records.append({
+                "submission_id": submission_id,
+                "original_file_name": file_name,
+                "question_number": row["question_number"],
+                "pages": json.dumps(chosen_pages),
+            })
+        if fallbacks and not failed:
+            print(f"Page mapping for submission {submission_id} had no pages for question(s) "
+                  f"{', '.join(fallbacks)}; using their candidate pages")
+        return records
+
+
 # --------------------------------------------------------------
 # 5. Main function with question‐level tqdm tracking
 # --------------------------------------------------------------
@@ -307,91 +508,128 @@ async def map_questions_to_pages_llm(
     output_csv: str = "output.csv",
     encoder_name: str = config.models.encoder_model,
     backup_dir: Optional[str] = None,
-    token_tracker=None
+    token_tracker=None,
+    min_text_match_confidence: float = config.processing.page_match_min_confidence,
+    mapping_mode: str = config.processing.page_mapping_mode,
+    embedding_provider: str = config.processing.embedding_provider,
+    layouts: Optional[Dict[str, LayoutIndex]] = None
 ) -> pd.DataFrame:
     """
     1) Precompute page splits & embeddings per submission (stage 1),
-       using semaphore-limited per-page embeddings and per-page tqdm.
-       If backup_dir contains a CSV, load from it instead of re-embedding.
-    2) Create one async task per question (batching question+answer+context),
-       limited by question‐semaphore.
-    3) Use tqdm_asyncio.as_completed for per-question progress.
+       using batched page embeddings from `embedding_provider` ("azure" or the
+       offline "local" backend) and per-page tqdm.
+       If backup_dir contains an embedding store, load from it instead of re-embedding.
+    2) Locate each answer's pages by exact offset search in the submission's layout
+       index (`layouts`, by submission_id; see layout_index.load_layout_indexes), then
+       by fuzzy text matching; rows matched exactly or with at least
+       `min_text_match_confidence` skip the LLM (set it above 1 to always use the LLM).
+    3) For the remaining rows, embed question text, answer and context, select
+       candidate pages per submission in one vectorized step, and create async LLM
+       tasks limited by question‐semaphore: one per question (mapping_mode="question")
+       or one per submission covering all its remaining questions
+       (mapping_mode="submission"), so shared candidate pages are sent once.
+    4) Use tqdm_asyncio.as_completed for per-task progress.
+
+    The output has one row per question with pages (JSON list), page_source
+    ("layout", "text_match" or "llm") and page_confidence (answer text-match confidence).
     """
+    if mapping_mode not in PAGE_MAPPING_MODES:
+        raise ValueError(f"mapping_mode must be one of {PAGE_MAPPING_MODES}, got {mapping_mode!r}")
+
     # Stage 1: split + embed pages (with optional backup)
+    embedder = get_embedding_provider(embedding_provider, client=client, model=embedding_model)
     submission_data = await preprocess_submissions(
-        submissions_df, client, embedding_model, backup_dir
+        submissions_df, client, embedding_model, backup_dir, embedder=embedder
     )
 
     # Initialize encoder and system prompt tokens
-    system_prompt = (
-        "You are a strict JSON formatter. Only output valid JSON.\n"
-        "Return exactly one JSON object with keys:\n"
-        "  question_number (string),\n"
-        "  pages (array of ints)\n"
-        "No commentary, no extra keys."
-    )
+    if mapping_mode == "submission":
+        system_prompt = (
+            "You are a strict JSON formatter. Only output valid JSON.\n"
+            "Return exactly one JSON object with key:\n"
+            "  questions (array of objects with keys item (int) and pages (array of ints))\n"
+            "No commentary, no extra keys."
+        )
+    else:
+        system_prompt = (
+            "You are a strict JSON formatter. Only output valid JSON.\n"
+            "Return exactly one JSON object with keys:\n"
+            "  question_number (string),\n"
+            "  pages (array of ints)\n"
+            "No commentary, no extra keys."
+        )
 
-    # Stage 2: build a list of question-level tasks wrapped in question‐semaphore
-    question_tasks = []
-    for sub_info in submission_data:
-        sid               = sub_info["submission_id"]
-        fname             = sub_info["original_file_name"]
-        pages             = sub_info["pages"]
-        page_embeddings_np= sub_info["page_embeddings"]
+    # Stage 2: assign pages by text matching; only low-confidence rows need embeddings and the LLM
+    rows = build_question_rows(submission_data, student_answers_df)
+    results, llm_rows = locate_question_pages(rows, min_text_match_confidence, layouts)
+    by_layout = sum(1 for record in results if record["page_source"] == "layout")
+    print(f"Located pages for {len(results)}/{len(rows)} questions by text match "
+          f"({by_layout} by exact layout offset); {len(llm_rows)} sent to the LLM")
+
+    # Stage 3: embed every remaining question/answer/context (batched, cached) and pick candidate pages
+    llm_rows = await select_candidate_pages(llm_rows, submission_data, embedder, top_k)
+
+    async def llm_task(row: Dict) -> List[Dict]:
+        record = await process_question_task(
+            submission_id       = row["submission_id"],
+            file_name           = row["original_file_name"],
+            qn                  = row["question_number"],
+            question_text       = row["question_text"],
+            answer_text         = row["answer_text"],
+            question_context    = row["question_context"],
+            pages               = row["pages"],
+            all_candidate_pages = row["candidate_pages"],
+            client              = client,
+            model               = model,
+            system_prompt       = system_prompt,
+            token_tracker       = token_tracker
+        )
+        return [record]
+
+    async def submission_llm_task(sub_rows: List[Dict]) -> List[Dict]:
+        return await process_submission_task(
+            submission_id = sub_rows[0]["submission_id"],
+            file_name     = sub_rows[0]["original_file_name"],
+            rows          = sub_rows,
+            pages         = sub_rows[0]["pages"],
+            client        = client,
+            model         = model,
+            system_prompt = system_prompt,
+            token_tracker = token_tracker
+        )
 
-        sa_subset = student_answers_df[
-            (student_answers_df["submission_id"] == sid) &
-            (student_answers_df["original_file_name"] == fname)
-        ]
-        for _, sa_row in sa_subset.iterrows():
-            qn              = sa_row["question_number"]
-            question_text   = str(sa_row["question_text"]).strip()
-            answer_text     = str(sa_row["answer_text"]).strip()
-            question_context= str(sa_row["question_context"]).strip()
-
-            async def sem_task(
-                sid=sid,
-                fname=fname,
-                qn=qn,
-                question_text=question_text,
-                answer_text=answer_text,
-                question_context=question_context,
-                pages=pages,
-                page_embeddings_np=page_embeddings_np
-            ):
-                return await process_question_task(
-                    submission_id     = sid,
-                    file_name         = fname,
-                    qn                = qn,
-                    question_text     = question_text,
-                    answer_text       = answer_text,
-                    question_context  = question_context,
-                    pages             = pages,
-                    page_embeddings_np= page_embeddings_np,
-                    client            = client,
-                    embedding_model   = embedding_model,
-                    model             = model,
-                    top_k             = top_k,
-                    system_prompt     = system_prompt,
-                    token_tracker     = token_tracker
-                )
-                
-
-            question_tasks.append(sem_task())
-
-    # Stage 3: run all question tasks with tqdm_asyncio progress bar
-    results: List[Dict] = []
+    # Build a list of question- or submission-level tasks wrapped in question‐semaphore
+    if mapping_mode == "submission":
+        rows_by_submission: Dict[int, List[Dict]] = defaultdict(list)
+        for row in llm_rows:
+            rows_by_submission[row["submission_index"]].append(row)
+        llm_tasks = [submission_llm_task(sub_rows) for sub_rows in rows_by_submission.values()]
+    else:
+        llm_tasks = [llm_task(row) for row in llm_rows]
+    confidence = {
+        (row["submission_id"], row["original_file_name"], row["question_number"]): row["page_confidence"]
+        for row in llm_rows
+    }
+
+    # Stage 4: run all LLM tasks with tqdm_asyncio progress bar
     for coro in tqdm_asyncio.as_completed(
-        question_tasks,
-        total = len(question_tasks),
-        desc  = "Processing each question"
+        llm_tasks,
+        total = len(llm_tasks),
+        desc  = f"Processing each {mapping_mode}"
     ):
-        record = await coro
-        results.append(record)
+        for record in await coro:
+            record["page_source"] = "llm"
+            record["page_confidence"] = confidence[
+                (record["submission_id"], record["original_file_name"], record["question_number"])
+            ]
+            results.append(record)
 
     df_out = pd.DataFrame.from_records(results)
     df_out.to_csv(output_csv, index=False)
 
+    await embedder.flush()
+    embedder.print_stats()
+
     if token_tracker:
         token_tracker.print_process("map_questions_to_pages_llm")
     return df_out
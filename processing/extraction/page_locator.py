@@ -0,0 +1,117 @@
+"""
+Deterministic page locator for page mapping.
+
+A student's extracted answer_text is usually an almost verbatim copy of text
+on one or two pages of their PageBreak-split markdown, so the pages can
+normally be found without an LLM. Texts are normalized to lowercase word
+tokens and split into overlapping word n-grams (shingles). Every shingle of
+the answer that also occurs in the document votes for an alignment offset
+(document position minus answer position), and the shingles that agree with
+the winning offset form the matched span. The locator then returns the pages
+that span covers.
+
+Confidence is the fraction of the answer's shingles that fall in the
+matched span, so edits, OCR noise and reordering lower it smoothly. Rows
+below the confidence threshold (including answers too short to match
+reliably) are left to the LLM.
+"""
+
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from config import config
+
+SHINGLE_WORDS = 3
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens with markdown and punctuation dropped."""
+    return _WORD_RE.findall(str(text).lower())
+
+
+@dataclass
+class TextMatch:
+    pages: List[int]     # 1-based page numbers covered by the matched span
+    confidence: float    # fraction of the text's shingles found in order
+
+
+@dataclass
+class PageLocation:
+    """Page assignment for one question row."""
+    pages: List[int] = field(default_factory=list)
+    confidence: float = 0.0   # confidence of the answer_text match
+
+
+class PageLocator:
+    """
+    Fuzzy, positional text matcher over one submission's pages.
+
+    Args:
+        pages (List[str]): The submission's page texts, in page order.
+        shingle_words (int): Words per shingle.
+    """
+
+    def __init__(self, pages: List[str], shingle_words: int = SHINGLE_WORDS):
+        self.n = shingle_words
+        self.tokens: List[str] = []
+        self.token_pages: List[int] = []
+        for page_num, page in enumerate(pages, start=1):
+            words = tokenize(page)
+            self.tokens.extend(words)
+            self.token_pages.extend([page_num] * len(words))
+
+        self.positions: Dict[Tuple[str, ...], List[int]] = defaultdict(list)
+        for pos in range(len(self.tokens) - self.n + 1):
+            self.positions[tuple(self.tokens[pos:pos + self.n])].append(pos)
+
+    def match(self, text: str, min_words: int = config.processing.page_match_min_words) -> TextMatch:
+        """Locate `text` in the document; texts shorter than `min_words` never match."""
+        words = tokenize(text)
+        if len(words) < max(min_words, self.n):
+            return TextMatch(pages=[], confidence=0.0)
+
+        shingles = [tuple(words[i:i + self.n]) for i in range(len(words) - self.n + 1)]
+        # Tolerate insertions/deletions: offsets are voted in bins of this width
+        slack = max(2, len(words) // 10)
+
+        votes = Counter()
+        hits: List[Tuple[int, int]] = []  # (answer position, document position)
+        for i, shingle in enumerate(shingles):
+            for pos in self.positions.get(shingle, ()):
+                hits.append((i, pos))
+                votes[(pos - i) // slack] += 1
+        if not hits:
+            return TextMatch(pages=[], confidence=0.0)
+
+        best_bin = max(votes, key=lambda b: (votes[b] + votes.get(b - 1, 0) + votes.get(b + 1, 0), -b))
+        offset_lo, offset_hi = (best_bin - 1) * slack, (best_bin + 2) * slack
+        aligned = [(i, pos) for i, pos in hits if offset_lo <= pos - i < offset_hi]
+
+        matched = len({i for i, _ in aligned})
+        start = min(pos for _, pos in aligned)
+        end = max(pos for _, pos in aligned) + self.n
+        pages = sorted(set(self.token_pages[start:end]))
+        return TextMatch(pages=pages, confidence=matched / len(shingles))
+
+    def locate(
+        self,
+        answer_text: str,
+        question_text: str = "",
+        question_context: str = "",
+        min_confidence: float = config.processing.page_match_min_confidence,
+    ) -> PageLocation:
+        """
+        Pages holding the answer, plus the question text and context when they
+        are reproduced in the submission. Confidence is that of the answer.
+        """
+        answer = self.match(answer_text)
+        pages = set(answer.pages)
+        for text in (question_text, question_context):
+            found = self.match(text)
+            if found.confidence >= min_confidence:
+                pages.update(found.pages)
+        return PageLocation(pages=sorted(pages), confidence=answer.confidence)
+
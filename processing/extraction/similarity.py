@@ -0,0 +1,61 @@
+"""
+Vectorized page retrieval for page mapping.
+
+Embeddings are L2-normalized once, so cosine similarity becomes a plain dot
+product: every (question, answer, context) query of a submission is scored
+against all of its pages in a single matrix product, and the top-k pages per
+query are picked with argpartition rather than a full sort.
+"""
+
+from typing import List
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Return `matrix` as float32 with every row scaled to unit length (zero rows stay zero)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def top_k_indices(queries: np.ndarray, pages: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the `k` most similar pages for each query, best first.
+
+    Args:
+        queries (np.ndarray): Normalized query embeddings, shape (n_queries, dim).
+        pages (np.ndarray): Normalized page embeddings, shape (n_pages, dim).
+        k (int): Pages to keep per query (all pages if there are fewer).
+
+    Returns:
+        np.ndarray: Shape (n_queries, min(k, n_pages)).
+    """
+    sims = queries @ pages.T
+    k = min(k, sims.shape[1])
+    if k == 0:
+        return np.empty((sims.shape[0], 0), dtype=np.intp)
+    if k < sims.shape[1]:
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+    order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def candidate_pages(query_groups: np.ndarray, pages: np.ndarray, k: int) -> List[List[int]]:
+    """
+    Union of the top-k pages over each group of queries.
+
+    Args:
+        query_groups (np.ndarray): Normalized embeddings, shape (n_groups, n_queries_per_group, dim)
+            (e.g. one group of question/answer/context per question row).
+        pages (np.ndarray): Normalized page embeddings of one submission, shape (n_pages, dim).
+        k (int): Pages kept per query.
+
+    Returns:
+        List[List[int]]: Sorted 1-based page numbers per group.
+    """
+    n_groups, per_group, dim = query_groups.shape
+    top = top_k_indices(query_groups.reshape(-1, dim), pages, k).reshape(n_groups, -1)
+    return [sorted({int(i) + 1 for i in row}) for row in top]
@@ -0,0 +1,132 @@
+"""
+Offline grading through the Batch API.
+
+The full grading pass and the quick grades build exactly the requests
+grade_questions and grade_questions_multi_sample would send, but instead of going
+through the rate-limited chat endpoint they are submitted together as batch
+jobs (see helpers.batch_jobs) and the responses are joined back to their rows
+by custom_id. A large course then grades overnight without being capped by
+the interactive per-minute limits, and an interrupted run resumes the jobs it
+already submitted.
+"""
+
+import asyncio
+
+import pandas as pd
+from openai import AsyncAzureOpenAI
+from openai.types.chat import ChatCompletion
+
+from config import config
+from helpers.batch_jobs import run_batch
+from helpers.page_image_cache import page_image_cache
+from processing.grading.image_prep import ImageOptions
+from processing.grading.llm_grader import (
+    GradingImages, add_agreement_stats, failed_grade, grading_request, merge_grading_inputs, parse_grading_output,
+    parse_simple_output, question_major, simple_grading_request,
+)
+
+
+async def grade_questions_offline(
+    df_questions: pd.DataFrame,
+    std_questions: pd.DataFrame,
+    rubric: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    state_path: str,
+    model: str = "gpt-4",
+    page_mapping: pd.DataFrame = None,
+    img_dir: str = None,
+    token_tracker=None,
+    page_images=None,
+    quick_samples: int = config.processing.quick_grade_samples,
+    sampling: str = config.processing.quick_grade_sampling,
+    image_cache=page_image_cache,
+    image_detail: str = config.processing.grading_image_detail,
+    image_token_budget: int = config.processing.grading_image_token_budget,
+    image_options: ImageOptions = ImageOptions()
+) -> pd.DataFrame:
+    """
+    Grade every (submission, question) row through the Batch API: the full
+    grading pass plus `quick_samples` quick grades, submitted as one set of
+    jobs. With sampling "n" each row's quick grades are one request for
+    `quick_samples` choices; with "fanout", one request per sample.
+
+    Args:
+        openai_client: Client to submit batch jobs with (see helpers.batch_jobs.batch_client).
+        state_path (str): JSON file recording submitted jobs, so a restart resumes them.
+        model (str): Model (for Azure, a global-batch deployment) named in every request.
+        quick_samples (int): Quick grades per row, added as grade_1..grade_k.
+        sampling (str): "n" or "fanout" (see llm_grader.grade_questions_multi_sample).
+
+    Returns:
+        pd.DataFrame: The columns of grade_questions, plus grade_1..grade_k and the
+        agreement columns of add_agreement_stats.
+    """
+    images_source = GradingImages(page_images, img_dir, image_cache, image_detail, image_token_budget, image_options)
+    rows = question_major(merge_grading_inputs(df_questions, std_questions, rubric, page_mapping)).to_dict("records")
+
+    # Same requests (and question-major order) as the interactive passes
+    full_requests = await asyncio.gather(*(grading_request(row, images_source) for row in rows))
+    requests = []
+    for i, (messages, tokens) in enumerate(full_requests):
+        requests.append((f"grade-{i}", {"model": model, "messages": messages}))
+        if token_tracker:
+            token_tracker.add("grading", tokens)
+    use_n = sampling == "n" and quick_samples > 1
+    quick_ids = [f"quick-{i}" for i in range(len(rows))] if use_n else [
+        f"quick{n}-{i}" for i in range(len(rows)) for n in range(1, quick_samples + 1)
+    ]
+    for custom_id in quick_ids:
+        row = rows[int(custom_id.rsplit("-", 1)[1])]
+        messages, tokens = simple_grading_request(row)
+        body = {"model": model, "messages": messages}
+        if use_n:
+            body["n"] = quick_samples
+        requests.append((custom_id, body))
+        if token_tracker:
+            token_tracker.add("fast_grading", tokens)
+    images_source.print_stats()
+
+    responses = await run_batch(openai_client, requests, state_path, description="Grading Questions")
+
+    def contents(custom_id, process_name):
+        body = responses.get(custom_id)
+        if body is None:
+            return []
+        response = ChatCompletion.model_validate(body)
+        if token_tracker:
+            token_tracker.add_usage(process_name, response.usage)
+        return [choice.message.content for choice in response.choices]
+
+    results = []
+    for i, row in enumerate(rows):
+        try:
+            llm_outputs = contents(f"grade-{i}", "grading")
+            if not llm_outputs:
+                raise ValueError("no batch result")
+            result = parse_grading_output(llm_outputs[0], row)
+        except Exception as e:
+            print(f"Error grading submission_id={row['submission_id']}, question={row['question_number']}: {e}")
+            result = failed_grade(row)
+
+        if use_n:
+            outputs = contents(f"quick-{i}", "fast_grading")
+        else:
+            outputs = [
+                next(iter(contents(f"quick{n}-{i}", "fast_grading")), None) for n in range(1, quick_samples + 1)
+            ]
+        outputs = (list(outputs) + [None] * quick_samples)[:quick_samples]
+        for n, llm_output in enumerate(outputs, start=1):
+            try:
+                result[f"grade_{n}"] = pd.NA if llm_output is None else parse_simple_output(llm_output)
+            except Exception as e:
+                print(e)
+                result[f"grade_{n}"] = pd.NA
+        results.append(result)
+
+    if token_tracker:
+        token_tracker.print_process("grading")
+        token_tracker.print_process("fast_grading")
+    results_df = pd.DataFrame(results)
+    if quick_samples:
+        add_agreement_stats(results_df, quick_samples)
+    return results_df
@@ -4,13 +4,9 @@ import asyncio
 import pandas as pd
 from tqdm.asyncio import tqdm_asyncio
 from openai import AsyncAzureOpenAI
-from aiolimiter import AsyncLimiter
-import tiktoken
 from config import config
-
-# Setup rate limiters using centralized config
-request_limiter = AsyncLimiter(config.rate_limits.requests_per_minute, 60)
-token_limiter = AsyncLimiter(config.rate_limits.tokens_per_minute, 60)
+from helpers.tokenizer import get_tokenizer
+from helpers.rate_limiter import rate_limiter
 
 async def generate_subquestion_feedback(
     df_feedback: pd.DataFrame,
@@ -39,8 +35,8 @@ async def generate_subquestion_feedback(
     df["needs_human_eval"] = df["needs_human_eval"].astype(bool)
     df["question_feedback"] = ""
 
-    # Initialize tiktoken encoder
-    encoder = tiktoken.get_encoding(config.models.encoder_model)
+    # Shared tokenizer (cached encoder, memoized counts)
+    tokenizer = get_tokenizer()
 
     # --------------------------------------------------------------
     # 2.  System prompt (unchanged)
@@ -100,7 +96,7 @@ Return **only** this JSON, wrapped in triple back-ticks:
 {"question_feedback": "<your feedback here or empty string>"}
 """
     combined_system = SYSTEM_PROMPT
-    system_tokens = len(encoder.encode(combined_system))
+    system_tokens = tokenizer.count(combined_system, shared=True)
 
     # --------------------------------------------------------------
     # 3.  Process each row with rate limiting and exact token counts
@@ -119,19 +115,19 @@ Return **only** this JSON, wrapped in triple back-ticks:
         user_prompt = f"Please write casual feedback for the sub‑question below \n\n{markdown}"
 
         try:
-            user_tokens = len(encoder.encode(user_prompt))
+            user_tokens = tokenizer.count(user_prompt)
             total_tokens = system_tokens + user_tokens
             if token_tracker:
                 token_tracker.add("feedback_generation", total_tokens)
-            async with request_limiter:
-                await token_limiter.acquire(total_tokens)
-                response = await openai_client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": combined_system},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                )
+            response = await rate_limiter.chat(
+                openai_client,
+                total_tokens,
+                model=model,
+                messages=[
+                    {"role": "system", "content": combined_system},
+                    {"role": "user", "content": user_prompt},
+                ],
+            )
 
             content = response.choices[0].message.content
             match = re.search(r"```(?:json)?(.*?)```", content, re.DOTALL)
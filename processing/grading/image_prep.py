@@ -0,0 +1,158 @@
+"""
+Token-aware preparation of page images for vision grading.
+
+Vision input is billed by tiles, not bytes. For "high" detail the service
+first scales an image to fit in a 2048x2048 square, then so its shortest side
+is at most 768px, and charges 170 tokens per 512x512 tile plus 85; a "low"
+detail image is a flat 85 tokens at up to 512x512. Page renders are 544x704,
+so they land just over a tile boundary: 2x2 tiles (765 tokens) where 1x2
+(425) would lose almost nothing.
+
+prepare_image turns a rendered page into what is actually sent:
+
+1. grayscale (student work is read, not admired)
+2. whitespace margins trimmed to the inked area plus a small pad
+3. resized to the size the service would use anyway for the chosen detail,
+   and snapped down to a tile boundary when that costs at most `tile_snap`
+   of the resolution
+4. recompressed as JPEG
+
+and reports its final dimensions and real token cost, which the rate
+limiter is budgeted from. choose_details picks the detail level of each
+image of a request so its vision tokens stay within a budget.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from config import config
+from helpers.page_image_cache import EncodedImage, to_data_url
+
+TILE_SIZE = 512
+TILE_TOKENS = 170
+BASE_TOKENS = 85
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+LOW_DETAIL_MAX_SIDE = 512
+
+IMAGE_DETAILS = ("auto", "high", "low")
+MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    """How page images are prepared (hashable, so it can key the image cache)."""
+    format: str = config.processing.grading_image_format
+    quality: int = config.processing.grading_image_quality
+    grayscale: bool = config.processing.grading_image_grayscale
+    trim: bool = config.processing.grading_image_trim
+    tile_snap: float = config.processing.grading_image_tile_snap
+    ink_threshold: int = 235  # pixels darker than this (0-255) count as content
+    trim_padding: int = 8
+
+
+def api_dimensions(width: int, height: int, detail: str = "high") -> Tuple[int, int]:
+    """Size the service scales an image to before tiling (it never upscales)."""
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_MAX_SIDE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+        scale *= min(1.0, HIGH_DETAIL_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Input tokens charged for a `width` x `height` image at `detail`."""
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = api_dimensions(width, height, detail)
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def target_size(width: int, height: int, detail: str = "high", tile_snap: float = 0.0) -> Tuple[int, int]:
+    """
+    Size to send an image at: what the service would scale it to, shrunk
+    further (by at most `tile_snap`) if that drops a row or column of tiles.
+    """
+    width, height = api_dimensions(width, height, detail)
+    if detail == "low" or not tile_snap:
+        return width, height
+
+    best = (vision_tokens(width, height), -1.0, width, height)
+    for side in (width, height):
+        tiles = math.ceil(side / TILE_SIZE)
+        if tiles < 2:
+            continue
+        scale = (tiles - 1) * TILE_SIZE / side
+        if scale >= 1 - tile_snap:
+            w, h = max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+            best = min(best, (vision_tokens(w, h), -scale, w, h))
+    return best[2], best[3]
+
+
+def _trim(pix: "fitz.Pixmap", threshold: int, padding: int) -> "fitz.Pixmap":
+    """Crop `pix` to the bounding box of its content plus `padding` pixels."""
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    samples = samples[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    ink = samples.min(axis=2) < threshold
+    rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        return pix  # blank page
+    y0, y1 = max(0, int(rows[0]) - padding), min(pix.height, int(rows[-1]) + 1 + padding)
+    x0, x1 = max(0, int(cols[0]) - padding), min(pix.width, int(cols[-1]) + 1 + padding)
+    if (x0, y0, x1, y1) == (0, 0, pix.width, pix.height):
+        return pix
+    cropped = np.ascontiguousarray(samples[y0:y1, x0:x1])
+    return fitz.Pixmap(pix.colorspace, x1 - x0, y1 - y0, cropped.tobytes(), False)
+
+
+def prepare_image(image: bytes, detail: str = "high", options: ImageOptions = ImageOptions()) -> EncodedImage:
+    """
+    Prepare rendered page bytes (PNG or JPEG) for a vision request at `detail`
+    ("high" or "low"). CPU-bound; run it off the event loop.
+    """
+    pix = fitz.Pixmap(image)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if options.grayscale and pix.n > 1:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)
+    if options.trim:
+        pix = _trim(pix, options.ink_threshold, options.trim_padding)
+
+    width, height = target_size(pix.width, pix.height, detail, options.tile_snap)
+    if (width, height) != (pix.width, pix.height):
+        pix = fitz.Pixmap(pix, width, height)
+
+    if options.format == "jpeg":
+        data = pix.tobytes("jpeg", jpg_quality=options.quality)
+    else:
+        data = pix.tobytes("png")
+    return EncodedImage(
+        url=to_data_url(data, MIME_TYPES[options.format]),
+        width=pix.width,
+        height=pix.height,
+        detail=detail,
+        tokens=vision_tokens(pix.width, pix.height, detail),
+    )
+
+
+def choose_details(high_costs: List[int], budget: int) -> List[str]:
+    """
+    Detail level per image of one request: "high" in page order while the
+    request's vision tokens stay within `budget` (counting the remaining
+    images at low detail), "low" for the rest.
+    """
+    details = []
+    spent = BASE_TOKENS * len(high_costs)
+    for cost in high_costs:
+        if spent - BASE_TOKENS + cost <= budget:
+            spent += cost - BASE_TOKENS
+            details.append("high")
+        else:
+            details.append("low")
+    return details
@@ -3,175 +3,359 @@ import json
 import asyncio
 import pandas as pd
 from tqdm.asyncio import tqdm_asyncio
-from openai import AsyncAzureOpenAI
-from aiolimiter import AsyncLimiter
+from openai import AsyncAzureOpenAI, BadRequestError
 import os
 from pathlib import Path
-import base64
 import ast
+from functools import partial
+from typing import List, Tuple
 
-import tiktoken  # <-- added
 from config import config
+from helpers.tokenizer import get_tokenizer
+from helpers.rate_limiter import rate_limiter
+from helpers.page_image_cache import page_image_cache
+from processing.grading.image_prep import (
+    BASE_TOKENS, IMAGE_DETAILS, ImageOptions, choose_details, prepare_image, vision_tokens,
+)
+
+# Grading instructions shared by single-answer and multi-answer (batched) requests
+GRADING_RULES = (
+    "You are an AI grader specialized in question-level evaluation. You cannot evaluate links!"
+    "Given the question details, rubric, student's answer, and images of their submission, grade strictly based on the rubric. "
+     "Many questions require links that have been swapped out for the contents of that link via webscraping. If a question requires a link but has instead what appears to be a chatbot conversation, do not make any reference to the missing link."
+     "If it appears the user tried to submit a link (for example: 'Link to AI bot: PingPong') however the hyperlink got lost due to converting text to markdown, set needs_human_eval to TRUE"
+     "Generally, we have access to the content of any link of the regex form r'https://pingpong.hks.harvard.edu/group/d+/thread/(d+)', and try to swap those in prior to AI grading. However, sometimes student submit invalid PingPong links or hypertext as noted above. If an answer has a pingpong link (or any other link) but no further conversation context (we paste conversations in.) Set needs_human_eval to true. "
+    "If the answer contains non-gradable content or rubric says human evaluation is required, set 'needs_human_eval' to TRUE. "
+)
+
+GRADING_SYSTEM_PROMPT = GRADING_RULES + "Return a JSON object inside triple backticks, no extra commentary."
+
+SIMPLE_GRADING_SYSTEM_PROMPT = (
+    "You are an AI grader.  Using the rubric, decide how many points "
+    "to award (0 – TOTAL_POINTS).  Reply ONLY with a JSON object, e.g.\n"
+    '{"points_awarded": 3}'
+)
+
+
+def question_prefix(row) -> str:
+    """
+    The part of a grading prompt shared by every student's answer to a
+    question: context, question, rubric and total points.
 
-# Setup rate limiters using centralized config
-request_limiter = AsyncLimiter(config.rate_limits.requests_per_minute, 60)
-token_limiter = AsyncLimiter(config.rate_limits.tokens_per_minute, 60)
+    It is built only from question-level fields, so it is byte-identical
+    across the students and can be served from the provider's prompt cache;
+    everything student-specific goes after it.
+    """
+    return f"""
+QUESTION CONTEXT:
+{row['question_context']}
 
-# Initialize the encoder for your model
-encoder = tiktoken.get_encoding(config.models.encoder_model)
+QUESTION:
+{row['question_text']}
 
-async def grade_questions(
+RUBRIC:
+{row['rubric']}
+
+TOTAL POINTS: {row['total_points']}
+"""
+
+
+def question_major(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reorder rows so all answers to a question are adjacent (questions in order
+    of first appearance, rows in their original order within a question).
+    Requests then go out question by question and the shared prompt prefix
+    stays warm in the provider's cache.
+    """
+    codes, _ = pd.factorize(df["question_number"])
+    return df.iloc[codes.argsort(kind="stable")]
+
+
+def merge_grading_inputs(
     df_questions: pd.DataFrame,
     std_questions: pd.DataFrame,
     rubric: pd.DataFrame,
-    openai_client: AsyncAzureOpenAI,
-    model: str = "gpt-4",
-    page_mapping: pd.DataFrame = None,
-    img_dir: str = None,
-    token_tracker= None
+    page_mapping: pd.DataFrame = None
 ) -> pd.DataFrame:
+    """One row per (submission, question) with its answer, question, rubric and mapped pages."""
     df_questions = df_questions[["original_file_name","submission_id", "question_number", "answer_text"]].copy()
     std_questions = std_questions[["question_number", "question_text", "question_context"]].copy()
     rubric = rubric[["question_number", "rubric", "total_points"]].copy()
 
     merged = pd.merge(std_questions, rubric, on="question_number", how="left")
     df_merged = pd.merge(df_questions, merged, on="question_number", how="left")
-    results = []
 
     # Merge in the page mapping if provided
     if page_mapping is not None:
         df_merged = pd.merge(df_merged, page_mapping[["submission_id", "question_number", "pages"]], on=["submission_id", "question_number"], how="left")
     else:
         df_merged["pages"] = None
+    return df_merged
 
-    async def grade_row(row):
-        system_prompt = (
-            "You are an AI grader specialized in question-level evaluation. You cannot evaluate links!"
-            "Given the question details, rubric, student's answer, and images of their submission, grade strictly based on the rubric. "
-             "Many questions require links that have been swapped out for the contents of that link via webscraping. If a question requires a link but has instead what appears to be a chatbot conversation, do not make any reference to the missing link."
-             "If it appears the user tried to submit a link (for example: 'Link to AI bot: PingPong') however the hyperlink got lost due to converting text to markdown, set needs_human_eval to TRUE"
-             "Generally, we have access to the content of any link of the regex form r'https://pingpong.hks.harvard.edu/group/d+/thread/(d+)', and try to swap those in prior to AI grading. However, sometimes student submit invalid PingPong links or hypertext as noted above. If an answer has a pingpong link (or any other link) but no further conversation context (we paste conversations in.) Set needs_human_eval to true. "
-            "If the answer contains non-gradable content or rubric says human evaluation is required, set 'needs_human_eval' to TRUE. "
-            "Return a JSON object inside triple backticks, no extra commentary."
-        )
 
-        # Parse images
+class GradingImages:
+    """
+    Page images attached to grading requests.
+
+    Pages come from ``page_images`` (a PageImageProvider that renders mapped
+    pages on demand) when given, otherwise from pre-rendered PNGs in
+    ``img_dir``. They are prepared for the vision model (see image_prep:
+    grayscale, trimmed, resized to tile boundaries, JPEG) at ``detail``;
+    "auto" sends pages at high detail while the request stays within
+    ``token_budget`` vision tokens and the rest at low detail. Each prepared
+    page is shared by every question it is mapped to through ``cache`` (a
+    PageImageCache).
+    """
+
+    def __init__(
+        self,
+        page_images=None,
+        img_dir: str = None,
+        cache=page_image_cache,
+        detail: str = config.processing.grading_image_detail,
+        token_budget: int = config.processing.grading_image_token_budget,
+        options: ImageOptions = ImageOptions()
+    ):
+        if detail not in IMAGE_DETAILS:
+            raise ValueError(f"image_detail must be one of {IMAGE_DETAILS}, got {detail!r}")
+        self.page_images = page_images
+        self.img_dir = img_dir
+        self.cache = cache
+        self.detail = detail
+        self.token_budget = token_budget
+        self.options = options
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.img_dir) or self.page_images is not None
+
+    async def page_image(self, row, page_num, detail):
+        encode = partial(prepare_image, detail=detail, options=self.options)
+        if self.page_images is not None:
+            return await self.cache.page_image(
+                self.page_images, row["original_file_name"], page_num, encode, (self.options, detail)
+            )
+        img_name = f"{Path(row['original_file_name']).stem}_page_{page_num}.png"
+        return await self.cache.file_image(os.path.join(self.img_dir, img_name), encode, (self.options, detail))
+
+    def pages(self, row) -> List[int]:
+        """Mapped page numbers of a row whose images would be attached."""
+        if not self.enabled or not row.get("pages"):
+            return []
+        try:
+            pages = ast.literal_eval(row["pages"]) if isinstance(row["pages"], str) else row["pages"]
+            if not isinstance(pages, list):
+                pages = [pages]
+        except Exception:
+            pages = [row["pages"]]
+        return [int(page_num) for page_num in pages]
+
+    def estimate_tokens(self, row) -> int:
+        """
+        Vision tokens of a row's pages without preparing them, assuming every
+        page is a full 544x704 render (trimming only makes them cheaper).
+        """
+        pages = self.pages(row)
+        high = vision_tokens(544, 704, "high")
+        if self.detail == "auto":
+            details = choose_details([high] * len(pages), self.token_budget)
+        else:
+            details = [self.detail] * len(pages)
+        return sum(high if detail == "high" else BASE_TOKENS for detail in details)
+
+    async def for_row(self, row) -> Tuple[List[dict], int, List[str]]:
+        """(image_url content parts, vision tokens, image names) for a row's mapped pages."""
         images = []
         image_tokens = 0
         image_refs = []
-        if img_dir and row.get("pages"):
-            try:
-                pages = ast.literal_eval(row["pages"]) if isinstance(row["pages"], str) else row["pages"]
-                if not isinstance(pages, list):
-                    pages = [pages]
-            except Exception:
-                pages = [row["pages"]]
-            for page_num in pages:
-                img_name = f"{Path(row['original_file_name']).stem}_page_{int(page_num)}.png"
-                img_path = os.path.join(img_dir, img_name)
-                if os.path.exists(img_path):
-                    with open(img_path, "rb") as f:
-                        img_b64 = base64.b64encode(f.read()).decode("utf-8")
-                        images.append({
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{img_b64}"}
-                        })
-                        # Estimate tokens for this image (adjust as needed)
-                        image_tokens += round(17 * 22 * 1.7)
-                        image_refs.append(img_name)
-
-        # Build user prompt, referencing images
-        user_text = f"""
-QUESTION CONTEXT:
-{row['question_context']}
-
-QUESTION:
-{row['question_text']}
+        pages = self.pages(row)
+        if not pages:
+            return images, image_tokens, image_refs
+        first_detail = "high" if self.detail == "auto" else self.detail
+        prepared = await asyncio.gather(*(self.page_image(row, page_num, first_detail) for page_num in pages))
+        found = [(page_num, img) for page_num, img in zip(pages, prepared) if img is not None]
+        if self.detail == "auto":
+            # Keep high detail while the request fits the budget; the rest go low
+            details = choose_details([img.tokens for _, img in found], self.token_budget)
+            found = [
+                (page_num, img if detail == "high" else await self.page_image(row, page_num, "low"))
+                for (page_num, img), detail in zip(found, details)
+            ]
+        for page_num, img in found:
+            if img is None:
+                continue
+            images.append({
+                "type": "image_url",
+                "image_url": {"url": img.url, "detail": img.detail}
+            })
+            # Real vision-token cost from the final image size
+            image_tokens += img.tokens
+            image_refs.append(f"{Path(row['original_file_name']).stem}_page_{page_num}.png")
+        return images, image_tokens, image_refs
+
+    def print_stats(self):
+        if self.cache.hits or self.cache.misses:
+            self.cache.print_stats()
+
+
+def failed_grade(row) -> dict:
+    """Result row for an answer that could not be graded: 0 points, flagged for a human."""
+    return {
+        "submission_id": row["submission_id"],
+        "question_number": row["question_number"],
+        "question_context": row['question_context'],
+        "question_text": row["question_text"],
+        "answer_text": row["answer_text"],
+        "rubric": row["rubric"],
+        "points_awarded": 0,
+        "total_points": row["total_points"],
+        "grade_explanation": "",
+        "needs_human_eval": True
+    }
+
+
+async def grading_request(row, images_source: GradingImages) -> Tuple[List[dict], int]:
+    """
+    Messages of the full grading request for one (submission, question) row,
+    and its estimated input tokens (text plus vision).
+    """
+    images, image_tokens, image_refs = await images_source.for_row(row)
 
+    # Build user prompt: the shared question prefix first, then the student's answer and images
+    prefix_text = question_prefix(row) + """
+Grade the student's answer below. Return a JSON object inside triple backticks with:
+- "points_awarded"
+- "grade_explanation"
+- "needs_human_eval"
+"""
+    answer_text = f"""
 STUDENT ANSWER:
 {row['answer_text']}
 
-RUBRIC:
-{row['rubric']}
-
-TOTAL POINTS: {row['total_points']}
-
 Image(s) of the student's submission: {', '.join(image_refs) if image_refs else 'None'}
+"""
 
-Please grade the student's answer. Return a JSON object inside triple backticks with:
-- "points_awarded"
-- "grade_explanation"
-- "needs_human_eval"
+    # Token estimation (the system prompt's count is memoized)
+    tokenizer = get_tokenizer()
+    system_tokens = tokenizer.count(GRADING_SYSTEM_PROMPT, shared=True)
+    user_tokens = tokenizer.count(prefix_text, shared=True) + tokenizer.count(answer_text)
+    total_tokens = system_tokens + user_tokens + image_tokens
+
+    messages = [
+        {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+        {"role": "user", "content": [
+            {"type": "text", "text": prefix_text},
+            {"type": "text", "text": answer_text},
+        ] + images},
+    ]
+    return messages, total_tokens
+
+
+def parse_grading_output(llm_output: str, row) -> dict:
+    """The grade JSON of a full grading response, with the row's question fields added."""
+    pattern = r"```(?:json)?(.*?)```"
+    match = re.search(pattern, llm_output, re.DOTALL)
+    raw_json = match.group(1).strip() if match else llm_output.strip()
+
+    data = json.loads(raw_json)
+    if not isinstance(data, dict):
+        raise ValueError("LLM output is not a JSON object.")
+
+    data.update({
+        "question_number": row["question_number"],
+        "question_context": row["question_context"],
+        "question_text": row["question_text"],
+        "total_points": row["total_points"],
+        "submission_id": row["submission_id"],
+        "answer_text": row["answer_text"],
+        "rubric": row["rubric"]
+    })
+    return data
+
+
+def simple_grading_request(row) -> Tuple[List[dict], int]:
+    """Messages of a quick (points-only) grading request for one row, and its estimated input tokens."""
+    # build the user prompt: shared question prefix first, student answer last
+    prefix_prompt = question_prefix(row)
+    answer_prompt = f"""
+STUDENT ANSWER:
+{row['answer_text']}
 """
+    # count tokens (the prefix count is memoized across students)
+    tokenizer = get_tokenizer()
+    prompt_tokens = (
+        tokenizer.count(SIMPLE_GRADING_SYSTEM_PROMPT, shared=True)
+        + tokenizer.count(prefix_prompt, shared=True)
+        + tokenizer.count(answer_prompt)
+    )
+    messages = [
+        {"role":"system","content":SIMPLE_GRADING_SYSTEM_PROMPT},
+        {"role":"user","content":prefix_prompt + answer_prompt},
+    ]
+    return messages, prompt_tokens
+
+
+def parse_simple_output(content):
+    """Points awarded in a quick grading response."""
+    # content should already be a dict when using json_object:
+    data = content if isinstance(content, dict) else json.loads(content)
+    return data.get("points_awarded", 0)
 
-        # Token estimation
-        encoding = tiktoken.get_encoding(config.models.encoder_model)
-        system_tokens = len(encoding.encode(system_prompt))
-        user_tokens = len(encoding.encode(user_text))
-        total_tokens = system_tokens + user_tokens + image_tokens
-        if token_tracker:
-            token_tracker.add("grading", total_tokens)
 
-        #print(f"Estimated tokens for submission_id={row['submission_id']}, question={row['question_number']}: {total_tokens}")
+async def grade_questions(
+    df_questions: pd.DataFrame,
+    std_questions: pd.DataFrame,
+    rubric: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    model: str = "gpt-4",
+    page_mapping: pd.DataFrame = None,
+    img_dir: str = None,
+    token_tracker= None,
+    page_images=None,
+    image_cache=page_image_cache,
+    image_detail: str = config.processing.grading_image_detail,
+    image_token_budget: int = config.processing.grading_image_token_budget,
+    image_options: ImageOptions = ImageOptions()
+) -> pd.DataFrame:
+    """
+    Grade every (submission, question) row against its rubric.
 
-        # Build messages for OpenAI API
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": [{"type": "text", "text": user_text}] + images},
-        ]
+    Page images are attached as described in GradingImages (``page_images``
+    or ``img_dir``, prepared at ``image_detail`` within ``image_token_budget``
+    and shared through ``image_cache``).
+    """
+    images_source = GradingImages(page_images, img_dir, image_cache, image_detail, image_token_budget, image_options)
+    df_merged = merge_grading_inputs(df_questions, std_questions, rubric, page_mapping)
+    results = []
 
+    async def grade_row(row):
         try:
-            async with request_limiter:
-                await token_limiter.acquire(total_tokens)
-                response = await openai_client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                )
-
-            llm_output = response.choices[0].message.content
-
-            pattern = r"```(?:json)?(.*?)```"
-            match = re.search(pattern, llm_output, re.DOTALL)
-            raw_json = match.group(1).strip() if match else llm_output.strip()
-
-            data = json.loads(raw_json)
-            if not isinstance(data, dict):
-                raise ValueError("LLM output is not a JSON object.")
-
-            data.update({
-                "question_number": row["question_number"],
-                "question_context": row["question_context"],
-                "question_text": row["question_text"],
-                "total_points": row["total_points"],
-                "submission_id": row["submission_id"],
-                "answer_text": row["answer_text"],
-                "rubric": row["rubric"]
-            })
+            # Inside the try, so a page image that fails to prepare only fails this row
+            messages, total_tokens = await grading_request(row, images_source)
+            if token_tracker:
+                token_tracker.add("grading", total_tokens)
 
-            return data
+            response = await rate_limiter.chat(openai_client, total_tokens, model=model, messages=messages)
+            if token_tracker:
+                token_tracker.add_usage("grading", response.usage)
 
+            return parse_grading_output(response.choices[0].message.content, row)
         except Exception as e:
             print(f"Error grading submission_id={row['submission_id']}, question={row['question_number']}: {e}")
-            return {
-                "submission_id": row["submission_id"],
-                "question_number": row["question_number"],
-                "question_context": row['question_context'],
-                "question_text": row["question_text"],
-                "answer_text": row["answer_text"],
-                "rubric": row["rubric"],
-                "points_awarded": 0,
-                "total_points": row["total_points"],
-                "grade_explanation": "",
-                "needs_human_eval": True
-            }
-
-    tasks = [grade_row(row) for _, row in df_merged.iterrows()]
+            return failed_grade(row)
+
+    # Question-major order keeps each question's prompt prefix cached while its answers are graded;
+    # tasks are started here, in that order (as_completed would start bare coroutines in set order)
+    tasks = [asyncio.ensure_future(grade_row(row)) for _, row in question_major(df_merged).iterrows()]
 
     # Just await them all together — limiter handles the pacing
     for result in tqdm_asyncio.as_completed(tasks, total=len(tasks), desc="Grading Questions"):
         res = await result
         results.append(res)
 
+    images_source.print_stats()
+    rate_limiter.print_metrics()
+
     if token_tracker:
         token_tracker.print_process("grading")
     
@@ -192,57 +376,22 @@ async def grade_questions_simple(
     """
 
     bar_desc = bar_desc or f"Grading pass {n}"
-    system_prompt = (
-        "You are an AI grader.  Using the rubric, decide how many points "
-        "to award (0 – TOTAL_POINTS).  Reply ONLY with a JSON object, e.g.\n"
-        '{"points_awarded": 3}'
-    )
 
     async def grade_row(idx: int, row):
-        # build the user prompt
-        user_prompt = f"""
-QUESTION CONTEXT:
-{row['question_context']}
-
-QUESTION:
-{row['question_text']}
-
-STUDENT ANSWER:
-{row['answer_text']}
-
-RUBRIC:
-{row['rubric']}
-
-TOTAL_POINTS: {row['total_points']}
-"""
-        # count tokens
-        prompt_tokens = (
-            len(encoder.encode(system_prompt))
-            + len(encoder.encode(user_prompt))
-        )
+        messages, prompt_tokens = simple_grading_request(row)
         if token_tracker:
             token_tracker.add("fast_grading", prompt_tokens)
         # rate-limit
-        async with request_limiter:
-            await token_limiter.acquire(prompt_tokens)
-            try:
-                resp = await openai_client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role":"system","content":system_prompt},
-                        {"role":"user","content":user_prompt},
-                    ]
-                )
-            except (Exception) as e:
-                # API rejected us or network issue
-                return idx, pd.NA
+        try:
+            resp = await rate_limiter.chat(openai_client, prompt_tokens, model=model, messages=messages)
+        except (Exception) as e:
+            # API rejected us or network issue
+            return idx, pd.NA
+        if token_tracker:
+            token_tracker.add_usage("fast_grading", resp.usage)
             # parse out the JSON object (Azure gives you a true dict here)
         try:
-            content = resp.choices[0].message.content
-            # content should already be a dict when using json_object:
-            data = content if isinstance(content, dict) else json.loads(content)
-            pts  = data.get("points_awarded", 0)
-            return idx, pts
+            return idx, parse_simple_output(resp.choices[0].message.content)
         except Exception as e:
             # log the very first bad payload so you can inspect it in your logs
             print(e)
@@ -252,7 +401,7 @@ TOTAL_POINTS: {row['total_points']}
             return idx, pd.NA
 
     # launch & gather with a live tqdm bar
-    tasks   = [grade_row(i, r) for i, r in df.iterrows()]
+    tasks   = [grade_row(i, r) for i, r in question_major(df).iterrows()]
     results = await tqdm_asyncio.gather(*tasks, desc=bar_desc)
     # rebuild the grade list in order
     grades = [pd.NA] * len(results)
@@ -260,4 +409,117 @@ TOTAL_POINTS: {row['total_points']}
         grades[idx] = pts
 
     df[f"grade_{n}"] = grades
-    return df
\ No newline at end of file
+    return df
+
+SAMPLING_MODES = ("n", "fanout")
+
+
+def add_agreement_stats(df: pd.DataFrame, k: int) -> dict:
+    """
+    Add per-row agreement columns over the quick grades grade_1..grade_k:
+    grade_mean, grade_spread (max - min) and grades_agree (every sample
+    identical; NA with fewer than two samples). Prints and returns a summary.
+    """
+    samples = df[[f"grade_{i}" for i in range(1, k + 1)]].apply(pd.to_numeric, errors="coerce")
+    counted = samples.notna().sum(axis=1)
+    df["grade_mean"] = samples.mean(axis=1)
+    df["grade_spread"] = samples.max(axis=1) - samples.min(axis=1)
+    df["grades_agree"] = (df["grade_spread"] == 0).astype("boolean").where(counted >= 2, pd.NA)
+
+    compared = counted >= 2
+    summary = {
+        "rows": int(compared.sum()),
+        "all_agree": float(df.loc[compared, "grades_agree"].astype(bool).mean()) if compared.any() else float("nan"),
+        "mean_spread": float(df.loc[compared, "grade_spread"].mean()) if compared.any() else float("nan"),
+    }
+    if "points_awarded" in df:
+        full = pd.to_numeric(df["points_awarded"], errors="coerce")
+        matched = compared & full.notna()
+        summary["matches_full_pass"] = (
+            float((samples[matched].median(axis=1) == full[matched]).mean()) if matched.any() else float("nan")
+        )
+    print(f"Quick grade agreement over {summary['rows']} answers ({k} samples): "
+          f"{summary['all_agree']:.0%} identical, mean spread {summary['mean_spread']:.2f} points"
+          + (f", median matches full pass {summary['matches_full_pass']:.0%}" if "matches_full_pass" in summary else ""))
+    return summary
+
+
+async def grade_questions_multi_sample(
+    df: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    k: int = config.processing.quick_grade_samples,
+    model: str = "gpt-4",
+    bar_desc: str | None = None,
+    token_tracker = None,
+    sampling: str = config.processing.quick_grade_sampling
+) -> pd.DataFrame:
+    """
+    Quick-grade every row `k` times in one sweep: adds grade_1..grade_k
+    (points, or pd.NA on failure) and the agreement columns of
+    add_agreement_stats.
+
+    With sampling "n", each row is one request for `k` choices, so the
+    question, rubric and answer are sent and billed once. With "fanout", the
+    `k` requests of a row go out together (after the first, the prompt is
+    served from the provider's prefix cache). Deployments that reject `n`
+    fall back to fan-out.
+    """
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"sampling must be one of {SAMPLING_MODES}, got {sampling!r}")
+    bar_desc = bar_desc or f"Quick grading ({k} samples)"
+    use_n = sampling == "n" and k > 1
+
+    async def request(messages, prompt_tokens, n):
+        if token_tracker:
+            token_tracker.add("fast_grading", prompt_tokens)
+        kwargs = {"n": n} if n > 1 else {}
+        resp = await rate_limiter.chat(openai_client, prompt_tokens, model=model, messages=messages, **kwargs)
+        if token_tracker:
+            token_tracker.add_usage("fast_grading", resp.usage)
+        return resp.choices
+
+    async def sample(messages, prompt_tokens):
+        try:
+            return (await request(messages, prompt_tokens, 1))[0]
+        except Exception:
+            # API rejected us or network issue
+            return None
+
+    async def grade_row(idx, row):
+        nonlocal use_n
+        messages, prompt_tokens = simple_grading_request(row)
+        choices = None
+        if use_n:
+            try:
+                choices = await request(messages, prompt_tokens, k)
+            except BadRequestError as e:
+                if getattr(e, "param", None) != "n" and "'n'" not in str(e):
+                    choices = []
+                elif use_n:
+                    print(f"Deployment rejected n={k} ({e}); falling back to parallel requests")
+                    use_n = False
+            except Exception:
+                choices = []
+        if choices is None:
+            choices = await asyncio.gather(*(sample(messages, prompt_tokens) for _ in range(k)))
+
+        grades = []
+        for choice in list(choices)[:k]:
+            try:
+                grades.append(parse_simple_output(choice.message.content))
+            except Exception as e:
+                print(e)
+                grades.append(pd.NA)
+        return idx, grades + [pd.NA] * (k - len(grades))
+
+    tasks = [grade_row(idx, row) for idx, row in question_major(df).iterrows()]
+    results = await tqdm_asyncio.gather(*tasks, desc=bar_desc)
+
+    grades = pd.DataFrame(
+        [g for _, g in results], index=[idx for idx, _ in results],
+        columns=[f"grade_{i}" for i in range(1, k + 1)], dtype="object",
+    )
+    for column in grades:
+        df[column] = grades[column]
+    add_agreement_stats(df, k)
+    return df
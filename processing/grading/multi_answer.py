@@ -0,0 +1,378 @@
+"""
+Multi-answer grading: several students' answers to one question per request.
+
+Single-answer grading resends the question context and rubric with every
+answer. Here answers to the same question are packed into one request (up to
+``batch_size`` answers and ``max_tokens`` estimated input tokens), after the
+same shared prompt prefix, and the model returns a structured grade for each
+submission_id. A response that does not validate (a missing or unexpected
+submission, points outside 0..total_points, a parse error or a failed call)
+is split in half and each half is retried, down to single answers, so one bad
+answer never costs the grades of the whole batch.
+
+check_batch_consistency re-grades a sample of whole batches one answer at a
+time and batched, and reports how well the two agree.
+"""
+
+import asyncio
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+from openai import AsyncAzureOpenAI
+from pydantic import BaseModel, Field
+from tqdm.asyncio import tqdm_asyncio
+
+from config import config
+from helpers.page_image_cache import page_image_cache
+from helpers.rate_limiter import rate_limiter
+from helpers.tokenizer import get_tokenizer
+from processing.grading.image_prep import ImageOptions
+from processing.grading.llm_grader import (
+    GRADING_RULES, GradingImages, failed_grade, grade_questions_simple, merge_grading_inputs,
+    question_major, question_prefix,
+)
+
+
+class AnswerGrade(BaseModel):
+    submission_id: str
+    points_awarded: float
+    grade_explanation: str
+    needs_human_eval: bool
+
+
+class AnswerGrades(BaseModel):
+    grades: List[AnswerGrade] = Field(default_factory=list)
+
+
+class AnswerPoints(BaseModel):
+    submission_id: str
+    points_awarded: float
+
+
+class AnswerPointsList(BaseModel):
+    grades: List[AnswerPoints] = Field(default_factory=list)
+
+
+BATCH_GRADING_SYSTEM_PROMPT = GRADING_RULES + (
+    "You will be given several students' answers to the same question, each labeled with its SUBMISSION ID "
+    "and followed by images of that student's submission. Grade every answer independently, exactly as if it "
+    "were the only one; never compare students. Return one entry per submission id."
+)
+
+BATCH_SIMPLE_SYSTEM_PROMPT = (
+    "You are an AI grader.  You will be given several students' answers to the same question, each labeled "
+    "with its SUBMISSION ID.  Using the rubric, decide independently for each answer how many points to award "
+    "(0 – TOTAL POINTS).  Return one entry per submission id."
+)
+
+BATCH_INSTRUCTIONS = """
+Grade each student's answer below independently. Return one entry per SUBMISSION ID.
+"""
+
+
+class BatchValidationError(ValueError):
+    """A multi-answer response that cannot be matched to its batch."""
+
+
+def pack_batches(rows: List[Dict], costs: List[int], batch_size: int, max_tokens: int) -> List[List[int]]:
+    """
+    Group question-major `rows` (by position) into batches of the same question,
+    with unique submission ids, at most `batch_size` rows and `max_tokens` of
+    estimated cost. A row over `max_tokens` on its own forms its own batch.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    spent = 0
+    for i, row in enumerate(rows):
+        if current:
+            first = rows[current[0]]
+            if (
+                row["question_number"] != first["question_number"]
+                or len(current) >= batch_size
+                or spent + costs[i] > max_tokens
+                or any(rows[j]["submission_id"] == row["submission_id"] for j in current)
+            ):
+                batches.append(current)
+                current, spent = [], 0
+        current.append(i)
+        spent += costs[i]
+    if current:
+        batches.append(current)
+    return batches
+
+
+def validate_batch(entries, rows: List[Dict]) -> Dict[str, BaseModel]:
+    """Map each row's submission_id to its entry, or raise BatchValidationError."""
+    expected = {str(row["submission_id"]) for row in rows}
+    found = {}
+    for entry in entries:
+        sid = str(entry.submission_id).strip()
+        if sid not in expected:
+            raise BatchValidationError(f"unexpected submission_id {sid!r}")
+        if sid in found:
+            raise BatchValidationError(f"duplicate submission_id {sid!r}")
+        found[sid] = entry
+    missing = expected - set(found)
+    if missing:
+        raise BatchValidationError(f"no grade for {sorted(missing)}")
+    for row in rows:
+        points = found[str(row["submission_id"])].points_awarded
+        total = pd.to_numeric(row["total_points"], errors="coerce")
+        if points < 0 or (pd.notna(total) and points > total):
+            raise BatchValidationError(
+                f"{points} points for {row['submission_id']} is outside 0..{row['total_points']}"
+            )
+    return found
+
+
+async def grade_with_splitting(
+    rows: List[Dict],
+    grade_batch: Callable,
+    on_failure: Callable,
+) -> List:
+    """
+    Grade `rows` with one `grade_batch(rows)` call; if it raises, split the rows
+    in half and grade each half the same way. A single row that still fails
+    gets `on_failure(row, error)`.
+    """
+    try:
+        return await grade_batch(rows)
+    except Exception as e:
+        if len(rows) == 1:
+            return [on_failure(rows[0], e)]
+        mid = len(rows) // 2
+        left, right = await asyncio.gather(
+            grade_with_splitting(rows[:mid], grade_batch, on_failure),
+            grade_with_splitting(rows[mid:], grade_batch, on_failure),
+        )
+        return left + right
+
+
+async def _parse(openai_client, model, messages, response_format, tokens, token_tracker, process_name):
+    """One structured-output call under the shared rate limiter; returns the parsed model."""
+    response = await rate_limiter.parse(
+        openai_client, tokens, model=model, messages=messages, response_format=response_format
+    )
+    if token_tracker:
+        token_tracker.add_usage(process_name, response.usage)
+    parsed = response.choices[0].message.parsed
+    if parsed is None:
+        raise BatchValidationError("response could not be parsed")
+    return parsed
+
+
+async def grade_questions_batched(
+    df_questions: pd.DataFrame,
+    std_questions: pd.DataFrame,
+    rubric: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    model: str = "gpt-4",
+    page_mapping: pd.DataFrame = None,
+    img_dir: str = None,
+    token_tracker=None,
+    page_images=None,
+    image_cache=page_image_cache,
+    image_detail: str = config.processing.grading_image_detail,
+    image_token_budget: int = config.processing.grading_image_token_budget,
+    image_options: ImageOptions = ImageOptions(),
+    batch_size: int = config.processing.grading_batch_size,
+    max_tokens: int = config.processing.grading_batch_max_tokens
+) -> pd.DataFrame:
+    """
+    Like grade_questions, but grades up to `batch_size` answers to the same
+    question per request (bounded by `max_tokens` estimated input tokens).
+    Each student's answer is followed by their own page images. Returns the
+    same columns as grade_questions.
+    """
+    images_source = GradingImages(page_images, img_dir, image_cache, image_detail, image_token_budget, image_options)
+    df_merged = question_major(merge_grading_inputs(df_questions, std_questions, rubric, page_mapping))
+    rows = df_merged.to_dict("records")
+
+    tokenizer = get_tokenizer()
+
+    def answer_text(row, image_refs) -> str:
+        return f"""
+SUBMISSION ID: {row['submission_id']}
+STUDENT ANSWER:
+{row['answer_text']}
+
+Image(s) of this student's submission: {', '.join(image_refs) if image_refs else 'None'}
+"""
+
+    # Batches are packed by estimated cost; images are only prepared once a batch is sent,
+    # so a page that fails to prepare is handled like any other failed batch
+    costs = tokenizer.count_many(answer_text(row, []) for row in rows)
+    costs = [cost + images_source.estimate_tokens(row) for cost, row in zip(costs, rows)]
+
+    async def grade_batch(batch: List[Dict]) -> List[Dict]:
+        prefix_text = question_prefix(batch[0]) + BATCH_INSTRUCTIONS
+        content = [{"type": "text", "text": prefix_text}]
+        tokens = (
+            tokenizer.count(BATCH_GRADING_SYSTEM_PROMPT, shared=True)
+            + tokenizer.count(prefix_text, shared=True)
+        )
+        prepared = await asyncio.gather(*(images_source.for_row(row) for row in batch))
+        for row, (images, image_tokens, image_refs) in zip(batch, prepared):
+            text = answer_text(row, image_refs)
+            content.append({"type": "text", "text": text})
+            content.extend(images)
+            tokens += tokenizer.count(text) + image_tokens
+        if token_tracker:
+            token_tracker.add("grading", tokens)
+        parsed = await _parse(
+            openai_client, model,
+            [
+                {"role": "system", "content": BATCH_GRADING_SYSTEM_PROMPT},
+                {"role": "user", "content": content},
+            ],
+            AnswerGrades, tokens, token_tracker, "grading",
+        )
+        grades = validate_batch(parsed.grades, batch)
+        results = []
+        for row in batch:
+            grade = grades[str(row["submission_id"])]
+            results.append({
+                "points_awarded": grade.points_awarded,
+                "grade_explanation": grade.grade_explanation,
+                "needs_human_eval": grade.needs_human_eval,
+                "question_number": row["question_number"],
+                "question_context": row["question_context"],
+                "question_text": row["question_text"],
+                "total_points": row["total_points"],
+                "submission_id": row["submission_id"],
+                "answer_text": row["answer_text"],
+                "rubric": row["rubric"],
+            })
+        return results
+
+    def on_failure(row, error):
+        print(f"Error grading submission_id={row['submission_id']}, question={row['question_number']}: {error}")
+        return failed_grade(row)
+
+    batches = pack_batches(rows, costs, batch_size, max_tokens)
+    tasks = [
+        asyncio.ensure_future(grade_with_splitting([rows[i] for i in batch], grade_batch, on_failure))
+        for batch in batches
+    ]
+    results = []
+    for result in tqdm_asyncio.as_completed(tasks, total=len(tasks), desc=f"Grading Questions ({len(rows)} answers)"):
+        results.extend(await result)
+
+    images_source.print_stats()
+    rate_limiter.print_metrics()
+    if token_tracker:
+        token_tracker.print_process("grading")
+    return pd.DataFrame(results)
+
+
+async def grade_questions_simple_batched(
+    df: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    n,
+    model: str = "gpt-4",
+    bar_desc: str | None = None,
+    token_tracker=None,
+    batch_size: int = config.processing.grading_batch_size,
+    max_tokens: int = config.processing.grading_batch_max_tokens
+) -> pd.DataFrame:
+    """
+    Like grade_questions_simple (adds a column `grade_{n}` with the points, or
+    pd.NA on failure), but grades up to `batch_size` answers to the same
+    question per request.
+    """
+    bar_desc = bar_desc or f"Grading pass {n}"
+    tokenizer = get_tokenizer()
+    ordered = question_major(df)
+    rows = [dict(row, _index=idx) for idx, row in zip(ordered.index, ordered.to_dict("records"))]
+    texts = [f"""
+SUBMISSION ID: {row['submission_id']}
+STUDENT ANSWER:
+{row['answer_text']}
+""" for row in rows]
+    costs = tokenizer.count_many(texts)
+    position = {id(row): i for i, row in enumerate(rows)}
+
+    async def grade_batch(batch: List[Dict]) -> List:
+        prefix_text = question_prefix(batch[0]) + BATCH_INSTRUCTIONS
+        user_prompt = prefix_text + "".join(texts[position[id(row)]] for row in batch)
+        tokens = (
+            tokenizer.count(BATCH_SIMPLE_SYSTEM_PROMPT, shared=True)
+            + tokenizer.count(prefix_text, shared=True)
+            + sum(costs[position[id(row)]] for row in batch)
+        )
+        if token_tracker:
+            token_tracker.add("fast_grading", tokens)
+        parsed = await _parse(
+            openai_client, model,
+            [
+                {"role": "system", "content": BATCH_SIMPLE_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+            AnswerPointsList, tokens, token_tracker, "fast_grading",
+        )
+        grades = validate_batch(parsed.grades, batch)
+        return [(row["_index"], grades[str(row["submission_id"])].points_awarded) for row in batch]
+
+    batches = pack_batches(rows, costs, batch_size, max_tokens)
+    results = await tqdm_asyncio.gather(
+        *(grade_with_splitting([rows[i] for i in batch], grade_batch, lambda row, e: (row["_index"], pd.NA))
+          for batch in batches),
+        desc=bar_desc,
+    )
+    grades = pd.Series(pd.NA, index=df.index, dtype="object")
+    for batch_results in results:
+        for idx, points in batch_results:
+            grades[idx] = points
+    df[f"grade_{n}"] = grades
+    return df
+
+
+async def check_batch_consistency(
+    df: pd.DataFrame,
+    openai_client: AsyncAzureOpenAI,
+    model: str = "gpt-4",
+    sample_size: int = config.processing.grading_consistency_sample,
+    batch_size: int = config.processing.grading_batch_size,
+    token_tracker=None
+) -> dict:
+    """
+    Grade a sample of graded rows (with question_context, question_text,
+    answer_text, rubric and total_points) both one answer per request and
+    batched, and report how often the points agree.
+
+    Answers are only batched with answers to the same question, so the sample
+    is drawn as whole batches: random questions, with up to `batch_size`
+    random answers each, until it holds at least `sample_size` answers. The
+    batched side is then graded at the batch size actually used.
+
+    Returns:
+        dict: answers compared, exact agreement rate and mean absolute difference in points.
+    """
+    groups = df.sample(frac=1, random_state=0).groupby("question_number", sort=False).head(batch_size)
+    sizes = groups.groupby("question_number", sort=False).size()
+    questions = sizes.index[sizes.cumsum().shift(fill_value=0) < sample_size]
+    sample = groups[groups["question_number"].isin(questions)].reset_index(drop=True)
+    if sample.empty:
+        return {"answers": 0, "exact_agreement": float("nan"), "mean_abs_diff": float("nan")}
+    sample = await grade_questions_simple(
+        sample, openai_client, n="single", model=model,
+        bar_desc="Consistency check (single)", token_tracker=token_tracker,
+    )
+    sample = await grade_questions_simple_batched(
+        sample, openai_client, n="batched", model=model,
+        bar_desc="Consistency check (batched)", token_tracker=token_tracker, batch_size=batch_size,
+    )
+    single = pd.to_numeric(sample["grade_single"], errors="coerce")
+    batched = pd.to_numeric(sample["grade_batched"], errors="coerce")
+    both = single.notna() & batched.notna()
+    diff = (single[both] - batched[both]).abs()
+    report = {
+        "answers": int(both.sum()),
+        "exact_agreement": float(np.isclose(diff, 0).mean()) if both.any() else float("nan"),
+        "mean_abs_diff": float(diff.mean()) if both.any() else float("nan"),
+    }
+    print(f"Batch grading consistency on {report['answers']} answers: "
+          f"{report['exact_agreement']:.0%} identical points, "
+          f"mean difference {report['mean_abs_diff']:.2f} points")
+    return report
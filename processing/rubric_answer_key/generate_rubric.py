@@ -374,7 +374,7 @@ async def expand_rubric(rubric_markdown: str, questions: pd.DataFrame, openai_cl
     Output only a valid JSON array.
     """
     if token_tracker:
-        token_tracker.add("map_questions_to_pages_llm", system_prompt+user_prompt)
+        token_tracker.add("map_questions_to_pages_llm", (system_prompt, user_prompt))
     try:
         response = await openai_client.chat.completions.create(
             model=model,
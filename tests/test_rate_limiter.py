@@ -0,0 +1,75 @@
+import os
+import time
+import asyncio
+
+os.environ.setdefault("AZURE_ENDPOINT_GPT", "https://example.invalid")
+os.environ.setdefault("AZURE_API_KEY_GPT", "test")
+os.environ.setdefault("AZURE_ENDPOINT", "https://example.invalid")
+os.environ.setdefault("AZURE_API_KEY", "test")
+
+import openai
+try:
+    import httpx
+except ImportError:  # newer openai releases ship their HTTP client as httpx2
+    import httpx2 as httpx
+
+from helpers.rate_limiter import AdaptiveRateLimiter, _Bucket
+
+
+class _RawResponse:
+    def __init__(self, headers):
+        self.headers = httpx.Headers(headers)
+
+    def parse(self):
+        return "ok"
+
+
+def _rate_limit_error(headers):
+    request = httpx.Request("POST", "https://example.invalid/chat/completions")
+    return openai.RateLimitError("rate limited", response=httpx.Response(429, headers=headers, request=request), body=None)
+
+
+def test_lower_limit_header_caps_level_without_debt():
+    bucket = _Bucket(6000)
+    bucket.level = 0.0  # after a 429
+    bucket.observe(600, None)
+    assert bucket.capacity == 600
+    assert 0.0 <= bucket.level <= 600
+
+    bucket = _Bucket(6000)
+    bucket.observe(600, None)
+    assert bucket.level == 600
+
+
+def test_higher_limit_header_adds_the_new_room():
+    bucket = _Bucket(100)
+    bucket.level = 40.0
+    bucket.observe(1000, None)
+    assert bucket.capacity == 1000
+    assert 939 <= bucket.level <= 941
+
+
+def test_429_then_lower_limit_does_not_stall():
+    limiter = AdaptiveRateLimiter(
+        requests_per_minute=6000, tokens_per_minute=1_000_000,
+        initial_concurrency=4, max_concurrency=8, max_retries=3,
+    )
+    calls = {"n": 0}
+
+    async def request():
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise _rate_limit_error({"retry-after-ms": "50"})
+        return _RawResponse({"x-ratelimit-limit-requests": "600"})
+
+    async def main():
+        start = time.monotonic()
+        results = await asyncio.gather(*(limiter.run(request, 10) for _ in range(20)))
+        return results, time.monotonic() - start
+
+    results, elapsed = asyncio.run(main())
+    assert results == ["ok"] * 20
+    assert limiter.requests.capacity == 600
+    assert limiter.metrics()["requests_available"] > -2
+    # 20 requests at 600/min from an empty bucket take about 2 seconds, not minutes
+    assert elapsed < 10